@@ -0,0 +1,239 @@
+# Outbound alert queue
+# Handlers only queue alerts: each one becomes an alert_queue row, committed
+# with the rest of the write batch, so ingestion never waits on Telegram and
+# unsent alerts survive a restart. One dispatcher thread sends them in order,
+# paced by token buckets that follow the Bot API limits (about 30 messages per
+# second overall, one per second in a single chat).
+#
+# Alert kinds: 'message' {'text'}, 'document' {'path', 'caption'} and
+# 'album' {'paths', 'caption'} (sent with sendMediaGroup, 10 files per album).
+# A media file that is still downloading delays its alert; a file that never
+# arrived is replaced by the caption alone. Files are read through tiers.py, so
+# media already moved to warm or cold storage is sent as well.
+
+import json
+import time
+import threading
+from contextlib import ExitStack
+from settings import *
+import storage
+import telegram_api
+import tiers
+import metrics
+
+_ALBUM_SIZE = 10  # Bot API limit for sendMediaGroup
+_MEDIA_RETRY_DELAY = 5  # Seconds between checks for a file that is still downloading
+_MAX_BACKOFF = 300
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Seconds until one token is available
+    def wait_time(self):
+        self._refill(time.monotonic())
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    # Spend tokens; an album may overdraw, which delays the next send to that chat
+    def take(self, count=1):
+        self._refill(time.monotonic())
+        self.tokens -= count
+
+    def full(self):
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+_global_bucket = TokenBucket(ALERT_RATE_GLOBAL, ALERT_RATE_GLOBAL)
+_chat_buckets = {}
+_wake = threading.Event()
+_stop = threading.Event()
+_thread = None
+
+metrics.gauge('bot_alert_queue_depth', storage.alert_queue_size)
+
+# Queue an alert for chat_id (returns at once; sent by the dispatcher thread)
+def enqueue(chat_id, kind, payload):
+    storage.queue_alert(chat_id, kind, json.dumps(payload, ensure_ascii=False))
+    _wake.set()
+
+# Check the queue now (alerts queued by a worker process, see process_runtime.py)
+def wake():
+    _wake.set()
+
+# Queue media files as albums of up to 10; the caption goes on the first album
+def enqueue_album(chat_id, paths, caption=''):
+    for i in range(0, len(paths), _ALBUM_SIZE):
+        enqueue(chat_id, 'album', {'paths': paths[i:i + _ALBUM_SIZE], 'caption': caption if i == 0 else ''})
+
+def _chat_bucket(chat_id):
+    bucket = _chat_buckets.get(chat_id)
+    if bucket is None:
+        if len(_chat_buckets) > 1000:  # Forget idle chats
+            for key in [k for k, b in _chat_buckets.items() if b.full()]:
+                del _chat_buckets[key]
+        bucket = _chat_buckets[chat_id] = TokenBucket(ALERT_RATE_PER_CHAT, ALERT_BURST_PER_CHAT)
+    return bucket
+
+# A file still being downloaded is worth waiting for (up to the download timeout)
+def _media_pending(path, created_at):
+    if tiers.exists(path):
+        return False
+    if time.time() - created_at > MEDIA_DOWNLOAD_TIMEOUT + 60:
+        return False
+    return storage.media_pending(path)  # Queued or downloading in any process
+
+# Attach a media file (and its thumbnail, if one was made) to files;
+# returns the thumbnail's attach:// name or None
+def _attach(stack, files, name, path):
+    file_name, f = tiers.open_original(path)
+    files[name] = (file_name, stack.enter_context(f))
+    thumb = tiers.thumbnail(path)
+    if thumb is None:
+        return None
+    files[f'{name}_thumb'] = stack.enter_context(open(thumb, 'rb'))
+    return f'attach://{name}_thumb'
+
+def _send_document(chat_id, path, caption):
+    with ExitStack() as stack:
+        files = {}
+        data = {'chat_id': chat_id, 'caption': caption[:1024]}
+        thumbnail = _attach(stack, files, 'document', path)
+        if thumbnail:
+            data['thumbnail'] = thumbnail
+        return telegram_api.call('sendDocument', data=data, files=files, wait_on_429=False)
+
+def _send_album(chat_id, paths, caption):
+    with ExitStack() as stack:
+        files = {}
+        media = []
+        for i, path in enumerate(paths):
+            item = {'type': 'document', 'media': f'attach://file{i}'}
+            thumbnail = _attach(stack, files, f'file{i}', path)
+            if thumbnail:
+                item['thumbnail'] = thumbnail
+            media.append(item)
+        if caption:
+            media[0]['caption'] = caption[:1024]  # Shown as the album caption
+        return telegram_api.call('sendMediaGroup', data={'chat_id': chat_id, 'media': json.dumps(media)},
+                                 files=files, wait_on_429=False)
+
+def _send_text(chat_id, text):
+    return telegram_api.call('sendMessage', json={'chat_id': chat_id, 'text': text}, wait_on_429=False)
+
+# Send one queued alert. Returns (Bot API result or None, messages sent), or
+# None when a file is still downloading. A 429 result is returned rather than
+# waited for, and _retry_later defers the chat for its retry_after.
+def _send(row):
+    chat_id, payload = row['chat_id'], json.loads(row['payload'])
+    if row['kind'] == 'document':
+        if _media_pending(payload['path'], row['created_at']):
+            return None
+        if tiers.exists(payload['path']):
+            return _send_document(chat_id, payload['path'], payload['caption']), 1
+        return _send_text(chat_id, payload['caption']), 1
+    if row['kind'] == 'album':
+        if any(_media_pending(path, row['created_at']) for path in payload['paths']):
+            return None
+        paths = [path for path in payload['paths'] if tiers.exists(path)]
+        if len(paths) > 1:
+            return _send_album(chat_id, paths, payload['caption']), len(paths)
+        if paths:
+            return _send_document(chat_id, paths[0], payload['caption']), 1
+        return None, 0  # Nothing left to send, the summary already went out
+    return _send_text(chat_id, payload['text']), 1
+
+def _retry_later(row, result=None):
+    attempts = row['attempts'] + 1
+    if attempts >= ALERT_MAX_ATTEMPTS:
+        print(f"Dropped alert {row['id']} to {row['chat_id']} after {attempts} attempts")
+        storage.delete_alert(row['id'])
+        return
+    delay = min(2 ** attempts, _MAX_BACKOFF)
+    if result and result.get('error_code') == 429:
+        delay = max(delay, result.get('parameters', {}).get('retry_after', 1))
+    storage.defer_alert(row['id'], attempts, time.time() + delay)
+
+# Send due alerts in queue order, skipping chats whose bucket is empty.
+# Returns seconds until the next alert could be sent.
+def _dispatch_due():
+    rows = storage.due_alerts(time.time(), 100)
+    next_wait = ALERT_POLL_INTERVAL
+    busy_chats = set()
+    progress = False
+    for row in rows:
+        chat_id = row['chat_id']
+        if chat_id in busy_chats:
+            continue  # Keep the order within a chat
+        wait = _chat_bucket(chat_id).wait_time()
+        if wait > 0:
+            busy_chats.add(chat_id)
+            next_wait = min(next_wait, wait)
+            continue
+        time.sleep(_global_bucket.wait_time())
+
+        try:
+            with metrics.timer('bot_alert_send_seconds', kind=row['kind']):
+                sent = _send(row)
+        except Exception as e:
+            metrics.inc('bot_failures_total', where='alerts')
+            print(f"Error sending alert {row['id']}: {e}")
+            _retry_later(row)
+            busy_chats.add(chat_id)
+            continue
+        progress = True
+        if sent is None:
+            storage.defer_alert(row['id'], row['attempts'], time.time() + _MEDIA_RETRY_DELAY)
+            busy_chats.add(chat_id)
+            continue
+
+        result, count = sent
+        _chat_bucket(chat_id).take(count)
+        _global_bucket.take(count)
+        error_code = result.get('error_code') if result else None
+        if error_code is None or 400 <= error_code < 500 and error_code != 429:
+            storage.delete_alert(row['id'])  # Sent, or refused for good (bot blocked, bad chat)
+        else:
+            _retry_later(row, result)
+            busy_chats.add(chat_id)
+    if len(rows) == 100 and progress:
+        next_wait = 0  # More alerts are waiting
+    return next_wait
+
+def _run():
+    wait = 0
+    while not _stop.is_set():
+        if wait:
+            _wake.wait(wait)
+        _wake.clear()
+        try:
+            wait = _dispatch_due()
+        except Exception as e:
+            metrics.inc('bot_failures_total', where='alerts')
+            print(f"Alert dispatcher error: {e}")
+            wait = ALERT_POLL_INTERVAL
+
+# Start the dispatcher thread (alerts left from the last run are sent first)
+def start():
+    global _thread
+    if _thread is None:
+        _stop.clear()
+        _thread = threading.Thread(target=_run, name='alert-dispatcher', daemon=True)
+        _thread.start()
+
+# Stop the dispatcher; unsent alerts stay queued for the next start
+def stop(timeout=5):
+    global _thread
+    if _thread is not None:
+        _stop.set()
+        _wake.set()
+        _thread.join(timeout)
+        _thread = None
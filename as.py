@@ -6,237 +6,115 @@
 # @Telegram: https://t.me/eg_rek
 # @Github  : https://github.com/Eg-rek
 
-import sqlite3
 import requests
 import time
 import os
-import json
-from datetime import datetime, timedelta
+import sys
+import signal
+import argparse
+from datetime import datetime
 import schedule
-import uuid
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
-from config import *
-
-# Global spam tracker
-spam_tracker = {}
-
-# Load spam tracker from JSON
-def load_spam_tracker():
-    global spam_tracker
-    try:
-        if os.path.exists('spam_tracker.json'):
-            with open('spam_tracker.json', 'r') as f:
-                spam_tracker = json.load(f)
-                # Convert user_id keys to integers
-                spam_tracker = {int(k): v for k, v in spam_tracker.items()}
-        else:
-            spam_tracker = {}
-    except Exception as e:
-        print(f"Error loading spam_tracker: {e}")
-        spam_tracker = {}
-
-# Save spam tracker to JSON
-def save_spam_tracker():
-    try:
-        with open('spam_tracker.json', 'w') as f:
-            json.dump(spam_tracker, f, indent=2)
-    except Exception as e:
-        print(f"Error saving spam_tracker: {e}")
+from settings import *
+import storage
+import telegram_api
+import backup
+import usage
+import retention
+import spam
+import search
+import history
+import stats
+import tenants
+import async_runtime
+import process_runtime
+import alerts
+import metrics
+import webhook
+import media
+import shards
+import tiers
 
 # Initialize DB and folders
 def init_db():
     os.makedirs(MEDIA_DIR, exist_ok=True)
-    
-    conn = sqlite3.connect('messages.db')
-    c = conn.cursor()
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS messages
-                 (id INTEGER PRIMARY KEY,
-                  message_id INT,
-                  chat_id INT,
-                  user_id INT,
-                  username TEXT,
-                  text TEXT,
-                  original_text TEXT,
-                  date INT,
-                  business_id TEXT,
-                  media_type TEXT,
-                  media_path TEXT,
-                  original_media_type TEXT,
-                  original_media_path TEXT,
-                  is_deleted BOOLEAN DEFAULT 0,
-                  is_edited BOOLEAN DEFAULT 0,
-                  forward_from TEXT,
-                  forward_from_chat INT,
-                  forward_from_message_id INT)''')
-    conn.commit()
-    conn.close()
-
-# Download and save media file
-def download_media(file_id, file_type):
-    try:
-        file_info = requests.get(f'{BASE_URL}/getFile?file_id={file_id}').json()
-        file_path = file_info['result']['file_path']
-        file_size = file_info['result'].get('file_size', 0)
-        
-        if file_size > MAX_FILE_SIZE:
-            print(f"File {file_path} exceeds 50 MB, ignoring.")
-            return None
-        
-        file_url = f'https://api.telegram.org/file/bot{TOKEN}/{file_path}'
-        local_path = f"{MEDIA_DIR}/{file_type}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4()}.{os.path.splitext(file_path)[1]}"
-        
-        with requests.get(file_url, stream=True) as r:
-            with open(local_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
-        
-        return local_path
-    except Exception as e:
-        print(f"Media download error: {e}")
-        return None
+    storage.init_db()
 
 # Check for spam (too many photos) and block media if needed
 def check_spam(user_id, username, first_name, last_name, media_type, msg_data):
-    current_time = time.time()
     user_info = f"{first_name} {last_name}".strip() if last_name else first_name
+    verdict = spam.check(msg_data['business_connection_id'], user_id, media_type)
+    
+    if verdict.already_blocked:
+        metrics.inc('bot_spam_total', action='ignored')
+        print(f"🚫 Ignored media ({media_type}) from @{username} ({user_info}) due to spam block")
+    elif verdict.notify:
+        metrics.inc('bot_spam_total', action='blocked')
+        # Send alert only once per block
+        print(f"⚠️ Spam detected from @{username} ({user_info}): {verdict.photo_count} photos, blocking media for 1 hour")
+        alert_item = {
+            'username': username,
+            'date': msg_data['date'],
+            'photo_count': verdict.photo_count
+        }
+        send_alert([alert_item], msg_data['business_connection_id'], msg_data['chat'], event_type='spam')
     
-    # Initialize user in spam_tracker if not present
-    if user_id not in spam_tracker:
-        spam_tracker[user_id] = {'photos': [], 'block_until': 0, 'notified': False}
-    
-    # Check if user is blocked
-    if current_time < spam_tracker[user_id]['block_until']:
-        if media_type in ['photo', 'video', 'document', 'voice', 'audio']:
-            print(f"🚫 Ignored media ({media_type}) from @{username} ({user_info}) due to spam block")
-            return True  # Skip media
-        return False  # Allow non-media messages
-    
-    # Only track photos for spam detection
-    if media_type == 'photo':
-        # Clean up old photo entries
-        spam_tracker[user_id]['photos'] = [
-            (t, c) for t, c in spam_tracker[user_id]['photos'] if current_time - t < SPAM_WINDOW
-        ]
-        
-        # Add new photo
-        spam_tracker[user_id]['photos'].append((current_time, 1))
-        
-        # Count total photos in the window
-        photo_count = sum(count for _, count in spam_tracker[user_id]['photos'])
-        
-        if photo_count > SPAM_THRESHOLD:
-            # Set block duration
-            spam_tracker[user_id]['block_until'] = current_time + SPAM_BLOCK_DURATION
-            
-            # Send alert only if not notified yet
-            if not spam_tracker[user_id]['notified']:
-                print(f"⚠️ Spam detected from @{username} ({user_info}): {photo_count} photos, blocking media for 1 hour")
-                alert_item = {
-                    'username': username,
-                    'date': msg_data['date'],
-                    'photo_count': photo_count
-                }
-                send_alert([alert_item], msg_data['business_connection_id'], msg_data['chat'], event_type='spam')
-                spam_tracker[user_id]['notified'] = True
-            
-            save_spam_tracker()  # Save updated tracker
-            return True  # Skip media
-    
-    save_spam_tracker()  # Save updated tracker
-    return False
+    return verdict.skip
 
-# Mark message as edited and update text and media
-def mark_edited(business_id, chat_id, message_id, new_msg_data):
-    conn = sqlite3.connect('messages.db')
-    c = conn.cursor()
-    
-    c.execute('''SELECT text, media_type, media_path FROM messages 
-                 WHERE message_id = ? AND chat_id = ? AND business_id = ?''',
-              (message_id, chat_id, business_id))
-    result = c.fetchone()
-    
+# Mark message as edited, update text and media and append the edit to its
+# history. previous is the stored message before the edit.
+def mark_edited(business_id, chat_id, message_id, new_msg_data, previous):
     new_text = new_msg_data.get('text', '')
     new_media_type = None
     new_media_path = None
+    new_media_file = None
     
     if 'photo' in new_msg_data:
         new_media_type = 'photo'
-        file_id = new_msg_data['photo'][-1]['file_id']
-        new_media_path = download_media(file_id, 'photo')
+        new_media_file = new_msg_data['photo'][-1]
     elif 'video' in new_msg_data:
         new_media_type = 'video'
-        new_media_path = download_media(new_msg_data['video']['file_id'], 'video')
+        new_media_file = new_msg_data['video']
     elif 'document' in new_msg_data:
         new_media_type = 'document'
-        new_media_path = download_media(new_msg_data['document']['file_id'], 'document')
+        new_media_file = new_msg_data['document']
     elif 'voice' in new_msg_data:
         new_media_type = 'voice'
-        new_media_path = download_media(new_msg_data['voice']['file_id'], 'voice')
+        new_media_file = new_msg_data['voice']
     elif 'audio' in new_msg_data:
         new_media_type = 'audio'
-        new_media_path = download_media(new_msg_data['audio']['file_id'], 'audio')
-    
-    if result:
-        current_text, current_media_type, current_media_path = result
-        c.execute('''UPDATE messages 
-                     SET is_edited = 1, 
-                         text = ?, 
-                         original_text = COALESCE(original_text, ?),
-                         media_type = ?,
-                         media_path = ?,
-                         original_media_type = COALESCE(original_media_type, ?),
-                         original_media_path = COALESCE(original_media_path, ?)
-                     WHERE message_id = ? AND chat_id = ? AND business_id = ?''',
-                  (new_text, current_text, new_media_type, new_media_path, 
-                   current_media_type, current_media_path, message_id, chat_id, business_id))
-    else:
-        c.execute('''UPDATE messages 
-                     SET is_edited = 1, text = ?, media_type = ?, media_path = ?
-                     WHERE message_id = ? AND chat_id = ? AND business_id = ?''',
-                  (new_text, new_media_type, new_media_path, message_id, chat_id, business_id))
+        new_media_file = new_msg_data['audio']
     
-    conn.commit()
-    conn.close()
-
-# Clean up old messages and media
-def cleanup_old_data():
-    conn = sqlite3.connect('messages.db')
-    c = conn.cursor()
+    new_media_file_id = None
+    if new_media_file:
+        new_media_path = media.new_local_path(new_media_type, new_media_file)
+        new_media_file_id = new_media_file['file_id']
     
-    cutoff_time = int((datetime.now() - timedelta(days=CLEANUP_DAYS)).timestamp())
+    # Media not downloaded yet (MEDIA_LAZY_MIN_SIZE) is needed for the alert now
+    if previous['media_status'] == 'lazy' and previous['media_path'] != new_media_path:
+        media.fetch_now(previous['media_file_id'], previous['media_path'], previous['media_type'])
     
-    c.execute('''SELECT media_path, original_media_path FROM messages 
-                 WHERE date < ? AND (media_path IS NOT NULL OR original_media_path IS NOT NULL)''',
-              (cutoff_time,))
-    media_files = c.fetchall()
+    storage.mark_edited(business_id, chat_id, message_id, new_text, new_media_type, new_media_path,
+                        new_media_file_id)
+    history.record_edit(previous, new_text, new_media_type, new_media_path, new_msg_data.get('edit_date'))
     
-    deleted_files = set()
-    for media_path, original_media_path in media_files:
-        for path in [media_path, original_media_path]:
-            if path and path not in deleted_files and os.path.exists(path):
-                try:
-                    os.remove(path)
-                    deleted_files.add(path)
-                    print(f"Deleted media file: {path}")
-                except Exception as e:
-                    print(f"Error deleting media {path}: {e}")
-    
-    c.execute('''DELETE FROM messages WHERE date < ?''', (cutoff_time,))
-    deleted_rows = c.rowcount
-    conn.commit()
-    conn.close()
+    # Download in the background once the row points at the new file
+    if new_media_path:
+        media.enqueue(new_media_file_id, new_media_path, new_media_type, new_media_file.get('file_size'))
     
-    print(f"Cleared {deleted_rows} old messages and {len(deleted_files)} media files.")
+    return new_text, new_media_type, new_media_path
+
+# Clean up old messages and media (batched, resumable, see retention.py)
+def cleanup_old_data():
+    retention.run()
 
 # Save message to DB
 def save_message(msg_data, business_id=None):
-    if business_id != ALLOWED_BUSINESS_ID:
+    tenant = tenants.get(business_id)
+    if tenant is None:
         return
     
     username = msg_data['from'].get('username')
-    if username and username.lower() == SENDER_USERNAME:
+    if tenant.is_owner(msg_data['from']):
         return
     
     user_id = msg_data['from']['id']
@@ -246,6 +124,7 @@ def save_message(msg_data, business_id=None):
     
     media_type = None
     media_path = None
+    media_file = None
     text = msg_data.get('text', '')
     
     # Check for spam or block before processing media
@@ -253,33 +132,36 @@ def save_message(msg_data, business_id=None):
         media_type = 'photo'
         if check_spam(user_id, username, first_name, last_name, media_type, msg_data):
             return
-        file_id = msg_data['photo'][-1]['file_id']
-        media_path = download_media(file_id, 'photo')
+        media_file = msg_data['photo'][-1]
     elif 'video' in msg_data:
         media_type = 'video'
         if check_spam(user_id, username, first_name, last_name, media_type, msg_data):
             return
-        media_path = download_media(msg_data['video']['file_id'], 'video')
+        media_file = msg_data['video']
     elif 'document' in msg_data:
         media_type = 'document'
         if check_spam(user_id, username, first_name, last_name, media_type, msg_data):
             return
-        media_path = download_media(msg_data['document']['file_id'], 'document')
+        media_file = msg_data['document']
     elif 'voice' in msg_data:
         media_type = 'voice'
         if check_spam(user_id, username, first_name, last_name, media_type, msg_data):
             return
-        media_path = download_media(msg_data['voice']['file_id'], 'voice')
+        media_file = msg_data['voice']
     elif 'audio' in msg_data:
         media_type = 'audio'
         if check_spam(user_id, username, first_name, last_name, media_type, msg_data):
             return
-        media_path = download_media(msg_data['audio']['file_id'], 'audio')
+        media_file = msg_data['audio']
     
-    print(f"📩 Saved message + media from @{username} ({user_info})")
+    media_file_id = None
+    media_status = None
+    if media_file:
+        media_path = media.new_local_path(media_type, media_file)
+        media_file_id = media_file['file_id']
+        media_status = media.initial_status(media_file, media_path)
     
-    conn = sqlite3.connect('messages.db')
-    c = conn.cursor()
+    print(f"📩 Saved message + media from @{username} ({user_info})")
     
     forward_from = None
     forward_from_chat = None
@@ -290,265 +172,263 @@ def save_message(msg_data, business_id=None):
         forward_from_chat = msg_data['forward_from_chat'].get('id')
         forward_from_message_id = msg_data.get('forward_from_message_id')
     
-    c.execute('''INSERT INTO messages 
-                 (message_id, chat_id, user_id, username, text, original_text, date, business_id, 
-                  media_type, media_path, original_media_type, original_media_path,
-                  forward_from, forward_from_chat, forward_from_message_id)
-                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-              (msg_data['message_id'],
-               msg_data['chat']['id'],
-               user_id,
-               username,
-               text,
-               text,
-               msg_data['date'],
-               business_id,
-               media_type,
-               media_path,
-               media_type,
-               media_path,
-               forward_from,
-               forward_from_chat,
-               forward_from_message_id))
-    conn.commit()
-    conn.close()
+    storage.insert_message(msg_data['message_id'],
+                           msg_data['chat']['id'],
+                           user_id,
+                           username,
+                           text,
+                           msg_data['date'],
+                           business_id,
+                           media_type,
+                           media_path,
+                           forward_from,
+                           forward_from_chat,
+                           forward_from_message_id,
+                           media_file_id,
+                           media_status)
+    
+    # Download in the background; the row stays 'pending' until it finishes
+    if media_status == 'pending':
+        media.enqueue(media_file_id, media_path, media_type, media_file.get('file_size'))
 
 # Handle edited messages
 def handle_edited(business_id, chat_id, message_id, new_msg_data):
-    if business_id != ALLOWED_BUSINESS_ID:
+    if tenants.get(business_id) is None:
         return None
     
-    mark_edited(business_id, chat_id, message_id, new_msg_data)
-    
-    conn = sqlite3.connect('messages.db')
-    c = conn.cursor()
-    
-    c.execute('''SELECT original_text, text, username, media_type, media_path, 
-                        original_media_type, original_media_path, date 
-                 FROM messages 
-                 WHERE message_id = ? AND chat_id = ? AND business_id = ?''',
-              (message_id, chat_id, business_id))
-    result = c.fetchone()
-    
-    edited_info = None
-    if result:
-        original_text, current_text, username, media_type, media_path, \
-        original_media_type, original_media_path, date = result
-        edited_info = {
-            'original_text': original_text or '',
-            'text': current_text or '',
-            'username': username,
-            'media_type': media_type,
-            'media_path': media_path,
-            'original_media_type': original_media_type,
-            'original_media_path': original_media_path,
-            'date': date
-        }
+    # One read before the edit serves the history, the alert and the first-version columns
+    result = storage.get_message(business_id, chat_id, message_id)
+    if result is None:
+        return None
+    
+    # An update fetched again after a restart must not record the same edit twice
+    edit_date = new_msg_data.get('edit_date')
+    last_edited_at = result['last_edited_at']
+    if edit_date is not None and last_edited_at is not None and (
+            edit_date < last_edited_at
+            or edit_date == last_edited_at and new_msg_data.get('text', '') == (result['text'] or '')):
+        return None
+    
+    text, media_type, media_path = mark_edited(business_id, chat_id, message_id, new_msg_data, result)
+    
+    original_media_type = result['original_media_type']
+    original_media_path = result['original_media_path']
+    if original_media_path is None:
+        original_media_type, original_media_path = result['media_type'], result['media_path']
+    
+    edited_info = {
+        'original_text': (result['original_text'] if result['original_text'] is not None
+                          else result['text']) or '',
+        'text': text or '',
+        'username': result['username'],
+        'media_type': media_type,
+        'media_path': media_path,
+        'original_media_type': original_media_type,
+        'original_media_path': original_media_path,
+        'date': result['date']
+    }
     
-    conn.close()
     return edited_info
 
 # Handle deleted messages
 def handle_deleted(business_id, chat_id, message_ids):
-    if business_id != ALLOWED_BUSINESS_ID:
+    if tenants.get(business_id) is None:
         return []
     
-    conn = sqlite3.connect('messages.db')
-    c = conn.cursor()
-    
     deleted_info = []
+    found_ids = []
     
+    # Recent messages come from the cache, the rest from one query for the whole update
+    found = storage.get_messages(business_id, chat_id, message_ids)
     for msg_id in message_ids:
-        c.execute('''SELECT text, username, media_type, media_path, date FROM messages 
-                     WHERE message_id = ? AND chat_id = ? AND business_id = ?''',
-                  (msg_id, chat_id, business_id))
-        result = c.fetchone()
+        result = found.get(msg_id)
         
-        if result:
-            text, username, media_type, media_path, date = result
-            mark_deleted(business_id, chat_id, [msg_id])
-            
+        if result and not result['is_deleted']:
+            found_ids.append(msg_id)
+            if result['media_status'] == 'lazy':
+                media.fetch_now(result['media_file_id'], result['media_path'], result['media_type'])
             deleted_info.append({
-                'text': text,
-                'username': username,
-                'media_type': media_type,
-                'media_path': media_path,
-                'date': date
+                'text': result['text'],
+                'username': result['username'],
+                'media_type': result['media_type'],
+                'media_path': result['media_path'],
+                'date': result['date']
             })
     
-    conn.close()
+    if found_ids:
+        mark_deleted(business_id, chat_id, found_ids)
+    
     return deleted_info
 
 # Mark message as deleted in DB
 def mark_deleted(business_id, chat_id, message_ids):
-    conn = sqlite3.connect('messages.db')
-    c = conn.cursor()
-    
-    for msg_id in message_ids:
-        c.execute('''UPDATE messages 
-                     SET is_deleted = 1 
-                     WHERE message_id = ? 
-                     AND chat_id = ? 
-                     AND business_id = ?''',
-                  (msg_id, chat_id, business_id))
-    
-    conn.commit()
-    conn.close()
+    storage.mark_deleted(business_id, chat_id, message_ids)
+
+# Alert text for one edited, deleted or spam item
+def format_alert(item, event_type):
+    if event_type == 'edited':
+        alert = f"✏️ Message edited in business chat!\n\n"
+        alert += f"From: @{item['username']}\n"
+        alert += f"Date: {datetime.fromtimestamp(item['date'])}\n"
+        if item['original_text']:
+            alert += f"Old text: {item['original_text'][:300]}\n"
+        if item['text']:
+            alert += f"New text: {item['text'][:300]}\n"
+        if item['original_media_type']:
+            alert += f"Old media: {item['original_media_type']}\n"
+        if item['media_type']:
+            alert += f"New media: {item['media_type']}\n"
+    elif event_type == 'spam':
+        alert = f"🚨 Spam detected in business chat!\n\n"
+        alert += f"From: @{item['username']}\n"
+        alert += f"Date: {datetime.fromtimestamp(item['date'])}\n"
+        alert += f"Sent {item['photo_count']} photos in the last minute\n"
+        alert += f"Media from this user will be ignored for 1 hour"
+    else:
+        alert = f"🚨 Message deleted in business chat!\n\n"
+        alert += f"From: @{item['username']}\n"
+        alert += f"Date: {datetime.fromtimestamp(item['date'])}\n"
+        if item['text']:
+            alert += f"Text: {item['text'][:300]}\n"
+        if item['media_type']:
+            alert += f"Media: {item['media_type']}\n"
+    return alert
+
+# One message listing a bulk deletion (cut to Telegram's 4096 character limit)
+def format_deletion_summary(items):
+    alert = f"🚨 {len(items)} messages deleted in business chat!\n"
+    for shown, item in enumerate(items):
+        line = f"\n@{item['username']}, {datetime.fromtimestamp(item['date'])}: "
+        line += (item['text'] or '')[:100]
+        if item['media_type']:
+            line += f" [{item['media_type']}]"
+        more = f"\n\n...and {len(items) - shown} more"
+        if len(alert) + len(line) + len(more) > 4096:
+            return alert + more
+        alert += line
+    return alert
 
-# Send alert to admin
+# Queue alerts for the admin of the business connection (sent by alerts.py)
 def send_alert(items, business_id, chat_info, event_type='deleted'):
+    with metrics.timer('bot_alert_enqueue_seconds', event_type=event_type):
+        queue_alerts(items, business_id, event_type)
+
+def queue_alerts(items, business_id, event_type):
+    tenant = tenants.get(business_id)
+    if tenant is None or not tenant.alerts_enabled(event_type):
+        return
+    alert_chat_id = tenant.alert_chat_id()
+    
+    # A bulk deletion becomes one summary plus albums of the deleted media
+    if event_type == 'deleted' and len(items) > ALERT_COALESCE_THRESHOLD:
+        alerts.enqueue(alert_chat_id, 'message', {'text': format_deletion_summary(items)})
+        paths = list(dict.fromkeys(item['media_path'] for item in items if item['media_path']))
+        alerts.enqueue_album(alert_chat_id, paths, f"Media of deleted messages ({len(paths)} files)")
+        return
+    
     for item in items:
-        if event_type == 'edited':
-            alert = f"✏️ Message edited in business chat!\n\n"
-            alert += f"From: @{item['username']}\n"
-            alert += f"Date: {datetime.fromtimestamp(item['date'])}\n"
-            if item['original_text']:
-                alert += f"Old text: {item['original_text'][:300]}\n"
-            if item['text']:
-                alert += f"New text: {item['text'][:300]}\n"
-            if item['original_media_type']:
-                alert += f"Old media: {item['original_media_type']}\n"
-            if item['media_type']:
-                alert += f"New media: {item['media_type']}\n"
-        elif event_type == 'spam':
-            alert = f"🚨 Spam detected in business chat!\n\n"
-            alert += f"From: @{item['username']}\n"
-            alert += f"Date: {datetime.fromtimestamp(item['date'])}\n"
-            alert += f"Sent {item['photo_count']} photos in the last minute\n"
-            alert += f"Media from this user will be ignored for 1 hour"
-        else:
-            alert = f"🚨 Message deleted in business chat!\n\n"
-            alert += f"From: @{item['username']}\n"
-            alert += f"Date: {datetime.fromtimestamp(item['date'])}\n"
-            if item['text']:
-                alert += f"Text: {item['text'][:300]}\n"
-            if item['media_type']:
-                alert += f"Media: {item['media_type']}\n"
+        alert = format_alert(item, event_type)
         
-        if event_type == 'edited' and item['original_media_path'] and os.path.exists(item['original_media_path']):
-            with open(item['original_media_path'], 'rb') as f:
-                files = {'document': f}
-                data = {
-                    'chat_id': ADMIN_ID,
-                    'caption': f"{alert}Old media:"[:1024]
-                }
-                requests.post(f'{BASE_URL}/sendDocument', data=data, files=files)
+        # Unchanged media is sent once, as the new media
+        if (event_type == 'edited' and item['original_media_path']
+                and item['original_media_path'] != item['media_path']):
+            alerts.enqueue(alert_chat_id, 'document', {'path': item['original_media_path'],
+                                                       'caption': f"{alert}Old media:"})
         
-        if event_type != 'spam' and item['media_path'] and os.path.exists(item['media_path']):
-            with open(item['media_path'], 'rb') as f:
-                files = {'document': f}
-                data = {
-                    'chat_id': ADMIN_ID,
-                    'caption': f"{alert}New media:"[:1024] if event_type == 'edited' else alert[:1024]
-                }
-                requests.post(f'{BASE_URL}/sendDocument', data=data, files=files)
-            return
+        if event_type != 'spam' and item['media_path']:
+            caption = f"{alert}New media:" if event_type == 'edited' else alert
+            alerts.enqueue(alert_chat_id, 'document', {'path': item['media_path'], 'caption': caption})
+            continue
         
-        requests.post(f'{BASE_URL}/sendMessage', json={
-            'chat_id': ADMIN_ID,
-            'text': alert
-        })
+        alerts.enqueue(alert_chat_id, 'message', {'text': alert})
+
 def get_project_size():
-    """Calculate and return the total size of the project directory in human-readable format"""
-    total_size = 0
-    for dirpath, dirnames, filenames in os.walk('.'):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            # Skip if it's symbolic link or doesn't exist
-            if not os.path.islink(fp) and os.path.exists(fp):
-                total_size += os.path.getsize(fp)
-    
-    # Convert size to human-readable format
-    def sizeof_fmt(num, suffix='B'):
-        for unit in ['', 'K', 'M', 'G', 'T', 'P', 'E', 'Z']:
-            if abs(num) < 1024.0:
-                return f"{num:.1f}{unit}{suffix}"
-            num /= 1024.0
-        return f"{num:.1f}Y{suffix}"
-    
-    return sizeof_fmt(total_size)
+    """Return the total size of the project directory in human-readable format (from the usage ledger)"""
+    return usage.sizeof_fmt(usage.project_size_bytes())
 
-# Handle commands
+# Handle commands. The bot operator (ADMIN_ID) sees every connection, other
+# account owners only their own.
 def handle_command(update):
     if 'message' in update and 'text' in update['message']:
         msg = update['message']
-        if msg['from']['id'] != ADMIN_ID:
+        user_id = msg['from']['id']
+        is_operator = user_id == ADMIN_ID
+        owned = tenants.owned_by(user_id)
+        if not is_operator and not owned:
             return
         
         command = msg['text'].split()[0]  # Get the first word (command)
+        args = msg['text'][len(command):].strip()
+        business_ids = None if is_operator else [t.business_id for t in owned]
         
         if command == '/stats':
-            conn = sqlite3.connect('messages.db')
-            c = conn.cursor()
-            
-            c.execute('SELECT COUNT(*) FROM messages')
-            total_msgs = c.fetchone()[0]
-            c.execute('SELECT COUNT(*) FROM messages WHERE is_deleted = 1')
-            deleted_msgs = c.fetchone()[0]
-            c.execute('SELECT COUNT(*) FROM messages WHERE is_edited = 1')
-            edited_msgs = c.fetchone()[0]
-            c.execute('SELECT COUNT(*) FROM messages WHERE media_type IS NOT NULL')
-            media_msgs = c.fetchone()[0]
-            
-            stats = (
-                f"📊 Statistics:\n"
-                f"Total messages: {total_msgs}\n"
-                f"Deleted: {deleted_msgs}\n"
-                f"Edited: {edited_msgs}\n"
-                f"With media: {media_msgs}"
-            )
-            
-            requests.post(f'{BASE_URL}/sendMessage', json={
-                'chat_id': ADMIN_ID,
-                'text': stats
+            telegram_api.call('sendMessage', json={
+                'chat_id': msg['chat']['id'],
+                'text': stats.report(args, business_ids)
+            })
+        
+        elif command == '/size' and is_operator:
+            telegram_api.call('sendMessage', json={
+                'chat_id': msg['chat']['id'],
+                'text': usage.usage_report()
+            })
+        
+        elif command == '/history':
+            telegram_api.call('sendMessage', json={
+                'chat_id': msg['chat']['id'],
+                'text': history.handle(args, business_ids or tenants.all_ids()),
+                'parse_mode': 'HTML'
+            })
+        
+        elif command == '/search':
+            telegram_api.call('sendMessage', json={
+                'chat_id': msg['chat']['id'],
+                'text': search.handle(args, business_ids),
+                'parse_mode': 'HTML'
             })
-            
-            conn.close()
         
-        elif command == '/size':
-            size = get_project_size()
-            requests.post(f'{BASE_URL}/sendMessage', json={
-                'chat_id': ADMIN_ID,
-                'text': f"📁 Project directory size: {size}"
+        elif command == '/health' and is_operator:
+            telegram_api.call('sendMessage', json={
+                'chat_id': msg['chat']['id'],
+                'text': metrics.health_report()
             })
+        
+        elif command == '/profile' and is_operator:
+            if args == 'start':
+                report, path = metrics.start_profiler(), None
+            elif args == 'stop':
+                report, path = metrics.stop_profiler()
+            else:
+                report, path = "Usage: /profile start|stop", None
+            telegram_api.call('sendMessage', json={
+                'chat_id': msg['chat']['id'],
+                'text': report
+            })
+            if path:
+                with open(path, 'rb') as f:
+                    telegram_api.call('sendDocument', data={'chat_id': msg['chat']['id']},
+                                      files={'document': f})
 
-# Backup database
+# Backup database (full snapshot or incremental delta, see backup.py)
 def backup_db():
-    backup_path = f"messages_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
     try:
-        # Create backup
-        with open('messages.db', 'rb') as src, open(backup_path, 'wb') as dst:
-            dst.write(src.read())
-        
-        # Get directory size
         dir_size = get_project_size()
-        caption = f"Daily database backup\n\nProject directory size: {dir_size}"
-        
-        # Send backup
-        with open(backup_path, 'rb') as f:
-            files = {'document': (backup_path, f)}
-            data = {'chat_id': ADMIN_ID, 'caption': caption}
-            requests.post(f'{BASE_URL}/sendDocument', data=data, files=files)
-        
-        os.remove(backup_path)
-        print(f"Backup sent: {backup_path} | Directory size: {dir_size}")
+        backup.run_backup(f"Project directory size: {dir_size}")
     except Exception as e:
         print(f"Backup error: {e}")
 
-# Create a session with retry logic
-def create_session():
-    session = requests.Session()
-    retries = Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
-    session.mount('https://', HTTPAdapter(max_retries=retries))
-    return session
-
 # Main processing loop
 def process_update(update):
+    metrics.inc('bot_updates_total', type=next((key for key in update if key != 'update_id'), 'unknown'))
+    metrics.gauge('bot_last_update_timestamp_seconds', time.time())
     handle_command(update)
-    if 'business_message' in update:
+    if 'business_connection' in update:
+        tenants.register(update['business_connection'])
+    
+    elif 'business_message' in update:
         msg = update['business_message']
         business_id = msg['business_connection_id']
-        if business_id != ALLOWED_BUSINESS_ID:
+        if tenants.get(business_id) is None:
             return
             
         save_message(msg, business_id)
@@ -556,7 +436,7 @@ def process_update(update):
     elif 'edited_business_message' in update:
         edited = update['edited_business_message']
         business_id = edited['business_connection_id']
-        if business_id != ALLOWED_BUSINESS_ID:
+        if tenants.get(business_id) is None:
             return
             
         edited_item = handle_edited(
@@ -577,7 +457,7 @@ def process_update(update):
     elif 'deleted_business_messages' in update:
         deleted = update['deleted_business_messages']
         business_id = deleted['business_connection_id']
-        if business_id != ALLOWED_BUSINESS_ID:
+        if tenants.get(business_id) is None:
             return
             
         deleted_items = handle_deleted(
@@ -595,44 +475,108 @@ def process_update(update):
                 print(f"⚠️ Recorded deletion of {len(deleted_items)} messages from @{username} ({user_info})")
             send_alert(deleted_items, business_id, deleted['chat'])
 
-def main():
+def main(runtime_mode=RUNTIME_MODE):
     init_db()
-    load_spam_tracker()  # Load spam tracker at startup
+    tenants.load()  # Business connections served by this process
+    metrics.start()
+    media.start()
+    media.resume_pending()  # Finish downloads interrupted by the last shutdown
+    alerts.start()  # Also sends alerts left unsent by the last run
+    spam.import_legacy_file()  # Before the worker processes load their share
+    if runtime_mode != 'processes':
+        spam.load()  # Load spam tracker at startup (each worker process loads its own)
+        schedule.every(SPAM_SAVE_INTERVAL).seconds.do(spam.save)
     print("🛡️ Archive bot started. Tracking messages, media, edits, and deletions...")
     
     schedule.every().day.at("00:00").do(backup_db)
     schedule.every().day.at("00:03").do(cleanup_old_data)
+    schedule.every().day.at("00:06").do(usage.reconcile)
+    if MEDIA_TIERING:
+        schedule.every().hour.do(tiers.run_in_background)
+    
+    # Databases created before the usage ledger need one full scan to fill it
+    if storage.get_meta('usage_reconciled_at') is None:
+        usage.reconcile_in_background()
+    shards.migrate_in_background()  # Archives from before the sharded media layout
+    
+    if runtime_mode == 'webhook':
+        webhook.run(process_update)
+        return
+    
+    # getUpdates is refused while a webhook is set (e.g. after running in webhook mode)
+    try:
+        telegram_api.call('deleteWebhook')
+    except Exception as e:
+        print(f"Error removing webhook: {e}")
+    
+    if runtime_mode == 'async':
+        async_runtime.run(process_update)
+        return
+    
+    if runtime_mode == 'processes':
+        process_runtime.run(process_update)
+        return
     
-    last_update_id = None
-    session = create_session()  # Create a session with retry logic
+    # Resume after the last update committed by the previous run
+    last_update_id = storage.load_offset()
+    if last_update_id is not None:
+        print(f"Resuming from update {last_update_id}")
     
     while True:
         try:
-            updates = session.get(f'{BASE_URL}/getUpdates', params={
+            updates = telegram_api.call('getUpdates', params={
                 'offset': last_update_id,
                 'timeout': 30
-            }, timeout=(10, 30)).json().get('result', [])
+            }, timeout=(HTTP_CONNECT_TIMEOUT, 30 + HTTP_READ_TIMEOUT)).get('result', [])
             
             for update in updates:
+                try:
+                    process_update(update)
+                except Exception as e:
+                    metrics.inc('bot_failures_total', where='update')
+                    print(f"Error processing update {update['update_id']}: {e}")
                 last_update_id = update['update_id'] + 1
-                process_update(update)
-                
+            
+            # Commit the whole batch in one transaction, with the offset that
+            # confirms it to Telegram on the next getUpdates call
+            if updates:
+                storage.commit_offset(last_update_id)
+            else:
+                storage.flush()
+            
             schedule.run_pending()
             
         except requests.exceptions.ConnectionError as e:
+            metrics.inc('bot_failures_total', where='polling')
             print(f"Connection error while fetching updates: {e}")
             time.sleep(5)  # Wait before retrying
         except requests.exceptions.Timeout as e:
+            metrics.inc('bot_failures_total', where='polling')
             print(f"Timeout error while fetching updates: {e}")
             time.sleep(5)  # Wait before retrying
         except requests.exceptions.RequestException as e:
+            metrics.inc('bot_failures_total', where='polling')
             print(f"Request error while fetching updates: {e}")
             time.sleep(5)  # Wait before retrying
         except Exception as e:
+            metrics.inc('bot_failures_total', where='polling')
             print(f"Unexpected error: {e}")
             time.sleep(5)  # Wait before retrying
         finally:
             time.sleep(1)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    # systemd stops the service with SIGTERM; exit through the cleanup below
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    parser = argparse.ArgumentParser(description="Telegram business chat archive bot")
+    parser.add_argument('--mode', choices=['sync', 'async', 'webhook', 'processes'], default=RUNTIME_MODE,
+                        help="polling loop to run (default: RUNTIME_MODE from config.py)")
+    args = parser.parse_args()
+    try:
+        main(args.mode)
+    except KeyboardInterrupt:
+        print("\n🛑 Archive bot stopped by user")
+    finally:
+        alerts.stop()
+        spam.save()
+        storage.close()
\ No newline at end of file
@@ -0,0 +1,148 @@
+# Asyncio runtime
+# Alternative to the blocking polling loop in as.py: long polling, update
+# processing, scheduled jobs and write flushes run concurrently on one event
+# loop. Handlers stay synchronous and run in a thread pool (the executor-backed
+# DB layer); updates of the same chat are processed in arrival order.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import schedule
+from settings import *
+import storage
+import telegram_api
+import metrics
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# Update types that carry a chat, used to keep per-chat ordering
+_CHAT_UPDATE_TYPES = ('business_message', 'edited_business_message',
+                      'deleted_business_messages', 'message', 'edited_message')
+
+# Chat an update belongs to (None for updates without one)
+def update_chat_id(update):
+    for key in _CHAT_UPDATE_TYPES:
+        if key in update:
+            return update[key].get('chat', {}).get('id')
+    return None
+
+# Runs updates in a thread pool: concurrent across chats, ordered within a chat
+class ChatDispatcher:
+    def __init__(self, handler, workers=ASYNC_WORKERS, max_pending=ASYNC_MAX_PENDING):
+        self.handler = handler
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='update')
+        self.slots = asyncio.Semaphore(max_pending)
+        self.tails = {}  # chat_id -> last scheduled task of that chat
+
+    # Schedule an update; waits while max_pending updates are already in flight
+    async def submit(self, update):
+        await self.slots.acquire()
+        chat_id = update_chat_id(update)
+        previous = self.tails.get(chat_id)
+        task = asyncio.ensure_future(self._run(previous, update))
+        self.tails[chat_id] = task
+        task.add_done_callback(lambda t: self._done(chat_id, t))
+
+    async def _run(self, previous, update):
+        if previous is not None:
+            await asyncio.wait([previous])
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.executor, self.handler, update)
+        except Exception as e:
+            metrics.inc('bot_failures_total', where='update')
+            print(f"Error processing update {update.get('update_id')}: {e}")
+
+    def _done(self, chat_id, task):
+        if self.tails.get(chat_id) is task:
+            del self.tails[chat_id]
+        self.slots.release()
+
+    # Wait for every scheduled update to finish
+    async def drain(self):
+        while self.tails:
+            await asyncio.wait(list(self.tails.values()))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+# Fetch one batch of updates with aiohttp, or the shared requests client in a thread
+async def _get_updates(http, offset):
+    params = {'timeout': 30}
+    if offset is not None:
+        params['offset'] = offset
+    if http is None:
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(None, lambda: telegram_api.call(
+            'getUpdates', params=params, timeout=(HTTP_CONNECT_TIMEOUT, 30 + HTTP_READ_TIMEOUT)))
+    else:
+        with metrics.timer('bot_telegram_request_seconds', method='getUpdates'):
+            async with http.get(f'{BASE_URL}/getUpdates', params=params) as response:
+                result = await response.json()
+    return result.get('result', [])
+
+# Each batch is processed and committed before the next getUpdates call
+# confirms it, so a crash never loses an update Telegram considers delivered
+async def _poll(http, dispatcher):
+    loop = asyncio.get_running_loop()
+    offset = await loop.run_in_executor(None, storage.load_offset)
+    while True:
+        try:
+            updates = await _get_updates(http, offset)
+            for update in updates:
+                await dispatcher.submit(update)
+            if updates:
+                await dispatcher.drain()
+                offset = updates[-1]['update_id'] + 1
+                await loop.run_in_executor(None, storage.commit_offset, offset)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            metrics.inc('bot_failures_total', where='polling')
+            print(f"Error while fetching updates: {e}")
+            await asyncio.sleep(5)  # Wait before retrying
+
+# Run due scheduled jobs (backup, cleanup) without blocking polling
+async def _run_schedule():
+    loop = asyncio.get_running_loop()
+    while True:
+        await loop.run_in_executor(None, schedule.run_pending)
+        await asyncio.sleep(1)
+
+# Commit queued writes at least every WRITE_FLUSH_INTERVAL seconds
+async def _flush_writes():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(WRITE_FLUSH_INTERVAL)
+        await loop.run_in_executor(None, storage.flush)
+
+# Jobs every event-loop runtime runs next to update ingestion
+def background_jobs():
+    return [_run_schedule(), _flush_writes()]
+
+async def _main(handler):
+    dispatcher = ChatDispatcher(handler)
+    http = None
+    if aiohttp is not None:
+        timeout = aiohttp.ClientTimeout(sock_connect=HTTP_CONNECT_TIMEOUT, total=30 + HTTP_READ_TIMEOUT)
+        http = aiohttp.ClientSession(timeout=timeout)
+    else:
+        print("aiohttp is not installed, polling through the requests client")
+
+    tasks = [asyncio.ensure_future(coro) for coro in [_poll(http, dispatcher), *background_jobs()]]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await dispatcher.drain()
+        dispatcher.shutdown()
+        if http is not None:
+            await http.close()
+
+# Run the bot on an asyncio event loop until interrupted
+def run(handler):
+    print("⚡ Running in asyncio mode")
+    asyncio.run(_main(handler))
@@ -0,0 +1,228 @@
+# Database backups
+# Full backups are consistent snapshots taken with VACUUM INTO on a separate
+# read connection, so the bot keeps writing while they run. Between full
+# backups only the rows inserted or changed since the previous backup are
+# exported. Archives are gzip-compressed while streaming to disk and split
+# into parts that fit the Bot API upload limit.
+#
+# Restore: python3 backup.py restore messages.db FULL.db.gz [DELTA.jsonl.gz ...]
+# (join split archives first: cat NAME.part* > NAME)
+
+import os
+import sys
+import json
+import gzip
+import shutil
+import sqlite3
+import time
+from datetime import datetime
+from settings import *
+import storage
+import telegram_api
+import retention
+
+_COPY_CHUNK = 1024 * 1024
+
+# Columns exported in delta backups, in table order
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+def _message_columns(conn):
+    return _columns(conn, 'messages')
+
+# Gzip src into dst without loading the file into memory
+def _compress(src_path, dst_path):
+    with open(src_path, 'rb') as src, gzip.open(dst_path, 'wb', compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst, _COPY_CHUNK)
+
+# Split a file into parts no larger than BACKUP_PART_SIZE; returns the paths to send
+def split_archive(path):
+    if os.path.getsize(path) <= BACKUP_PART_SIZE:
+        return [path]
+    parts = []
+    with open(path, 'rb') as src:
+        index = 1
+        while True:
+            part_path = f"{path}.part{index:03d}"
+            written = 0
+            with open(part_path, 'wb') as dst:
+                while written < BACKUP_PART_SIZE:
+                    chunk = src.read(min(_COPY_CHUNK, BACKUP_PART_SIZE - written))
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    written += len(chunk)
+            if written == 0:
+                os.remove(part_path)
+                break
+            parts.append(part_path)
+            index += 1
+    os.remove(path)
+    return parts
+
+# Consistent, compressed snapshot of the whole database
+def create_full_backup(stamp):
+    snapshot_path = f"messages_backup_{stamp}.db"
+    archive_path = f"{snapshot_path}.gz"
+    storage.flush()
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        conn.execute('VACUUM INTO ?', (snapshot_path,))
+    finally:
+        conn.close()
+    # Positions are read from the snapshot itself, so nothing falls between it and the next delta
+    conn = sqlite3.connect(snapshot_path)
+    try:
+        max_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM messages').fetchone()[0]
+        max_version_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM message_versions').fetchone()[0]
+    finally:
+        conn.close()
+    _compress(snapshot_path, archive_path)
+    os.remove(snapshot_path)
+    return archive_path, max_id, max_version_id
+
+# Rows inserted after since_id or changed at/after since_time, as compressed JSON lines,
+# followed by the edit history rows added after since_version_id (marked
+# "_table": "message_versions"). The first line is a header with the retention
+# cutoffs (see retention.py), so a restore can also drop rows the bot has
+# cleaned up since.
+def create_delta_backup(stamp, since_id, since_time, since_version_id):
+    archive_path = f"messages_delta_{stamp}.jsonl.gz"
+    conn = storage.open_reader()
+    try:
+        conn.execute('BEGIN')  # One snapshot for max_id and the exported rows
+        max_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM messages').fetchone()[0]
+        max_version_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM message_versions').fetchone()[0]
+        columns = _message_columns(conn)
+        version_columns = _columns(conn, 'message_versions')
+        policy = retention.RetentionPolicy()
+        rows = conn.execute(f'''SELECT {', '.join(columns)} FROM messages
+                                WHERE id > ? AND id <= ?
+                                UNION ALL
+                                SELECT {', '.join(columns)} FROM messages
+                                WHERE updated_at >= ? AND id <= ?''',
+                            (since_id, max_id, since_time, since_id))
+        count = 0
+        with gzip.open(archive_path, 'wt', encoding='utf-8', compresslevel=6) as out:
+            header = {'type': 'header', 'since_id': since_id, 'since_time': since_time,
+                      'max_id': max_id, 'delete_before': policy.message_cutoff(),
+                      'retention': policy.message_cutoffs()}
+            out.write(json.dumps(header) + '\n')
+            for row in rows:  # Streamed from the cursor
+                out.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n')
+                count += 1
+            versions = conn.execute(f'''SELECT {', '.join(version_columns)} FROM message_versions
+                                        WHERE id > ? AND id <= ?''', (since_version_id, max_version_id))
+            for row in versions:
+                out.write(json.dumps({'_table': 'message_versions', **dict(zip(version_columns, row))},
+                                     ensure_ascii=False) + '\n')
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+    return archive_path, max_id, max_version_id, count
+
+def _send_parts(paths, caption):
+    for index, path in enumerate(paths, 1):
+        part_caption = caption if len(paths) == 1 else f"{caption}\n\nPart {index}/{len(paths)}"
+        with open(path, 'rb') as f:
+            files = {'document': (os.path.basename(path), f)}
+            data = {'chat_id': ADMIN_ID, 'caption': part_caption[:1024]}
+            telegram_api.call('sendDocument', data=data, files=files,
+                              timeout=(HTTP_CONNECT_TIMEOUT, BACKUP_UPLOAD_TIMEOUT))
+        os.remove(path)
+
+# Take a full or incremental backup and send it to the admin
+def run_backup(extra_caption=''):
+    stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    started = int(time.time())
+    last_full = int(storage.get_meta('backup_last_full', 0))
+    last_id = int(storage.get_meta('backup_last_id', 0))
+    last_time = int(storage.get_meta('backup_last_time', 0))
+    last_version_id = storage.get_meta('backup_last_version_id')
+
+    # The first backup with edit history is a full one, so every delta that
+    # carries versions has a base snapshot with the message_versions table
+    full = (not last_full or started - last_full >= BACKUP_FULL_INTERVAL_DAYS * 86400
+            or last_version_id is None)
+    if full:
+        archive_path, max_id, max_version_id = create_full_backup(stamp)
+        caption = "Daily database backup (full)"
+    else:
+        archive_path, max_id, max_version_id, count = create_delta_backup(stamp, last_id, last_time,
+                                                                          int(last_version_id))
+        caption = (f"Daily database backup (incremental: {count} new or changed messages "
+                   f"since {datetime.fromtimestamp(last_time)})")
+
+    if extra_caption:
+        caption += f"\n\n{extra_caption}"
+    paths = split_archive(archive_path)
+    _send_parts(paths, caption)
+
+    if full:
+        storage.set_meta('backup_last_full', started)
+    storage.set_meta('backup_last_id', max_id)
+    storage.set_meta('backup_last_version_id', max_version_id)
+    storage.set_meta('backup_last_time', started)
+    print(f"Backup sent: {', '.join(os.path.basename(p) for p in paths)}")
+
+# Delete the rows the bot's retention cleanup had deleted when a delta was taken
+def _delete_expired(conn, header):
+    if 'retention' not in header:  # Deltas from before per-chat and per-connection retention
+        conn.execute('DELETE FROM messages WHERE date < ?', (header['delete_before'],))
+        return
+    policy = retention.RetentionPolicy.from_message_cutoffs(header['retention'])
+    rows = conn.execute('SELECT id, business_id, chat_id, date FROM messages WHERE date < ?',
+                        (policy.message_cutoff(),)).fetchall()
+    conn.executemany('DELETE FROM messages WHERE id = ?',
+                     [(row_id,) for row_id, business_id, chat_id, date in rows
+                      if policy.message_expired(business_id, chat_id, date)])
+
+# Rebuild a database from a full backup and the deltas taken after it (in order)
+def restore(target_path, full_archive, delta_archives):
+    if os.path.exists(target_path):
+        raise FileExistsError(f"{target_path} already exists")
+    with gzip.open(full_archive, 'rb') as src, open(target_path, 'wb') as dst:
+        shutil.copyfileobj(src, dst, _COPY_CHUNK)
+    conn = sqlite3.connect(target_path)
+    try:
+        has_versions = conn.execute("""SELECT 1 FROM sqlite_master
+                                       WHERE name = 'message_versions'""").fetchone() is not None
+        columns = {'messages': _message_columns(conn)}
+        if has_versions:
+            columns['message_versions'] = _columns(conn, 'message_versions')
+        for delta in delta_archives:
+            with conn, gzip.open(delta, 'rt', encoding='utf-8') as src:
+                header = json.loads(src.readline())
+                for line in src:
+                    row = json.loads(line)
+                    table = row.pop('_table', 'messages')
+                    names = [c for c in columns[table] if c in row]
+                    conn.execute(f'''INSERT OR REPLACE INTO {table} ({', '.join(names)})
+                                     VALUES ({', '.join('?' for _ in names)})''',
+                                 [row[c] for c in names])
+                _delete_expired(conn, header)
+            print(f"Applied {delta}")
+        with conn:
+            conn.execute('DELETE FROM media_blobs')
+            conn.execute(storage.REBUILD_MEDIA_REFS if has_versions else storage.REBUILD_MESSAGE_MEDIA_REFS)
+            # INSERT OR REPLACE does not run the delete triggers, so the counters are
+            # recounted and the search index is rebuilt from the restored rows
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'stats_totals'").fetchone():
+                conn.execute('DELETE FROM stats_totals')
+                conn.execute('DELETE FROM stats_events')
+                for statement in storage.REBUILD_STATS:
+                    conn.execute(statement)
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone():
+                conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+            # The rebuilt media_blobs rows have no sizes, so the usage ledger is
+            # reconciled again on the next start (see usage.py)
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'meta'").fetchone():
+                conn.execute("DELETE FROM meta WHERE key = 'usage_reconciled_at'")
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4 or sys.argv[1] != 'restore':
+        print("Usage: python3 backup.py restore TARGET.db FULL.db.gz [DELTA.jsonl.gz ...]")
+        sys.exit(1)
+    restore(sys.argv[2], sys.argv[3], sys.argv[4:])
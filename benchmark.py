@@ -0,0 +1,479 @@
+# Throughput benchmark
+# Replays a synthetic stream of business messages, edits and deletions through
+# the real bot (polling, handlers, write batching, media downloads, alerts)
+# against a local stub of the Bot API, and reports throughput, end-to-end
+# latency, database size and RSS as the run goes on.
+#
+#     python3 benchmark.py --rate 200 --duration 60 --media-ratio 0.2 --prefill 100000
+#
+# The bot runs in this process, in a scratch directory (--workdir) with its own
+# config.py, database and media folder, so an installed bot is never touched.
+# Bot output goes to bot.log in that directory.
+#
+# Latency is measured from the moment an update is offered to the bot (returned
+# by getUpdates, or POSTed in webhook mode) until the write batch holding its
+# changes is committed. Media downloads finish later and are reported separately.
+# Note that the sync loop pauses one second between getUpdates batches, so it
+# tops out at about 100 updates per second. In processes mode the handlers run
+# in worker processes, so an update counts as committed with the offset that
+# confirms its batch.
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import importlib
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+_TOKEN = 'benchmark'
+_BUSINESS_ID = 'benchmark'
+_ADMIN_ID = 1
+_MEDIA_KINDS = ('photo', 'document', 'video', 'voice')
+_FILE_BLOCK = os.urandom(64 * 1024)
+
+# Minimal Bot API: getUpdates serves the published updates, getFile and file
+# downloads serve generated files, every other method answers ok
+class StubBotApi:
+    def __init__(self, port=0, latency=0):
+        self.latency = latency
+        self.updates = []  # Published and not yet confirmed by a getUpdates offset
+        self.offered = {}  # update_id -> time first returned by getUpdates
+        self.cond = threading.Condition()
+        self.calls = {}
+        self.downloaded_bytes = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                stub._handle(self, b'')
+
+            def do_POST(self):
+                stub._handle(self, self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, name='stub-bot-api', daemon=True).start()
+
+    def publish(self, update):
+        with self.cond:
+            self.updates.append(update)
+            self.cond.notify_all()
+
+    def _count(self, method):
+        with self.cond:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+    def _reply(self, handler, result, status=200):
+        body = json.dumps({'ok': True, 'result': result}).encode()
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def _handle(self, handler, body):
+        url = urlsplit(handler.path)
+        if url.path.startswith('/file/'):
+            return self._send_file(handler, url.path.rsplit('/', 1)[1])
+        method = url.path.rsplit('/', 1)[1]
+        self._count(method)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if body and handler.headers.get('Content-Type', '').startswith('application/json'):
+            params.update(json.loads(body))
+        if self.latency and method != 'getUpdates':
+            time.sleep(self.latency)
+        if method == 'getUpdates':
+            return self._reply(handler, self._get_updates(params))
+        if method == 'getFile':
+            file_id = params.get('file_id', '')
+            return self._reply(handler, {'file_id': file_id, 'file_path': f'files/{file_id}',
+                                         'file_size': _file_size(file_id)})
+        return self._reply(handler, {'message_id': 1} if method.startswith('send') else True)
+
+    # Long poll: wait up to a second for updates after offset
+    def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        deadline = time.monotonic() + min(float(params.get('timeout') or 0), 1)
+        with self.cond:
+            self.updates = [u for u in self.updates if u['update_id'] >= offset]
+            while not self.updates and time.monotonic() < deadline:
+                self.cond.wait(deadline - time.monotonic())
+            batch = self.updates[:limit]
+            now = time.perf_counter()
+            for update in batch:
+                self.offered.setdefault(update['update_id'], now)
+        return batch
+
+    def _send_file(self, handler, file_id):
+        size = _file_size(file_id)
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/octet-stream')
+        handler.send_header('Content-Length', str(size))
+        handler.end_headers()
+        head = file_id.encode()[:size]  # Unique content, so files are not deduplicated
+        handler.wfile.write(head)
+        sent = len(head)
+        while sent < size:
+            chunk = _FILE_BLOCK[:size - sent]
+            handler.wfile.write(chunk)
+            sent += len(chunk)
+        with self.cond:
+            self.downloaded_bytes += size
+
+    def close(self):
+        self.server.shutdown()
+
+# File ids carry their size: KIND-N-SIZE
+def _file_size(file_id):
+    try:
+        return int(file_id.rsplit('-', 1)[1])
+    except (IndexError, ValueError):
+        return 1024
+
+# Synthetic update stream. Edits and deletions pick messages sent earlier in
+# the stream that are still alive.
+class StreamGenerator:
+    def __init__(self, chats=50, edit_ratio=0.2, delete_ratio=0.1, media_ratio=0.1,
+                 media_kb=200, text_length=120, seed=None):
+        self.random = random.Random(seed)
+        self.chats = [10_000 + i for i in range(chats)]
+        self.edit_ratio = edit_ratio
+        self.delete_ratio = delete_ratio
+        self.media_ratio = media_ratio
+        self.media_kb = media_kb
+        self.text_length = text_length
+        self.next_message_id = {chat_id: 1 for chat_id in self.chats}
+        self.alive = {chat_id: [] for chat_id in self.chats}
+        self.update_id = 0
+        self.files = 0
+        self.kinds = {'message': 0, 'edit': 0, 'delete': 0, 'media': 0}
+
+    def _text(self):
+        words = self.random.choices(('hello', 'order', 'price', 'tomorrow', 'photo', 'thanks',
+                                     'delivery', 'address', 'please', 'call', 'ok', 'when'), k=30)
+        return ' '.join(words)[:self.random.randint(1, self.text_length)]
+
+    def _media(self):
+        kind = self.random.choice(_MEDIA_KINDS)
+        self.files += 1
+        size = max(1, int(self.random.expovariate(1 / self.media_kb) * 1024))
+        media_file = {'file_id': f'{kind}-{self.files}-{size}', 'file_unique_id': f'u{self.files}',
+                      'file_size': size}
+        if kind == 'document':
+            media_file['file_name'] = f'file{self.files}.pdf'
+        return kind, [media_file] if kind == 'photo' else media_file
+
+    def _message(self, chat_id):
+        message_id = self.next_message_id[chat_id]
+        self.next_message_id[chat_id] += 1
+        message = {'business_connection_id': _BUSINESS_ID, 'message_id': message_id,
+                   'chat': {'id': chat_id, 'type': 'private'},
+                   'from': {'id': chat_id, 'first_name': 'User', 'username': f'user{chat_id}'},
+                   'date': int(time.time()), 'text': self._text()}
+        if self.random.random() < self.media_ratio:
+            kind, media_file = self._media()
+            message[kind] = media_file
+            message['caption'] = message.pop('text')
+            self.kinds['media'] += 1
+        self.alive[chat_id].append(message)
+        self.kinds['message'] += 1
+        return {'business_message': message}
+
+    def _edit(self, chat_id):
+        message = dict(self.random.choice(self.alive[chat_id]))
+        key = 'caption' if 'caption' in message else 'text'
+        message[key] = self._text()
+        message['edit_date'] = int(time.time())
+        self.kinds['edit'] += 1
+        return {'edited_business_message': message}
+
+    def _delete(self, chat_id):
+        alive = self.alive[chat_id]
+        message_ids = []
+        for _ in range(min(len(alive), self.random.randint(1, 3))):
+            i = self.random.randrange(len(alive))
+            alive[i], alive[-1] = alive[-1], alive[i]
+            message_ids.append(alive.pop()['message_id'])
+        self.kinds['delete'] += 1
+        return {'deleted_business_messages': {'business_connection_id': _BUSINESS_ID,
+                                              'chat': {'id': chat_id, 'type': 'private'},
+                                              'message_ids': message_ids}}
+
+    def next(self):
+        chat_id = self.random.choice(self.chats)
+        roll = self.random.random()
+        if self.alive[chat_id] and roll < self.delete_ratio:
+            update = self._delete(chat_id)
+        elif self.alive[chat_id] and roll < self.delete_ratio + self.edit_ratio:
+            update = self._edit(chat_id)
+        else:
+            update = self._message(chat_id)
+        self.update_id += 1
+        update['update_id'] = self.update_id
+        return update
+
+# Records when each update was processed and when its writes were committed
+class LatencyTracker:
+    def __init__(self, offered):
+        self.offered = offered  # update_id -> time offered to the bot
+        self.lock = threading.Lock()
+        self.processed = []
+        self.samples = []
+        self.committed = 0
+
+    def wrap_handler(self, handler):
+        def tracked(update):
+            try:
+                return handler(update)
+            finally:
+                with self.lock:
+                    self.processed.append(update.get('update_id'))
+        return tracked
+
+    # Updates processed before a flush starts are committed when it returns
+    def wrap_flush(self, flush):
+        def tracked():
+            with self.lock:
+                done, self.processed = self.processed, []
+            try:
+                return flush()
+            finally:
+                now = time.perf_counter()
+                with self.lock:
+                    for update_id in done:
+                        offered = self.offered.pop(update_id, None)
+                        if offered is not None:
+                            self.samples.append(now - offered)
+                    self.committed += len(done)
+        return tracked
+
+    # Every update before offset is committed once commit_offset returns
+    def wrap_commit_offset(self, commit_offset):
+        def tracked(offset):
+            try:
+                return commit_offset(offset)
+            finally:
+                now = time.perf_counter()
+                with self.lock:
+                    for update_id in [i for i in self.offered if i < offset]:
+                        self.samples.append(now - self.offered.pop(update_id))
+                        self.committed += 1
+        return tracked
+
+    # Latencies recorded since the last call
+    def take_samples(self):
+        with self.lock:
+            samples, self.samples = self.samples, []
+        return samples
+
+def _percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def _rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # Peak, where /proc is missing
+
+def _db_mb(db_path):
+    return sum(os.path.getsize(p) for p in (db_path, db_path + '-wal') if os.path.exists(p)) / 1024 / 1024
+
+def _write_config(workdir, stub_port, args):
+    lines = [
+        f"TOKEN = {_TOKEN!r}",
+        f"ADMIN_ID = {_ADMIN_ID}",
+        f"ALLOWED_BUSINESS_ID = {_BUSINESS_ID!r}",
+        "SENDER_USERNAME = 'owner'",
+        f"BASE_URL = 'http://127.0.0.1:{stub_port}/bot{_TOKEN}'",
+        "MEDIA_DIR = 'media_archive'",
+        "MAX_FILE_SIZE = 50 * 1024 * 1024",
+        "CLEANUP_DAYS = 5",
+        "SPAM_THRESHOLD = 10 ** 9",  # The synthetic senders are not spammers
+        "SPAM_WINDOW = 60",
+        "SPAM_BLOCK_DURATION = 3600",
+        f"RUNTIME_MODE = {args.mode!r}",
+        "WEBHOOK_SECRET = 'benchmark'",
+        f"WEBHOOK_PORT = {args.webhook_port}",
+    ]
+    lines += args.set
+    with open(os.path.join(workdir, 'config.py'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+# Fill the database with older messages, to measure how it behaves when large
+def _prefill(storage, count, seed):
+    rng = random.Random(seed)
+    now = int(time.time())
+    for i in range(count):
+        chat_id = 1_000_000 + i % 1000
+        storage.insert_message(i + 1, chat_id, chat_id, f'old{chat_id}', f'older message {i} {rng.random()}',
+                               now - rng.randint(0, 4 * 86400), _BUSINESS_ID, None, None, None, None, None)
+    storage.flush()
+
+# Offer updates at the target rate until the duration is over
+def _feed(stub, generator, args, webhook_url, stop):
+    session = None
+    if webhook_url:
+        import requests
+        session = requests.Session()
+    started = time.perf_counter()
+    sent = 0
+    while not stop.is_set():
+        elapsed = time.perf_counter() - started
+        if elapsed >= args.duration:
+            break
+        due = int(elapsed * args.rate) + 1 - sent
+        if due <= 0:
+            time.sleep(min(0.01, 1 / args.rate))
+            continue
+        for _ in range(due):
+            update = generator.next()
+            if session is None:
+                stub.publish(update)
+            else:
+                stub.offered[update['update_id']] = time.perf_counter()
+                response = session.post(webhook_url, json=update,
+                                        headers={'X-Telegram-Bot-Api-Secret-Token': 'benchmark'})
+                if response.status_code == 503:
+                    del stub.offered[update['update_id']]  # Refused as busy, not counted
+            sent += 1
+    return sent
+
+def _report_line(elapsed, interval, count, samples, db_path, files):
+    return (f"{elapsed:7.1f}s  {count / interval:8.1f} upd/s  "
+            f"p50 {_percentile(samples, 50) * 1000:7.1f} ms  p99 {_percentile(samples, 99) * 1000:7.1f} ms  "
+            f"db {_db_mb(db_path):8.1f} MB  rss {_rss_mb():7.1f} MB  media files {files}")
+
+def run(args):
+    out = sys.stdout
+    workdir = os.path.abspath(args.workdir)
+    csv_path = os.path.abspath(args.csv) if args.csv else None
+    if os.path.exists(workdir) and not args.keep:
+        shutil.rmtree(workdir)
+    os.makedirs(workdir, exist_ok=True)
+    stub = StubBotApi(latency=args.api_latency / 1000)
+    _write_config(workdir, stub.port, args)
+
+    # Import the bot from this checkout, with the scratch config.py
+    os.chdir(workdir)
+    sys.path.insert(0, workdir)
+    sys.path.insert(1, os.path.dirname(os.path.abspath(__file__)))
+    sys.stdout = open('bot.log', 'w', buffering=1)
+    if args.mode == 'processes':
+        out = os.fdopen(os.dup(1), 'w')
+        os.dup2(sys.stdout.fileno(), 1)  # Worker processes print to bot.log too
+    bot = importlib.import_module('as')
+    import storage
+    import settings
+
+    bot.init_db()
+    if args.prefill:
+        print(f"Prefilling {args.prefill} messages...", file=out, flush=True)
+        _prefill(storage, args.prefill, args.seed)
+
+    tracker = LatencyTracker(stub.offered)
+    if args.mode == 'processes':
+        storage.commit_offset = tracker.wrap_commit_offset(storage.commit_offset)
+    else:
+        storage.flush = tracker.wrap_flush(storage.flush)
+        bot.process_update = tracker.wrap_handler(bot.process_update)
+    threading.Thread(target=bot.main, args=(args.mode,), name='bot', daemon=True).start()
+
+    webhook_url = None
+    if args.mode == 'webhook':
+        webhook_url = f'http://127.0.0.1:{args.webhook_port}{settings.WEBHOOK_PATH}'
+        time.sleep(1)  # Let the server start
+    generator = StreamGenerator(args.chats, args.edit_ratio, args.delete_ratio, args.media_ratio,
+                                args.media_kb, args.text_length, args.seed)
+    stop = threading.Event()
+    result = {}
+
+    def feed():
+        result['sent'] = _feed(stub, generator, args, webhook_url, stop)
+    feeder = threading.Thread(target=feed, name='feeder', daemon=True)
+
+    print(f"Benchmark: mode {args.mode}, {args.rate} updates/s for {args.duration} s, "
+          f"{args.chats} chats, workdir {workdir}", file=out, flush=True)
+    rows = []
+    all_samples = []
+    started = last = time.perf_counter()
+    last_committed = 0
+    feeder.start()
+    while True:
+        time.sleep(args.report_interval)
+        now = time.perf_counter()
+        samples = tracker.take_samples()
+        all_samples += samples
+        committed = tracker.committed
+        files = sum(len(names) for _, _, names in os.walk(settings.MEDIA_DIR))
+        print(_report_line(now - started, now - last, committed - last_committed, samples,
+                           settings.DB_PATH, files), file=out, flush=True)
+        rows.append((round(now - started, 1), committed - last_committed, _percentile(samples, 50),
+                     _percentile(samples, 99), _db_mb(settings.DB_PATH), _rss_mb(), files))
+        last, last_committed = now, committed
+        # Done when the feed is over and every offered update is committed
+        backlog = stub.offered or stub.updates
+        if not feeder.is_alive() and (not backlog or now - started > args.duration + args.drain_timeout):
+            break
+    elapsed = time.perf_counter() - started
+
+    print(f"\nSent {result.get('sent', 0)} updates ({generator.kinds['message']} messages, "
+          f"{generator.kinds['edit']} edits, {generator.kinds['delete']} deletions, "
+          f"{generator.kinds['media']} with media); committed {tracker.committed} in {elapsed:.1f} s "
+          f"({tracker.committed / elapsed:.1f} updates/s)", file=out)
+    print(f"Latency p50 {_percentile(all_samples, 50) * 1000:.1f} ms, "
+          f"p99 {_percentile(all_samples, 99) * 1000:.1f} ms, max {max(all_samples or [0]) * 1000:.1f} ms; "
+          f"{len(stub.offered) + len(stub.updates)} updates never committed", file=out)
+    print(f"Database {_db_mb(settings.DB_PATH):.1f} MB, RSS {_rss_mb():.1f} MB, "
+          f"{stub.downloaded_bytes / 1024 / 1024:.1f} MB of media downloaded, "
+          f"Bot API calls: {dict(sorted(stub.calls.items()))}", file=out)
+    if csv_path:
+        with open(csv_path, 'w') as f:
+            f.write('elapsed_s,updates,p50_s,p99_s,db_mb,rss_mb,media_files\n')
+            f.writelines(','.join(str(v) for v in row) + '\n' for row in rows)
+    out.flush()
+    os._exit(0)  # The polling loop and its threads have no stop signal
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay a synthetic update stream and measure throughput")
+    parser.add_argument('--mode', choices=['sync', 'async', 'webhook', 'processes'], default='async')
+    parser.add_argument('--rate', type=float, default=100, help="updates offered per second")
+    parser.add_argument('--duration', type=float, default=30, help="seconds of traffic")
+    parser.add_argument('--chats', type=int, default=50)
+    parser.add_argument('--edit-ratio', type=float, default=0.2)
+    parser.add_argument('--delete-ratio', type=float, default=0.1)
+    parser.add_argument('--media-ratio', type=float, default=0.1, help="share of new messages with media")
+    parser.add_argument('--media-kb', type=int, default=200, help="average media file size (KiB)")
+    parser.add_argument('--text-length', type=int, default=120)
+    parser.add_argument('--prefill', type=int, default=0, help="older messages stored before the run")
+    parser.add_argument('--api-latency', type=float, default=0, help="added Bot API delay (ms)")
+    parser.add_argument('--report-interval', type=float, default=5, help="seconds between report lines")
+    parser.add_argument('--drain-timeout', type=float, default=30, help="seconds to wait for the backlog after the feed")
+    parser.add_argument('--webhook-port', type=int, default=18443)
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help="extra config.py line, e.g. --set WRITE_BATCH_SIZE=1000")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'bot_benchmark'))
+    parser.add_argument('--keep', action='store_true', help="reuse the database in workdir instead of starting empty")
+    parser.add_argument('--csv', help="write the report lines to this CSV file")
+    run(parser.parse_args())
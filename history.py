@@ -0,0 +1,89 @@
+# Edit history
+# Every edit appends one message_versions row with the new text and media; the
+# messages row keeps the first version (original_*) and the latest one. Long
+# texts are stored as a diff against the previous version: a JSON list whose
+# [start, end] items copy a slice of the previous text and whose strings are
+# inserted as they are. The first stored version of a message is always full
+# text, so a history can be rebuilt without anything from before it.
+#
+# /history CHAT_ID MESSAGE_ID [page:N] pages through a message's versions.
+
+import json
+import html
+import time
+import difflib
+from datetime import datetime
+from settings import *
+import storage
+
+PAGE_SIZE = 5
+
+# Compact diff turning old into new
+def encode_diff(old, new):
+    ops = []
+    matcher = difflib.SequenceMatcher(None, old, new, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append(new[j1:j2])
+    return json.dumps(ops, ensure_ascii=False, separators=(',', ':'))
+
+def apply_diff(old, diff):
+    return ''.join(old[op[0]:op[1]] if isinstance(op, list) else op for op in json.loads(diff))
+
+# Store text as a diff when that saves space
+def _encode_text(previous_text, text, first):
+    if first or text is None or previous_text is None or len(text) < HISTORY_DIFF_MIN_LENGTH:
+        return 'full', text
+    diff = encode_diff(previous_text, text)
+    return ('diff', diff) if len(diff) < len(text) * 0.8 else ('full', text)
+
+# Append a version for an edit of the message previous (from storage.get_message)
+def record_edit(previous, text, media_type, media_path, edited_at=None):
+    text_format, stored_text = _encode_text(previous['text'], text, previous['versions'] == 0)
+    storage.add_version(previous['business_id'], previous['chat_id'], previous['message_id'],
+                        previous['versions'] + 1, int(edited_at or time.time()),
+                        text_format, stored_text, media_type, media_path)
+
+# All versions of a message as dicts with plain text, oldest first (version 0 is the original)
+def load_versions(message):
+    versions = [{'version': 0, 'edited_at': message['date'], 'text': message['original_text'],
+                 'media_type': message['original_media_type'], 'media_path': message['original_media_path']}]
+    text = None
+    for row in storage.message_versions(message['id']):
+        text = apply_diff(text or '', row['text']) if row['text_format'] == 'diff' else row['text']
+        versions.append({'version': row['version'], 'edited_at': row['edited_at'], 'text': text,
+                         'media_type': row['media_type'], 'media_path': row['media_path']})
+    return versions
+
+def _format_version(version):
+    label = "Original" if version['version'] == 0 else f"Edit {version['version']}"
+    media = f" [{version['media_type']}]" if version['media_type'] else ''
+    text = html.escape((version['text'] or '')[:600])
+    return f"<b>{label}</b>, {datetime.fromtimestamp(version['edited_at']):%Y-%m-%d %H:%M}{media}\n{text}"
+
+# Run /history and return the reply (HTML). business_ids limits the lookup to
+# those connections.
+def handle(args, business_ids):
+    parts = args.split()
+    page = 1
+    if parts and parts[-1].lower().startswith('page:'):
+        page = parts.pop()[5:]
+        page = max(1, int(page)) if page.isdigit() else 1
+    if len(parts) != 2 or not all(p.lstrip('-').isdigit() for p in parts):
+        return "Usage: /history CHAT_ID MESSAGE_ID [page:N]"
+    message = storage.find_message(int(parts[0]), int(parts[1]), business_ids)
+    if message is None:
+        return "Message not found."
+    versions = load_versions(message)
+    shown = versions[(page - 1) * PAGE_SIZE:page * PAGE_SIZE]
+    if not shown:
+        return "No more versions."
+    flags = ' (deleted)' if message['is_deleted'] else ''
+    lines = [f"📜 History of message {parts[1]} from @{html.escape(message['username'] or '?')}{flags}, "
+             f"{len(versions)} versions:"]
+    lines += [_format_version(v) for v in shown]
+    if page * PAGE_SIZE < len(versions):
+        lines.append(f"Next page: add page:{page + 1}")
+    return '\n\n'.join(lines)
@@ -2,6 +2,7 @@ import requests
 import time
 import re
 from config import TOKEN, BASE_URL
+import telegram_api
 
 def update_config(business_connection_id, admin_id, sender_username):
     """Update ALLOWED_BUSINESS_ID, ADMIN_ID, and SENDER_USERNAME in config.py."""
@@ -60,10 +61,10 @@ def main():
     
     while True:
         try:
-            updates = requests.get(f'{BASE_URL}/getUpdates', params={
+            updates = telegram_api.call('getUpdates', params={
                 'offset': last_update_id,
                 'timeout': 30
-            }, timeout=(10, 30)).json().get('result', [])
+            }, timeout=(10, 40)).get('result', [])
             
             for update in updates:
                 last_update_id = update['update_id'] + 1
@@ -72,6 +72,7 @@ fi
 # Step 2: Install Python dependencies
 print_msg "Installing Python dependencies..."
 pip3 install requests schedule
+pip3 install pillow zstandard || print_msg "Pillow/zstandard not installed: media tiering will only pack files" "$YELLOW"
 
 # Step 3: Create bot user (non-login, for running the bot)
 if ! id "$BOT_USER" &>/dev/null; then
@@ -100,12 +101,14 @@ MAX_FILE_SIZE_BYTES=$((MAX_FILE_SIZE * 1024 * 1024))
 print_msg "Setting up installation directory at $INSTALL_DIR..."
 mkdir -p "$INSTALL_DIR" "$INSTALL_DIR/$MEDIA_DIR"
 
-# Copy as.py and init_bot.py (assuming they are in the current directory)
-if [ -f "as.py" ] && [ -f "init_bot.py" ]; then
-    cp as.py init_bot.py "$INSTALL_DIR/"
-else
-    print_error "as.py and init_bot.py must be in the current directory"
-fi
+# Copy the bot modules (assuming they are in the current directory)
+BOT_FILES="as.py init_bot.py settings.py storage.py media.py telegram_api.py async_runtime.py backup.py usage.py retention.py spam.py tenants.py webhook.py alerts.py search.py history.py stats.py metrics.py tiers.py shards.py process_runtime.py message_cache.py"
+for file in $BOT_FILES; do
+    if [ ! -f "$file" ]; then
+        print_error "$file must be in the current directory"
+    fi
+done
+cp $BOT_FILES "$INSTALL_DIR/"
 
 # Generate config.py
 print_msg "Generating config.py..."
@@ -117,21 +120,104 @@ ALLOWED_BUSINESS_ID = ''  # Will be automatically filled by init_bot.py after se
 SENDER_USERNAME = ''  # Will be automatically filled by init_bot.py with the bot's username (e.g., 'BotName')
 BASE_URL = f'https://api.telegram.org/bot{TOKEN}'
 
+# Multi-tenant settings (one process serves every connected business account)
+TENANT_ALLOWED_USERS = [ADMIN_ID]  # Telegram users allowed to connect the bot; None = anyone
+TENANT_DEFAULTS = {}  # e.g. {'alerts': ['deleted', 'edited', 'spam'], 'retention_days': None}
+TENANT_SETTINGS = {}  # Per connection: {BUSINESS_CONNECTION_ID: {'alert_chat_id': CHAT_ID, ...}}
+
+# Runtime settings
+RUNTIME_MODE = 'sync'  # 'sync' polling loop, 'async' event loop, 'webhook' (needs aiohttp) or 'processes'
+ASYNC_WORKERS = 8  # Threads running update handlers in async mode
+ASYNC_MAX_PENDING = 200  # In-flight updates before polling waits (async mode)
+PROCESS_WORKERS = $(nproc 2>/dev/null || echo 2)  # Update worker processes (processes mode)
+
+# Webhook settings (RUNTIME_MODE = 'webhook')
+WEBHOOK_URL = ''  # Public HTTPS URL of your reverse proxy; '' = do not register with Telegram
+WEBHOOK_LISTEN = '127.0.0.1'  # Address the embedded server listens on
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = '/telegram-webhook'
+WEBHOOK_SECRET = ''  # Secret token Telegram sends with every update; '' = random per run
+WEBHOOK_QUEUE_SIZE = 1000  # Acknowledged updates waiting for processing before answering 503
+WEBHOOK_MAX_CONNECTIONS = 40  # Parallel connections Telegram may open
+
+# Bot API client settings
+HTTP_POOL_SIZE = 10  # Keep-alive connections to the Bot API
+HTTP_CONNECT_TIMEOUT = 10  # Seconds
+HTTP_READ_TIMEOUT = 30  # Seconds
+HTTP_MAX_RETRIES = 5  # Retries after a 429 (rate limit) response
+
 # File and storage settings
 MEDIA_DIR = '$MEDIA_DIR'  # Folder for media storage
 MAX_FILE_SIZE = $MAX_FILE_SIZE_BYTES  # $MAX_FILE_SIZE MB in bytes
 CLEANUP_DAYS = $CLEANUP_DAYS  # Cleanup period for old messages and media
+RETENTION_POLICIES = {}  # e.g. {'chats': {CHAT_ID: 30}, 'media_types': {'video': 2}}
+RETENTION_BATCH_SIZE = 1000  # Messages removed per cleanup transaction
+RETENTION_BATCH_PAUSE = 0.05  # Pause between cleanup batches (seconds)
+RETENTION_DELETE_WORKERS = 4  # Parallel media file deletions
+MEDIA_DOWNLOAD_WORKERS = 4  # Parallel media downloads
+MEDIA_QUEUE_SIZE = 100  # Queued downloads before message processing waits
+MEDIA_DOWNLOAD_TIMEOUT = 300  # Max time for one download (seconds)
+MEDIA_DOWNLOAD_RETRIES = 3  # Resumes of a download after a broken connection
+MEDIA_FAST_LANE_MAX_SIZE = 1024 * 1024  # Larger files are downloaded by the slow lane (bytes)
+MEDIA_SLOW_WORKERS = 1  # Parallel downloads of large files
+MEDIA_BANDWIDTH_LIMIT = 0  # Cap for all downloads (bytes/s); 0 = unlimited
+MEDIA_SLOW_LANE_BANDWIDTH = 0  # Cap for large file downloads (bytes/s); 0 = unlimited
+MEDIA_LAZY_MIN_SIZE = 0  # Media this large is only downloaded once deleted or edited (bytes); 0 = off
+
+# Database settings
+DB_PATH = 'messages.db'  # SQLite database file
+DB_CACHE_SIZE_KB = 16384  # SQLite page cache size (KiB)
+DB_MMAP_SIZE = 268435456  # Memory-mapped I/O window (bytes)
+WRITE_BATCH_SIZE = 500  # Queued writes that force a commit
+WRITE_FLUSH_INTERVAL = 1.0  # Max age of a queued write before commit (seconds)
+MESSAGE_CACHE_SIZE = 32 * 1024 * 1024  # Memory for recently received messages (bytes); 0 = off
+MESSAGE_CACHE_TTL = 86400  # Seconds a message stays cached after it was sent
+
+# Backup settings
+BACKUP_FULL_INTERVAL_DAYS = 7  # Full snapshot every N days, incremental backups in between
+BACKUP_PART_SIZE = 51380224  # Split archives larger than 49 MB (Bot API upload limit is 50 MB)
+BACKUP_UPLOAD_TIMEOUT = 300  # Seconds per uploaded part
+
+# Alert settings
+ALERT_RATE_GLOBAL = 25  # Alerts per second overall (Bot API allows about 30)
+ALERT_RATE_PER_CHAT = 1  # Alerts per second to one chat
+ALERT_BURST_PER_CHAT = 3  # Short bursts allowed above that rate
+ALERT_COALESCE_THRESHOLD = 3  # Deleting more messages at once sends one summary plus albums
+ALERT_MAX_ATTEMPTS = 10  # Failed sends before an alert is dropped
+
+# Edit history settings
+HISTORY_DIFF_MIN_LENGTH = 256  # Edits of shorter texts are stored in full, longer ones as a diff
+
+# Metrics settings
+METRICS_LISTEN = '127.0.0.1'  # Address of the Prometheus /metrics endpoint
+METRICS_PORT = 9108  # 0 = no endpoint
+PROFILER_INTERVAL = 0.01  # Seconds between samples of /profile
+PROFILER_MAX_SECONDS = 300  # The profiler stops by itself after this
+
+# Media tiering settings
+MEDIA_TIERING = False  # True = recompress media after MEDIA_WARM_DAYS and pack it after MEDIA_COLD_DAYS
+MEDIA_WARM_DAYS = 1  # Age at which photos become WebP and documents zstd
+MEDIA_COLD_DAYS = 3  # Days in warm storage before media is appended to a pack
+MEDIA_WEBP_QUALITY = 80
+MEDIA_ZSTD_LEVEL = 10
+MEDIA_PACK_SIZE = 256 * 1024 * 1024  # Bytes per pack file
+MEDIA_TIERING_WORKERS = 2  # Recompression processes
+MEDIA_THUMBNAILS = True  # Photo thumbnails shown in alerts
+
+# Statistics settings
+STATS_EVENT_DAYS = 365  # Days of daily counts kept for /stats days
 
 # Spam protection settings
 SPAM_THRESHOLD = $SPAM_THRESHOLD  # Max photos allowed in 1 minute
 SPAM_WINDOW = $SPAM_WINDOW  # Time window for spam detection (seconds)
 SPAM_BLOCK_DURATION = $SPAM_BLOCK_DURATION  # Block media for 1 hour (seconds)
+SPAM_SAVE_INTERVAL = 30  # Seconds between spam tracker snapshots
 EOF
 
 # Set permissions
 chown -R "$BOT_USER:$BOT_USER" "$INSTALL_DIR"
 chmod -R 755 "$INSTALL_DIR"
-chmod 644 "$INSTALL_DIR/as.py" "$INSTALL_DIR/config.py" "$INSTALL_DIR/init_bot.py"
+(cd "$INSTALL_DIR" && chmod 644 $BOT_FILES config.py)
 
 # Step 6: Initialize database (will be created by bot if needed)
 print_msg "Database will be initialized by the bot at first run ($INSTALL_DIR/messages.db)"
@@ -202,4 +288,4 @@ fi
 echo "5. Logs are printed to console or systemd journal (journalctl -u telegram-bot)"
 echo "6. Media files are stored in $INSTALL_DIR/$MEDIA_DIR"
 echo "7. Database is at $INSTALL_DIR/messages.db"
-echo "8. Spam tracker is at $INSTALL_DIR/spam_tracker.json"
\ No newline at end of file
+echo "8. Spam tracker state is stored in the database (spam_state table)"
\ No newline at end of file
@@ -0,0 +1,305 @@
+# Background media downloads into a content-addressed store
+# Message rows are stored right away with media_status = 'pending'; worker
+# threads fetch the files and record the final status, so a large video never
+# blocks the getUpdates loop.
+# Files are named after Telegram's file_unique_id (or their SHA-256 when it is
+# missing), so media forwarded into many chats or kept across edits is stored
+# and downloaded once. Files are spread over shard directories (see shards.py).
+#
+# Downloads run in two lanes. Photos, voice notes and other files up to
+# MEDIA_FAST_LANE_MAX_SIZE go to the fast lane; large videos and documents go
+# to the slow lane, which has its own workers and bandwidth cap, so they never
+# hold up small files. A download cut off mid-way resumes from its .part file
+# with an HTTP Range request, also after a restart.
+#
+# With MEDIA_LAZY_MIN_SIZE set, media at least that large is stored as
+# media_status = 'lazy' (only its file_id) and fetched when the message is
+# deleted or edited, ahead of other large downloads.
+
+import os
+import time
+import uuid
+import hashlib
+import queue
+import itertools
+import threading
+import mimetypes
+import requests
+import urllib3
+from settings import *
+import storage
+import telegram_api
+import usage
+import shards
+import tiers
+import metrics
+
+# Extensions for media types whose Telegram objects carry no file name or MIME type
+_DEFAULT_EXTENSIONS = {'photo': '.jpg', 'voice': '.ogg', 'video': '.mp4', 'audio': '.mp3'}
+
+# Prefix of paths used until a file without file_unique_id has been hashed
+_TEMP_PREFIX = 'tmp_'
+
+_FAST, _SLOW = 'fast', 'slow'
+_ON_DEMAND, _REGULAR = 0, 1  # Queue priorities: media of deleted/edited messages goes first
+_SMALL_MEDIA_TYPES = ('photo', 'voice')  # Fast lane when getFile has not told the size yet
+
+# Read size adapts to the link: it doubles while chunks arrive quickly and
+# halves when a chunk takes long, within these bounds
+_MIN_CHUNK = 64 * 1024
+_MAX_CHUNK = 1024 * 1024
+_CHUNK_SECONDS = 0.25
+
+# Byte-rate limit shared by download threads (rate 0 = unlimited). Up to one
+# second of unused rate may be spent at once.
+class RateLimit:
+    def __init__(self, rate):
+        self.rate = rate
+        self.available_at = 0.0
+        self.lock = threading.Lock()
+
+    # Wait until count more bytes are allowed
+    def take(self, count):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.available_at = max(self.available_at, now - 1) + count / self.rate
+            wait = self.available_at - now
+        if wait > 0:
+            time.sleep(wait)
+
+_lanes = {_FAST: queue.PriorityQueue(maxsize=MEDIA_QUEUE_SIZE),
+          _SLOW: queue.PriorityQueue(maxsize=MEDIA_QUEUE_SIZE)}
+_lane_workers = {_FAST: MEDIA_DOWNLOAD_WORKERS, _SLOW: MEDIA_SLOW_WORKERS}
+_bandwidth = RateLimit(MEDIA_BANDWIDTH_LIMIT)
+_slow_bandwidth = RateLimit(MEDIA_SLOW_LANE_BANDWIDTH)
+_sequence = itertools.count()  # Keeps queue order within a priority
+_queued = set()  # Paths queued or downloading, so shared media is fetched once
+_queued_lock = threading.Lock()
+_workers = []
+_workers_lock = threading.Lock()
+
+metrics.gauge('bot_media_queue_depth', lambda: sum(lane.qsize() for lane in _lanes.values()))
+metrics.gauge('bot_write_queue_depth', storage.pending_writes)
+
+# Pick a file extension from the Telegram file object
+def _guess_extension(file_type, media_file):
+    file_name = media_file.get('file_name')
+    if file_name and os.path.splitext(file_name)[1]:
+        return os.path.splitext(file_name)[1].lower()
+    mime_type = media_file.get('mime_type')
+    if mime_type:
+        extension = mimetypes.guess_extension(mime_type)
+        if extension:
+            return extension
+    return _DEFAULT_EXTENSIONS.get(file_type, '')
+
+# Local path the file will be stored at. Keyed by file_unique_id, which is the
+# same for a file in every chat; without one, a temporary path is used until
+# the download is hashed.
+def new_local_path(file_type, media_file):
+    extension = _guess_extension(file_type, media_file)
+    unique_id = media_file.get('file_unique_id')
+    if unique_id:
+        return shards.media_path(f"{unique_id}{extension}")
+    return shards.media_path(f"{_TEMP_PREFIX}{uuid.uuid4().hex}{extension}")
+
+def _is_temp_path(local_path):
+    return os.path.basename(local_path).startswith(_TEMP_PREFIX)
+
+# Lane for a download: small files first, large ones throttled
+def _lane(media_type, file_size):
+    if file_size:
+        return _FAST if file_size <= MEDIA_FAST_LANE_MAX_SIZE else _SLOW
+    return _FAST if media_type in _SMALL_MEDIA_TYPES else _SLOW
+
+def _next_chunk_size(size, received, seconds):
+    if received < size:
+        return size  # End of the file, or a short read
+    if seconds < _CHUNK_SECONDS / 2:
+        return min(size * 2, _MAX_CHUNK)
+    if seconds > _CHUNK_SECONDS * 2:
+        return max(size // 2, _MIN_CHUNK)
+    return size
+
+# Append the rest of a file to part_path, continuing a partial download when
+# the server honours the Range request. Returns the SHA-256 of the whole file.
+def _receive(file_path, part_path, file_size, limits, deadline):
+    digest = hashlib.sha256()
+    offset = 0
+    if os.path.exists(part_path):
+        with open(part_path, 'rb') as f:
+            for block in iter(lambda: f.read(_MAX_CHUNK), b''):
+                digest.update(block)
+                offset += len(block)
+    if file_size and offset >= file_size:
+        if offset == file_size:
+            return digest
+        digest, offset = hashlib.sha256(), 0  # Not the file we are downloading
+
+    headers = {'Range': f'bytes={offset}-'} if offset else None
+    with telegram_api.open_file(file_path, headers=headers) as r:
+        if offset and r.status_code != 206:
+            digest, offset = hashlib.sha256(), 0  # Range ignored: start over
+        with open(part_path, 'ab' if offset else 'wb') as f:
+            chunk_size = _MIN_CHUNK
+            while True:
+                started = time.monotonic()
+                if started > deadline:
+                    raise TimeoutError(f"download exceeded {MEDIA_DOWNLOAD_TIMEOUT} s")
+                chunk = r.raw.read(chunk_size, decode_content=True)
+                if not chunk:
+                    break
+                f.write(chunk)
+                digest.update(chunk)
+                offset += len(chunk)
+                chunk_size = _next_chunk_size(chunk_size, len(chunk), time.monotonic() - started)
+                for limit in limits:
+                    limit.take(len(chunk))
+    if file_size and offset != file_size:
+        raise ConnectionError(f"connection closed after {offset} of {file_size} bytes")
+    return digest
+
+# Download a Telegram file to local_path.
+# Returns (media_status, SHA-256 hex digest of the content or None); the
+# status is 'slow' when a fast-lane file turns out to be large.
+def download_media(file_id, local_path, lane=_FAST):
+    part_path = f"{local_path}.part"
+    try:
+        file_info = telegram_api.call('getFile', params={'file_id': file_id})
+        file_path = file_info['result']['file_path']
+        file_size = file_info['result'].get('file_size', 0)
+
+        if lane == _FAST and file_size > MEDIA_FAST_LANE_MAX_SIZE:
+            return _SLOW, None  # Larger than the update said: leave it to the slow lane
+        if file_size > MAX_FILE_SIZE:
+            print(f"File {file_path} exceeds 50 MB, ignoring.")
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            return 'too_large', None
+
+        deadline = time.monotonic() + MEDIA_DOWNLOAD_TIMEOUT
+        limits = [_bandwidth, _slow_bandwidth] if lane == _SLOW else [_bandwidth]
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+
+        # A broken connection is resumed from the bytes already on disk
+        for attempt in range(MEDIA_DOWNLOAD_RETRIES + 1):
+            try:
+                digest = _receive(file_path, part_path, file_size, limits, deadline)
+                break
+            except (OSError, requests.RequestException, urllib3.exceptions.HTTPError) as e:
+                if attempt == MEDIA_DOWNLOAD_RETRIES or time.monotonic() > deadline:
+                    raise
+                print(f"Download of {file_path} interrupted ({e}), resuming")
+
+        os.replace(part_path, local_path)
+        return 'done', digest.hexdigest()
+    except Exception as e:
+        print(f"Media download error: {e}")
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        return 'failed', None
+
+# Move a hashed download to its content-addressed path and repoint the rows
+def _store_by_hash(local_path, sha256):
+    extension = os.path.splitext(local_path)[1]
+    final_path = shards.media_path(f"sha256_{sha256}{extension}")
+    if tiers.exists(final_path):
+        os.remove(local_path)  # Same content already stored
+    else:
+        os.replace(local_path, final_path)
+    storage.rename_media(local_path, final_path)
+    return final_path
+
+# Download one queued file. Returns False when it was moved to the slow lane.
+def _fetch(lane, priority, file_id, local_path):
+    if tiers.exists(local_path):
+        status = 'done'  # Already stored, no network fetch needed
+    else:
+        started = time.perf_counter()
+        status, sha256 = download_media(file_id, local_path, lane)
+        if status == _SLOW:
+            _lanes[_SLOW].put((priority, next(_sequence), file_id, local_path))
+            return False
+        metrics.observe('bot_media_download_seconds', time.perf_counter() - started, status=status, lane=lane)
+        metrics.inc('bot_media_downloads_total', status=status, lane=lane)
+        if status == 'done' and _is_temp_path(local_path):
+            local_path = _store_by_hash(local_path, sha256)
+        if status == 'done':
+            usage.record_file(local_path)
+            tiers.make_thumbnail(local_path)
+    storage.set_media_status(local_path, status)
+    return True
+
+def _worker(lane):
+    jobs = _lanes[lane]
+    while True:
+        priority, _, file_id, local_path = jobs.get()
+        finished = True
+        try:
+            finished = _fetch(lane, priority, file_id, local_path)
+        except Exception as e:
+            print(f"Media worker error: {e}")
+        finally:
+            if finished:
+                with _queued_lock:
+                    _queued.discard(local_path)
+                storage.media_download_finished(local_path)
+            jobs.task_done()
+
+# Start the download workers of both lanes (idempotent)
+def start():
+    with _workers_lock:
+        if _workers:
+            return
+        for lane, count in _lane_workers.items():
+            for i in range(count):
+                worker = threading.Thread(target=_worker, args=(lane,), name=f'media-{lane}-{i}', daemon=True)
+                worker.start()
+                _workers.append(worker)
+
+# Status to store for new media: 'lazy' when it is only fetched if the message
+# is deleted or edited (see MEDIA_LAZY_MIN_SIZE), otherwise 'pending'
+def initial_status(media_file, local_path):
+    size = media_file.get('file_size') or 0
+    if MEDIA_LAZY_MIN_SIZE and size >= MEDIA_LAZY_MIN_SIZE and not tiers.exists(local_path):
+        return 'lazy'
+    return 'pending'
+
+# Queue a download; blocks while MEDIA_QUEUE_SIZE downloads are already waiting
+# in its lane. Call after the row referencing local_path has been written.
+def enqueue(file_id, local_path, media_type=None, file_size=None, priority=_REGULAR):
+    if tiers.exists(local_path):
+        if os.path.exists(local_path):
+            usage.record_file(local_path)  # No-op unless the ledger lost track of it
+        storage.set_media_status(local_path, 'done')
+        return
+    with _queued_lock:
+        if local_path in _queued:
+            return  # The running download updates every row with this path
+        _queued.add(local_path)
+    storage.media_download_started(local_path)  # Seen by the alert dispatcher of any process
+    start()
+    _lanes[_lane(media_type, file_size)].put((priority, next(_sequence), file_id, local_path))
+
+# Fetch lazy media now that its message was deleted or edited
+def fetch_now(file_id, local_path, media_type=None):
+    if not file_id:
+        return
+    storage.set_media_status(local_path, 'pending')
+    enqueue(file_id, local_path, media_type, priority=_ON_DEMAND)
+
+# Re-queue downloads left pending by a previous run
+def resume_pending():
+    storage.clear_media_downloads()
+    pending = storage.pending_media()
+    for row in pending:
+        enqueue(row['media_file_id'], row['media_path'], row['media_type'])
+    if pending:
+        print(f"Resumed {len(pending)} pending media downloads")
+
+# Block until every queued download has finished
+def wait_idle():
+    for jobs in _lanes.values():
+        jobs.join()
@@ -0,0 +1,168 @@
+# Recent message cache
+# Edits and deletions nearly always concern messages from the last few
+# minutes. Every message saved by this process is kept here, keyed by
+# (business_id, chat_id, message_id), so the edit and deletion handlers build
+# their alerts without reading the database. storage.py updates the entries on
+# every write to a cached message (edits, new versions, deletions, media
+# downloads and moves) and retention.py drops the ones it may clean up.
+#
+# Entries are kept in LRU order within MESSAGE_CACHE_SIZE bytes (estimated from
+# the records' size in memory) and for MESSAGE_CACHE_TTL seconds after the
+# message was sent. Messages sent before the process started are never cached:
+# after a restart an update may be fetched again for a message that is already
+# stored and edited, so those are always read from the database.
+#
+# In processes mode every worker has its own cache, while retention, media
+# moves and resumed downloads run in the main process. The main process
+# listens for those changes and sends them on to the workers (see
+# process_runtime.py).
+
+import sys
+import time
+import threading
+from collections import OrderedDict
+from settings import *
+import metrics
+
+_lock = threading.Lock()
+_entries = OrderedDict()  # key -> record, least recently used first
+_sizes = {}  # key -> estimated bytes of the entry
+_by_path = {}  # media path -> keys of the records referring to it
+_bytes = 0
+_floor = int(time.time())  # Messages sent before this are not cached
+_listeners = []
+
+_PATH_FIELDS = ('media_path', 'original_media_path')
+
+metrics.gauge('bot_message_cache_bytes', lambda: _bytes)
+metrics.gauge('bot_message_cache_entries', lambda: len(_entries))
+
+def _size(key, record):
+    return (sys.getsizeof(key) + sum(sys.getsizeof(part) for part in key) + sys.getsizeof(record)
+            + sum(sys.getsizeof(value) for value in record.values()))
+
+def _drop(key):
+    global _bytes
+    record = _entries.pop(key)
+    _bytes -= _sizes.pop(key)
+    for field in _PATH_FIELDS:
+        keys = _by_path.get(record[field])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del _by_path[record[field]]
+
+# Insert or replace an entry as the most recently used, then evict down to
+# the budget (call with _lock held)
+def _store(key, record):
+    global _bytes
+    if key in _entries:
+        _drop(key)
+    size = _size(key, record)
+    if size > MESSAGE_CACHE_SIZE:
+        return
+    _entries[key] = record
+    _sizes[key] = size
+    _bytes += size
+    for field in _PATH_FIELDS:
+        if record[field]:
+            _by_path.setdefault(record[field], set()).add(key)
+    while _bytes > MESSAGE_CACHE_SIZE:
+        _drop(next(iter(_entries)))
+
+# Call fn(name, *args) for every media_status, media_moved and forget_before
+# call of this process; getattr(message_cache, name)(*args) repeats it
+def listen(fn):
+    _listeners.append(fn)
+
+def _notify(name, *args):
+    for fn in _listeners:
+        fn(name, *args)
+
+def _expired(record):
+    return record['date'] < max(_floor, time.time() - MESSAGE_CACHE_TTL)
+
+# Cache a newly saved message (a message that is already cached is kept, like
+# the row in the database)
+def add(key, record):
+    if not MESSAGE_CACHE_SIZE or _expired(record):
+        return
+    with _lock:
+        if key not in _entries:
+            _store(key, record)
+
+# Copy of a cached message record, or None
+def get(key):
+    if not MESSAGE_CACHE_SIZE:
+        return None
+    with _lock:
+        record = _entries.get(key)
+        if record is not None and _expired(record):
+            _drop(key)
+            record = None
+        if record is not None:
+            _entries.move_to_end(key)
+            record = dict(record)
+    metrics.inc('bot_message_cache_lookups_total', result='miss' if record is None else 'hit')
+    return record
+
+def _update(key, **changes):
+    with _lock:
+        record = _entries.get(key)
+        if record is not None:
+            _store(key, {**record, **changes})
+
+# Same changes as storage._MARK_EDITED: the original_* fields keep the first version
+def edited(key, text, media_type, media_path, media_status, media_file_id):
+    with _lock:
+        record = _entries.get(key)
+        if record is None:
+            return
+        _store(key, {**record,
+                     'text': text,
+                     'original_text': record['original_text'] if record['original_text'] is not None
+                                      else record['text'],
+                     'media_type': media_type,
+                     'media_path': media_path,
+                     'media_status': media_status,
+                     'media_file_id': media_file_id,
+                     'original_media_type': record['original_media_type'] or record['media_type'],
+                     'original_media_path': record['original_media_path'] or record['media_path']})
+
+# A new edit history version was stored
+def versioned(key, version, edited_at):
+    with _lock:
+        record = _entries.get(key)
+        if record is not None:
+            _store(key, {**record, 'versions': version,
+                         'last_edited_at': max(record['last_edited_at'] or 0, edited_at)})
+
+def deleted(key):
+    _update(key, is_deleted=1)
+
+# A download of the media at path finished (or failed)
+def media_status(path, status):
+    _notify('media_status', path, status)
+    with _lock:
+        for key in list(_by_path.get(path, ())):
+            record = _entries.get(key)  # May have been evicted by the loop
+            if record is not None and record['media_path'] == path:
+                _store(key, {**record, 'media_status': status})
+
+# Media moved from old to new (content-addressed or sharded path)
+def media_moved(old, new):
+    _notify('media_moved', old, new)
+    with _lock:
+        for key in list(_by_path.get(old, ())):
+            record = _entries.get(key)
+            if record is not None:
+                _store(key, {**record, **{field: new for field in _PATH_FIELDS if record[field] == old}})
+
+# Drop messages sent before cutoff and stop caching them (retention may delete them)
+def forget_before(cutoff):
+    global _floor
+    _notify('forget_before', cutoff)
+    with _lock:
+        _floor = max(_floor, int(cutoff))
+        for key in [key for key, record in _entries.items() if record['date'] < cutoff]:
+            _drop(key)
@@ -0,0 +1,324 @@
+# Runtime metrics
+# Counters and timing histograms kept in memory by the modules that do the
+# work (Bot API calls, SQL, media downloads, alerts, update handling). They are
+# served in the Prometheus text format on
+# http://METRICS_LISTEN:METRICS_PORT/metrics (METRICS_PORT = 0 turns the
+# endpoint off) and summarized by the /health admin command.
+#
+# /profile start|stop runs a sampling profiler: every PROFILER_INTERVAL seconds
+# the stack of every thread is recorded. Stopping writes the samples as folded
+# stacks (one "thread;outer;...;inner COUNT" line each, the input of
+# flamegraph.pl and speedscope) and returns the functions seen most often.
+
+import os
+import sys
+import time
+import bisect
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from settings import *
+
+# Histogram bucket bounds (seconds)
+_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_HELP = {
+    'bot_updates_total': ('counter', "Updates received, by type"),
+    'bot_failures_total': ('counter', "Errors caught while polling or handling updates, by place"),
+    'bot_spam_total': ('counter', "Media refused by the spam tracker (blocked: new block, ignored: already blocked)"),
+    'bot_telegram_request_seconds': ('histogram', "Bot API call duration, by method"),
+    'bot_telegram_errors_total': ('counter', "Bot API error responses, by method and error code (429 = rate limited)"),
+    'bot_db_seconds': ('histogram', "SQLite call duration, by operation"),
+    'bot_db_writes_total': ('counter', "Writes committed by the write-behind queue"),
+    'bot_media_download_seconds': ('histogram', "Media download duration, by result"),
+    'bot_media_downloads_total': ('counter', "Media downloads, by result"),
+    'bot_media_tiered_total': ('counter', "Media files moved to the warm or cold tier, by tier and encoding"),
+    'bot_media_tiering_saved_bytes_total': ('counter', "Bytes saved by recompressing warm media"),
+    'bot_webhook_rejected_total': ('counter', "Webhook deliveries answered 503 because the queue was full"),
+    'bot_alert_enqueue_seconds': ('histogram', "Time to build and queue an alert, by event type"),
+    'bot_alert_send_seconds': ('histogram', "Alert delivery duration, by kind"),
+    'bot_last_update_timestamp_seconds': ('gauge', "Unix time of the last update received"),
+    'bot_start_timestamp_seconds': ('gauge', "Unix time the process started"),
+    'bot_write_queue_depth': ('gauge', "Writes waiting for the next commit"),
+    'bot_media_queue_depth': ('gauge', "Media downloads waiting for a worker"),
+    'bot_alert_queue_depth': ('gauge', "Alerts waiting to be sent"),
+    'bot_message_cache_lookups_total': ('counter', "Recent message cache lookups, by result (hit or miss)"),
+    'bot_message_cache_bytes': ('gauge', "Estimated memory held by the recent message cache"),
+    'bot_message_cache_entries': ('gauge', "Messages in the recent message cache"),
+}
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(_BUCKETS) + 1)  # The last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # Upper bound of the bucket holding quantile q (0..1)
+    def quantile(self, q):
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(_BUCKETS + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+_lock = threading.Lock()
+_counters = {}  # (name, labels) -> value
+_histograms = {}  # (name, labels) -> Histogram
+_gauges = {'bot_start_timestamp_seconds': time.time()}  # name -> value or callable
+_server = None
+_profiler = None
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def inc(name, amount=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+def observe(name, seconds, **labels):
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+# Time the block into a histogram
+@contextmanager
+def timer(name, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+# Set a gauge to a value, or to a function read at scrape time
+def gauge(name, value):
+    _gauges[name] = value
+
+def _gauge_value(value):
+    try:
+        return value() if callable(value) else value
+    except Exception:
+        return None  # E.g. the database is not open yet
+
+# Histogram of name merged over the label values matching labels
+def histogram(name, **labels):
+    merged = Histogram()
+    with _lock:
+        for (n, l), h in _histograms.items():
+            if n == name and set(labels.items()) <= set(l):
+                merged.counts = [a + b for a, b in zip(merged.counts, h.counts)]
+                merged.sum += h.sum
+                merged.count += h.count
+    return merged
+
+def _labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in items)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + '}'
+
+def _header(lines, name, seen):
+    if name not in seen:
+        seen.add(name)
+        kind, text = _HELP.get(name, ('untyped', name))
+        lines.append(f"# HELP {name} {text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+# Every metric in the Prometheus text exposition format
+def render():
+    lines = []
+    seen = set()
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((key, (list(h.counts), h.sum, h.count)) for key, h in _histograms.items())
+    for (name, labels), value in counters:
+        _header(lines, name, seen)
+        lines.append(f"{name}{_labels(labels)} {value}")
+    for (name, labels), (counts, total, count) in histograms:
+        _header(lines, name, seen)
+        cumulative = 0
+        for bound, bucket in zip(_BUCKETS + ('+Inf',), counts):
+            cumulative += bucket
+            lines.append(f"{name}_bucket{_labels(labels, [('le', bound)])} {cumulative}")
+        lines.append(f"{name}_sum{_labels(labels)} {total}")
+        lines.append(f"{name}_count{_labels(labels)} {count}")
+    for name, value in sorted(_gauges.items()):
+        value = _gauge_value(value)
+        if value is not None:
+            _header(lines, name, seen)
+            lines.append(f"{name} {value}")
+    return '\n'.join(lines) + '\n'
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+# Serve /metrics in a background thread (no-op when METRICS_PORT is 0)
+def start():
+    global _server
+    if not METRICS_PORT or _server is not None:
+        return
+    try:
+        _server = ThreadingHTTPServer((METRICS_LISTEN, METRICS_PORT), _Handler)
+    except OSError as e:
+        print(f"Metrics endpoint not started: {e}")
+        return
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name='metrics', daemon=True).start()
+    print(f"📈 Metrics on http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
+
+def _ms(seconds):
+    return "-" if seconds == float('inf') else f"{seconds * 1000:.0f} ms"
+
+def _ago(timestamp):
+    if not timestamp:
+        return "never"
+    seconds = int(time.time() - timestamp)
+    return f"{seconds} s ago" if seconds < 120 else f"{seconds // 60} min ago"
+
+def _by_label(name, label):
+    totals = Counter()
+    with _lock:
+        for (n, labels), value in _counters.items():
+            if n == name:
+                totals[dict(labels).get(label, '')] += value
+    return ', '.join(f"{k} {v}" for k, v in totals.most_common()) or "none"
+
+# Short state report for the /health command
+def health_report():
+    uptime = int(time.time() - _gauges['bot_start_timestamp_seconds'])
+    polls = histogram('bot_telegram_request_seconds', method='getUpdates')
+    flushes = histogram('bot_db_seconds', op='flush')
+    queries = histogram('bot_db_seconds', op='query')
+    downloads = histogram('bot_media_download_seconds')
+    alerts_sent = histogram('bot_alert_send_seconds')
+    return (
+        f"🩺 Health\n"
+        f"Uptime: {uptime // 3600} h {uptime % 3600 // 60} min\n"
+        f"Last update: {_ago(_gauge_value(_gauges.get('bot_last_update_timestamp_seconds')))}\n"
+        f"Updates: {_by_label('bot_updates_total', 'type')}\n"
+        f"Queues: writes {_gauge_value(_gauges.get('bot_write_queue_depth'))}, "
+        f"media {_gauge_value(_gauges.get('bot_media_queue_depth'))}, "
+        f"alerts {_gauge_value(_gauges.get('bot_alert_queue_depth'))}\n"
+        f"getUpdates: {polls.count} calls, p99 {_ms(polls.quantile(0.99))}\n"
+        f"DB: commits p50 {_ms(flushes.quantile(0.5))} / p99 {_ms(flushes.quantile(0.99))}, "
+        f"queries p99 {_ms(queries.quantile(0.99))}\n"
+        f"Message cache: {_by_label('bot_message_cache_lookups_total', 'result')}, "
+        f"{_gauge_value(_gauges.get('bot_message_cache_entries'))} messages\n"
+        f"Media: {_by_label('bot_media_downloads_total', 'status')}, p99 {_ms(downloads.quantile(0.99))}\n"
+        f"Alerts: {alerts_sent.count} sent, p99 {_ms(alerts_sent.quantile(0.99))}\n"
+        f"Telegram errors: {_by_label('bot_telegram_errors_total', 'code')}\n"
+        f"Failures: {_by_label('bot_failures_total', 'where')}\n"
+        f"Spam: {_by_label('bot_spam_total', 'action')}\n"
+        f"Profiler: {'running' if _profiler is not None else 'off'}"
+    )
+
+# Samples the stacks of every thread at a fixed interval
+class SamplingProfiler:
+    def __init__(self, interval=PROFILER_INTERVAL, max_seconds=PROFILER_MAX_SECONDS):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.stacks = Counter()
+        self.samples = 0
+        self.started = time.time()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def _run(self):
+        own = threading.get_ident()
+        deadline = time.monotonic() + self.max_seconds
+        while not self.stop_event.wait(self.interval) and time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    # Functions on top of the stack (self) and anywhere in it (total)
+    def top(self, limit=10):
+        leaf = Counter()
+        total = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')[1:]
+            if frames:
+                leaf[frames[-1]] += count
+            for name in set(frames):
+                total[name] += count
+        return leaf.most_common(limit), total.most_common(limit)
+
+    def write_folded(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+def start_profiler():
+    global _profiler
+    if _profiler is not None:
+        return "Profiler is already running."
+    _profiler = SamplingProfiler()
+    _profiler.start()
+    return (f"Profiler started: sampling every {PROFILER_INTERVAL * 1000:.0f} ms, "
+            f"stops by itself after {PROFILER_MAX_SECONDS} s. Send /profile stop for the report.")
+
+# Stop the profiler and write its samples. Returns (report, folded file path or None).
+def stop_profiler():
+    global _profiler
+    if _profiler is None:
+        return "Profiler is not running.", None
+    profiler, _profiler = _profiler, None
+    profiler.stop()
+    if not profiler.samples:
+        return "No samples taken.", None
+    path = f"profile_{datetime.now():%Y%m%d_%H%M%S}.folded"
+    profiler.write_folded(path)
+    thread_samples = sum(profiler.stacks.values())
+    leaf, total = profiler.top()
+    lines = [f"⏱ {profiler.samples} samples over {time.time() - profiler.started:.0f} s "
+             f"({thread_samples} thread stacks). Blocked threads (waits, sockets) count too.",
+             "", "Most often running:"]
+    lines += [f"{count * 100 / thread_samples:5.1f}% {name}" for name, count in leaf]
+    lines += ["", "Most often on the stack:"]
+    lines += [f"{count * 100 / thread_samples:5.1f}% {name}" for name, count in total]
+    return '\n'.join(lines), path
@@ -0,0 +1,186 @@
+# Multi-process runtime
+# One poller fans updates out to PROCESS_WORKERS worker processes, so update
+# handlers run on every core. Updates are sharded by chat: every update of a
+# chat goes to the same worker and is handled there in arrival order, which
+# keeps a message, its edits and its deletion in sequence.
+#
+# The poller's process is the only writer. It owns the database connection,
+# commits the writes the workers send it (see connect_writer / serve_writer in
+# storage.py), sends alerts, resumes interrupted downloads and runs the
+# scheduled jobs. Workers read through their own read-only connections and
+# download the media of their chats.
+#
+# A batch of updates is confirmed to Telegram only after every worker has
+# handled its share and the writer has committed it, as in the other polling
+# modes. If a worker dies the bot exits, and the batch is fetched again on the
+# next start.
+#
+# Business connections are sent to every worker (the first one stores them),
+# and so are the changes the main process makes to messages the workers may
+# have cached (see message_cache.py).
+# Spam tracking is per worker: a business chat is a private chat, so its chat
+# ID is the sender's user ID and the sender always reaches the same worker.
+
+import time
+import queue
+import signal
+import threading
+import multiprocessing
+import schedule
+from settings import *
+import storage
+import telegram_api
+import async_runtime
+import tenants
+import spam
+import media
+import message_cache
+import alerts
+import metrics
+
+_STOP_TIMEOUT = 10  # Seconds a worker gets to commit its last writes
+
+# A worker process that stopped without being asked to
+class WorkerExited(Exception):
+    pass
+
+def _shard(chat_id, count):
+    return chat_id % count if chat_id is not None else 0
+
+# Body of a worker process: handle the updates of its chats until stopped
+def _work(index, count, handler, updates, acks, writer):
+    # The poller stops the workers once their last updates are committed
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    storage.connect_writer(writer)
+    tenants.load()
+    spam.load(lambda user_id: _shard(user_id, count) == index)
+    media.start()
+    schedule.every(SPAM_SAVE_INTERVAL).seconds.do(spam.save)
+    parent = multiprocessing.parent_process()
+    while True:
+        try:
+            item = updates.get(timeout=WRITE_FLUSH_INTERVAL)
+        except queue.Empty:
+            if not parent.is_alive():
+                break
+            storage.flush()
+            schedule.run_pending()
+            continue
+        if item is None:
+            break
+        kind, value = item
+        if kind == 'update':
+            try:
+                handler(value)
+            except Exception as e:
+                print(f"Error processing update {value.get('update_id')}: {e}")
+        elif kind == 'tenant':
+            tenants.register(value, save=False)
+        elif kind == 'cache':
+            name, args = value
+            getattr(message_cache, name)(*args)
+        elif kind == 'batch':
+            storage.flush()  # Committed by the writer before the batch is acknowledged
+            acks.put((index, value))
+            schedule.run_pending()
+    spam.save()
+    storage.close()
+
+# Start the workers and a writer thread serving each of them.
+# Returns ([(process, update queue, writer thread)], acknowledgement queue).
+def _start_workers(handler, count):
+    context = multiprocessing.get_context('spawn')
+    acks = context.Queue()
+    workers = []
+    for index in range(count):
+        updates = context.Queue()
+        writer_end, worker_end = context.Pipe()
+        process = context.Process(target=_work, args=(index, count, handler, updates, acks, worker_end),
+                                  name=f'update-worker-{index}', daemon=True)
+        process.start()
+        worker_end.close()  # The writer thread sees EOF when the worker exits
+        writer = threading.Thread(target=storage.serve_writer, args=(writer_end, alerts.wake),
+                                  name=f'db-writer-{index}')
+        writer.start()
+        workers.append((process, updates, writer))
+    return workers, acks
+
+# Send an update to the worker of its chat
+def _dispatch(workers, update):
+    if 'business_connection' in update:
+        connection = update['business_connection']
+        tenants.register(connection, save=False)  # For the writer's jobs (retention)
+        workers[0][1].put(('update', update))
+        for _, updates, _ in workers[1:]:
+            updates.put(('tenant', connection))
+        return
+    chat_id = async_runtime.update_chat_id(update)
+    workers[_shard(chat_id, len(workers))][1].put(('update', update))
+
+# Repeat a message_cache change of this process in every worker
+def _broadcast_cache(workers, name, *args):
+    for _, updates, _ in workers:
+        updates.put(('cache', (name, args)))
+
+# Wait until every worker has committed the updates sent before batch
+def _wait_batch(workers, acks, batch):
+    waiting = set(range(len(workers)))
+    while waiting:
+        try:
+            index, done = acks.get(timeout=1)
+        except queue.Empty:
+            for index in waiting:
+                if not workers[index][0].is_alive():
+                    raise WorkerExited(f"update worker {index} exited")
+            continue
+        if done == batch:
+            waiting.discard(index)
+
+# Stop the workers, then wait for their writer threads to commit the last
+# writes (each one returns on EOF once its worker has exited)
+def _stop_workers(workers):
+    for process, updates, _ in workers:
+        if process.is_alive():
+            updates.put(None)
+    for process, _, _ in workers:
+        process.join(_STOP_TIMEOUT)
+        if process.is_alive():
+            process.terminate()
+            process.join()
+    for _, _, writer in workers:
+        writer.join()
+
+# Poll for updates and hand them to count worker processes until interrupted
+def run(handler, count=PROCESS_WORKERS):
+    count = max(1, int(count))
+    print(f"🧩 Running with {count} update worker processes")
+    workers, acks = _start_workers(handler, count)
+    message_cache.listen(lambda name, *args: _broadcast_cache(workers, name, *args))
+    offset = storage.load_offset()
+    batch = 0
+    try:
+        while True:
+            try:
+                updates = telegram_api.call('getUpdates', params={
+                    'offset': offset,
+                    'timeout': 30
+                }, timeout=(HTTP_CONNECT_TIMEOUT, 30 + HTTP_READ_TIMEOUT)).get('result', [])
+                for update in updates:
+                    _dispatch(workers, update)
+                if updates:
+                    batch += 1
+                    for _, worker_updates, _ in workers:
+                        worker_updates.put(('batch', batch))
+                    _wait_batch(workers, acks, batch)
+                    offset = updates[-1]['update_id'] + 1
+                    storage.commit_offset(offset)
+                schedule.run_pending()
+            except WorkerExited:
+                raise
+            except Exception as e:
+                metrics.inc('bot_failures_total', where='polling')
+                print(f"Error while fetching updates: {e}")
+                time.sleep(5)  # Wait before retrying
+    finally:
+        _stop_workers(workers)
@@ -0,0 +1,156 @@
+# Retention cleanup
+# Expired messages are found by walking the date index in bounded batches and
+# removed in short transactions, so the nightly cleanup never holds the write
+# lock for long or loads every expired row into memory. Media files whose last
+# reference is gone are removed by a small thread pool, from whichever storage
+# tier holds them (see tiers.py). Progress is saved in the meta table after
+# every batch, so an interrupted run resumes where it stopped. Media types
+# with a shorter retention are expired separately through their own indexes,
+# so they never widen the walk over the messages.
+#
+# RETENTION_POLICIES in config.py overrides CLEANUP_DAYS (as does the
+# retention_days setting of a business connection, see tenants.py):
+#     {'chats': {CHAT_ID: DAYS, ...},        # keep these chats longer/shorter
+#      'media_types': {'video': DAYS, ...}}  # drop media files of a type sooner;
+#                                            # the message text is kept
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from settings import *
+import storage
+import message_cache
+import tenants
+import tiers
+
+_CURSOR_KEY = 'retention_cursor'
+
+def _cutoff(days, now):
+    return int((now - timedelta(days=days)).timestamp())
+
+# Cutoff timestamps for the current run
+class RetentionPolicy:
+    def __init__(self, policies=None, default_days=CLEANUP_DAYS, now=None, tenant_days=None):
+        policies = RETENTION_POLICIES if policies is None else policies
+        tenant_days = tenants.retention_days() if tenant_days is None else tenant_days
+        now = now or datetime.now()
+        self.default_cutoff = _cutoff(default_days, now)
+        self.tenant_cutoffs = {business_id: _cutoff(days, now)
+                               for business_id, days in tenant_days.items()}
+        self.chat_cutoffs = {int(chat_id): _cutoff(days, now)
+                             for chat_id, days in policies.get('chats', {}).items()}
+        self.media_cutoffs = {media_type: _cutoff(days, now)
+                              for media_type, days in policies.get('media_types', {}).items()}
+
+    # Message cutoffs as JSON-friendly values (stored in delta backups)
+    def message_cutoffs(self):
+        return {'default': self.default_cutoff, 'tenants': self.tenant_cutoffs, 'chats': self.chat_cutoffs}
+
+    # Policy deleting what the saved message cutoffs delete (media is kept)
+    @classmethod
+    def from_message_cutoffs(cls, saved):
+        policy = cls.__new__(cls)
+        policy.default_cutoff = saved['default']
+        policy.tenant_cutoffs = dict(saved['tenants'])
+        policy.chat_cutoffs = {int(chat_id): cutoff for chat_id, cutoff in saved['chats'].items()}
+        policy.media_cutoffs = {}
+        return policy
+
+    # Newest cutoff of the message policies: no row at or after it is deleted
+    def message_cutoff(self):
+        return max([self.default_cutoff, *self.tenant_cutoffs.values(), *self.chat_cutoffs.values()])
+
+    # Newest cutoff of any policy: no row at or after it can change
+    def max_cutoff(self):
+        return max([self.message_cutoff(), *self.media_cutoffs.values()])
+
+    # A chat policy wins over the connection's setting, which wins over CLEANUP_DAYS
+    def message_expired(self, business_id, chat_id, date):
+        if chat_id in self.chat_cutoffs:
+            return date < self.chat_cutoffs[chat_id]
+        return date < self.tenant_cutoffs.get(business_id, self.default_cutoff)
+
+    def media_expired(self, media_type, date):
+        return media_type in self.media_cutoffs and date < self.media_cutoffs[media_type]
+
+# Decide what to do with one batch of candidate rows
+def _plan_batch(policy, rows):
+    delete_ids, expire_media_ids, expire_original_ids = [], [], []
+    for row in rows:
+        if policy.message_expired(row['business_id'], row['chat_id'], row['date']):
+            delete_ids.append(row['id'])
+            continue
+        if row['media_path'] and policy.media_expired(row['media_type'], row['date']):
+            expire_media_ids.append(row['id'])
+        if row['original_media_path'] and policy.media_expired(row['original_media_type'], row['date']):
+            expire_original_ids.append(row['id'])
+    return delete_ids, expire_media_ids, expire_original_ids
+
+def _remove_file(path):
+    try:
+        return tiers.remove(path)
+    except OSError as e:
+        print(f"Error deleting media {path}: {e}")
+    return False
+
+# Remove media files that no message references any more
+def remove_orphaned_media(pool):
+    paths = storage.forget_media(storage.orphaned_media())
+    return sum(pool.map(_remove_file, paths))
+
+# Expire the media of one type sent before cutoff, in batches. Expired rows
+# leave the index the query reads, so each batch starts where the last ended.
+# Returns (expired media references, deleted files).
+def _expire_media_type(pool, media_type, cutoff):
+    expired = deleted_files = 0
+    for original in (False, True):
+        while True:
+            ids = storage.expired_media(media_type, cutoff, original, RETENTION_BATCH_SIZE)
+            if not ids:
+                break
+            storage.apply_expiry([], [] if original else ids, ids if original else [])
+            expired += len(ids)
+            deleted_files += remove_orphaned_media(pool)
+            time.sleep(RETENTION_BATCH_PAUSE)
+    return expired, deleted_files
+
+# Run the retention cleanup (resumes an interrupted run)
+def run(policy=None):
+    policy = policy or RetentionPolicy()
+    message_cutoff = policy.message_cutoff()
+    message_cache.forget_before(policy.max_cutoff())  # Cached records of messages this run may change
+
+    cursor = storage.get_meta(_CURSOR_KEY)
+    after_date, after_id = (int(v) for v in cursor.split(':')) if cursor else (-1, -1)
+    if cursor:
+        print(f"Resuming retention cleanup after {datetime.fromtimestamp(after_date)}")
+
+    deleted_rows = expired_media = deleted_files = 0
+    with ThreadPoolExecutor(max_workers=RETENTION_DELETE_WORKERS) as pool:
+        while True:
+            rows = storage.expiry_candidates(message_cutoff, after_date, after_id, RETENTION_BATCH_SIZE)
+            if not rows:
+                break
+            delete_ids, expire_media_ids, expire_original_ids = _plan_batch(policy, rows)
+            storage.apply_expiry(delete_ids, expire_media_ids, expire_original_ids)
+            deleted_rows += len(delete_ids)
+            expired_media += len(expire_media_ids) + len(expire_original_ids)
+
+            after_date, after_id = rows[-1]['date'], rows[-1]['id']
+            storage.set_meta(_CURSOR_KEY, f"{after_date}:{after_id}")
+
+            deleted_files += remove_orphaned_media(pool)
+            time.sleep(RETENTION_BATCH_PAUSE)  # Let message writes in between batches
+
+        for media_type, cutoff in policy.media_cutoffs.items():
+            expired, deleted = _expire_media_type(pool, media_type, cutoff)
+            expired_media += expired
+            deleted_files += deleted
+
+        deleted_files += remove_orphaned_media(pool)  # Also leftovers of earlier runs
+    storage.delete_meta(_CURSOR_KEY)
+    storage.prune_stats((datetime.now() - timedelta(days=STATS_EVENT_DAYS)).strftime('%Y-%m-%d'))
+
+    print(f"Cleared {deleted_rows} old messages, {expired_media} expired media references "
+          f"and {deleted_files} media files.")
+    return deleted_rows, expired_media, deleted_files
@@ -0,0 +1,98 @@
+# /search command
+# Usage: /search WORDS [chat:ID] [user:@NAME|ID] [from:YYYY-MM-DD] [to:YYYY-MM-DD]
+#                      [deleted] [edited] [page:N]
+# Words are matched as whole tokens (word* matches a prefix, "two words" a
+# phrase) in the current and the original text, newest messages first.
+
+import re
+import html
+import sqlite3
+from datetime import datetime
+from settings import *
+import storage
+
+PAGE_SIZE = 10
+
+_TOKEN = re.compile(r'"[^"]*"|\S+')
+_FILTER = re.compile(r'^(chat|user|from|to|page):(.+)$', re.IGNORECASE)
+
+class SearchError(ValueError):
+    pass
+
+# Quote every word so user input is never parsed as FTS5 syntax
+def _fts_term(token):
+    prefix = token.endswith('*') and len(token) > 1
+    word = token.rstrip('*').strip('"').replace('"', '""')
+    if not word:
+        return None
+    return f'"{word}"' + ('*' if prefix else '')
+
+def _date(value):
+    try:
+        return int(datetime.strptime(value, '%Y-%m-%d').timestamp())
+    except ValueError:
+        raise SearchError(f"Bad date {value!r}, expected YYYY-MM-DD")
+
+# Split the command arguments into an FTS5 query, filters and page number
+def parse(args):
+    terms = []
+    filters = {}
+    page = 1
+    for token in _TOKEN.findall(args):
+        match = _FILTER.match(token)
+        lowered = token.lower()
+        if match:
+            key, value = match.group(1).lower(), match.group(2)
+            try:
+                if key == 'chat':
+                    filters['chat_id'] = int(value)
+                elif key == 'user' and value.lstrip('-').isdigit():
+                    filters['user_id'] = int(value)
+                elif key == 'user':
+                    filters['username'] = value.lstrip('@')
+                elif key == 'from':
+                    filters['since'] = _date(value)
+                elif key == 'to':
+                    filters['until'] = _date(value) + 86400  # Inclusive
+                else:
+                    page = max(1, int(value))
+            except ValueError as e:
+                raise SearchError(str(e) if isinstance(e, SearchError) else f"Bad value in {token!r}")
+        elif lowered in ('deleted', 'edited'):
+            filters[lowered] = True
+        else:
+            term = _fts_term(token)
+            if term:
+                terms.append(term)
+    if not terms:
+        raise SearchError("Nothing to search for")
+    return ' '.join(terms), filters, page
+
+def _format_row(row):
+    snippet = html.escape(row['snippet'] or '').replace('\x02', '<b>').replace('\x03', '</b>')
+    flags = ''.join(flag for flag, on in (('🗑', row['is_deleted']), ('✏️', row['is_edited'])) if on)
+    media = f" [{row['media_type']}]" if row['media_type'] else ''
+    return (f"{flags}{' ' if flags else ''}<b>@{html.escape(row['username'] or '?')}</b> "
+            f"in {row['chat_id']} #{row['message_id']}, {datetime.fromtimestamp(row['date']):%Y-%m-%d %H:%M}{media}\n"
+            f"{snippet}")
+
+# Run /search and return the reply (HTML). business_ids limits the search to
+# those connections (None = all).
+def handle(args, business_ids=None):
+    try:
+        query, filters, page = parse(args)
+    except SearchError as e:
+        return html.escape(f"{e}\n\nUsage: /search WORDS [chat:ID] [user:@NAME|ID] "
+                           f"[from:YYYY-MM-DD] [to:YYYY-MM-DD] [deleted] [edited] [page:N]")
+    try:
+        rows = storage.search_messages(query, filters, business_ids, limit=PAGE_SIZE + 1,
+                                       offset=(page - 1) * PAGE_SIZE)
+    except sqlite3.OperationalError as e:
+        return html.escape(f"Search failed: {e}")
+    if not rows:
+        return "Nothing found." if page == 1 else "No more results."
+    lines = [f"🔎 Results, page {page}:"]
+    lines += [_format_row(row) for row in rows[:PAGE_SIZE]]
+    if len(rows) > PAGE_SIZE:
+        lines.append(f"Next page: add page:{page + 1}")
+    return '\n\n'.join(lines)
@@ -0,0 +1,102 @@
+# Runtime settings
+# Values come from config.py (generated by install.sh). Options added after the
+# first release fall back to defaults here, so older config files keep working.
+
+import os
+import config
+from config import *
+
+# Runtime settings
+RUNTIME_MODE = getattr(config, 'RUNTIME_MODE', 'sync')  # 'sync' polling loop, 'async' event loop, 'webhook' or 'processes'
+ASYNC_WORKERS = getattr(config, 'ASYNC_WORKERS', 8)  # Threads running update handlers in async mode
+ASYNC_MAX_PENDING = getattr(config, 'ASYNC_MAX_PENDING', 200)  # In-flight updates before polling waits
+PROCESS_WORKERS = getattr(config, 'PROCESS_WORKERS', os.cpu_count() or 2)  # Update worker processes in processes mode
+
+# Webhook settings (RUNTIME_MODE = 'webhook', see webhook.py)
+WEBHOOK_URL = getattr(config, 'WEBHOOK_URL', '')  # Public HTTPS URL registered with setWebhook; '' = local testing
+WEBHOOK_LISTEN = getattr(config, 'WEBHOOK_LISTEN', '127.0.0.1')  # Address of the embedded server
+WEBHOOK_PORT = getattr(config, 'WEBHOOK_PORT', 8443)
+WEBHOOK_PATH = getattr(config, 'WEBHOOK_PATH', '/telegram-webhook')
+WEBHOOK_SECRET = getattr(config, 'WEBHOOK_SECRET', '')  # Secret token checked on every request; '' = random per run
+WEBHOOK_QUEUE_SIZE = getattr(config, 'WEBHOOK_QUEUE_SIZE', 1000)  # Acknowledged updates before answering 503
+WEBHOOK_MAX_CONNECTIONS = getattr(config, 'WEBHOOK_MAX_CONNECTIONS', 40)  # Parallel deliveries Telegram may open
+WEBHOOK_MAX_BODY = getattr(config, 'WEBHOOK_MAX_BODY', 1024 * 1024)  # Largest accepted update (bytes)
+
+# Bot API client settings
+FILE_BASE_URL = getattr(config, 'FILE_BASE_URL', BASE_URL.replace('/bot', '/file/bot', 1))
+HTTP_POOL_SIZE = getattr(config, 'HTTP_POOL_SIZE', 10)  # Keep-alive connections to the Bot API
+HTTP_CONNECT_TIMEOUT = getattr(config, 'HTTP_CONNECT_TIMEOUT', 10)  # Seconds
+HTTP_READ_TIMEOUT = getattr(config, 'HTTP_READ_TIMEOUT', 30)  # Seconds
+HTTP_MAX_RETRIES = getattr(config, 'HTTP_MAX_RETRIES', 5)  # Retries after a 429 response
+
+# Database settings
+DB_PATH = getattr(config, 'DB_PATH', 'messages.db')
+DB_CACHE_SIZE_KB = getattr(config, 'DB_CACHE_SIZE_KB', 16384)  # SQLite page cache (KiB)
+DB_MMAP_SIZE = getattr(config, 'DB_MMAP_SIZE', 256 * 1024 * 1024)  # Memory-mapped I/O window (bytes)
+WRITE_BATCH_SIZE = getattr(config, 'WRITE_BATCH_SIZE', 500)  # Queued writes that force a commit
+WRITE_FLUSH_INTERVAL = getattr(config, 'WRITE_FLUSH_INTERVAL', 1.0)  # Max age of a queued write (seconds)
+MESSAGE_CACHE_SIZE = getattr(config, 'MESSAGE_CACHE_SIZE', 32 * 1024 * 1024)  # Memory for recent messages (bytes); 0 = off
+MESSAGE_CACHE_TTL = getattr(config, 'MESSAGE_CACHE_TTL', 86400)  # Seconds a message stays cached after it was sent
+
+# Media download settings
+MEDIA_DOWNLOAD_WORKERS = getattr(config, 'MEDIA_DOWNLOAD_WORKERS', 4)  # Parallel downloads
+MEDIA_QUEUE_SIZE = getattr(config, 'MEDIA_QUEUE_SIZE', 100)  # Queued downloads before ingestion waits
+MEDIA_DOWNLOAD_TIMEOUT = getattr(config, 'MEDIA_DOWNLOAD_TIMEOUT', 300)  # Max time for one download (seconds)
+MEDIA_DOWNLOAD_RETRIES = getattr(config, 'MEDIA_DOWNLOAD_RETRIES', 3)  # Resumes of a download after a broken connection
+MEDIA_FAST_LANE_MAX_SIZE = getattr(config, 'MEDIA_FAST_LANE_MAX_SIZE', 1024 * 1024)  # Larger files use the slow lane (bytes)
+MEDIA_SLOW_WORKERS = getattr(config, 'MEDIA_SLOW_WORKERS', 1)  # Parallel downloads of large files
+MEDIA_BANDWIDTH_LIMIT = getattr(config, 'MEDIA_BANDWIDTH_LIMIT', 0)  # All downloads together (bytes/s); 0 = unlimited
+MEDIA_SLOW_LANE_BANDWIDTH = getattr(config, 'MEDIA_SLOW_LANE_BANDWIDTH', 0)  # Large file downloads (bytes/s); 0 = unlimited
+MEDIA_LAZY_MIN_SIZE = getattr(config, 'MEDIA_LAZY_MIN_SIZE', 0)  # Larger media is fetched only once deleted or edited; 0 = off
+
+# Media tiering settings (see tiers.py)
+MEDIA_TIERING = getattr(config, 'MEDIA_TIERING', False)  # Recompress and pack older media every hour
+MEDIA_WARM_DAYS = getattr(config, 'MEDIA_WARM_DAYS', 1)  # Age at which media is recompressed
+MEDIA_COLD_DAYS = getattr(config, 'MEDIA_COLD_DAYS', 3)  # Days in warm storage before media is packed
+MEDIA_WEBP_QUALITY = getattr(config, 'MEDIA_WEBP_QUALITY', 80)  # WebP quality of recompressed photos
+MEDIA_ZSTD_LEVEL = getattr(config, 'MEDIA_ZSTD_LEVEL', 10)  # zstd level of recompressed documents
+MEDIA_PACK_SIZE = getattr(config, 'MEDIA_PACK_SIZE', 256 * 1024 * 1024)  # Size at which a new pack is started (bytes)
+MEDIA_TIERING_WORKERS = getattr(config, 'MEDIA_TIERING_WORKERS', 2)  # Recompression processes
+MEDIA_THUMBNAILS = getattr(config, 'MEDIA_THUMBNAILS', True)  # Thumbnails of downloaded photos for alerts
+
+# Backup settings
+BACKUP_FULL_INTERVAL_DAYS = getattr(config, 'BACKUP_FULL_INTERVAL_DAYS', 7)  # Incremental backups in between
+BACKUP_PART_SIZE = getattr(config, 'BACKUP_PART_SIZE', 49 * 1024 * 1024)  # Bot API uploads are capped at 50 MB
+BACKUP_UPLOAD_TIMEOUT = getattr(config, 'BACKUP_UPLOAD_TIMEOUT', 300)  # Seconds per uploaded part
+
+# Retention settings
+RETENTION_POLICIES = getattr(config, 'RETENTION_POLICIES', {})  # Per-chat / per-media-type overrides of CLEANUP_DAYS
+RETENTION_BATCH_SIZE = getattr(config, 'RETENTION_BATCH_SIZE', 1000)  # Rows per cleanup transaction
+RETENTION_BATCH_PAUSE = getattr(config, 'RETENTION_BATCH_PAUSE', 0.05)  # Pause between batches (seconds)
+RETENTION_DELETE_WORKERS = getattr(config, 'RETENTION_DELETE_WORKERS', 4)  # Parallel media file deletions
+
+# Alert settings (see alerts.py)
+ALERT_RATE_GLOBAL = getattr(config, 'ALERT_RATE_GLOBAL', 25)  # Alerts per second overall (Bot API: ~30)
+ALERT_RATE_PER_CHAT = getattr(config, 'ALERT_RATE_PER_CHAT', 1)  # Alerts per second to one chat
+ALERT_BURST_PER_CHAT = getattr(config, 'ALERT_BURST_PER_CHAT', 3)  # Short bursts allowed above that rate
+ALERT_COALESCE_THRESHOLD = getattr(config, 'ALERT_COALESCE_THRESHOLD', 3)  # Larger deletions become one summary
+ALERT_MAX_ATTEMPTS = getattr(config, 'ALERT_MAX_ATTEMPTS', 10)  # Failed sends before an alert is dropped
+ALERT_POLL_INTERVAL = getattr(config, 'ALERT_POLL_INTERVAL', 5)  # Seconds between checks for deferred alerts
+
+# Edit history settings (see history.py)
+HISTORY_DIFF_MIN_LENGTH = getattr(config, 'HISTORY_DIFF_MIN_LENGTH', 256)  # Shorter edits are stored as full text
+
+# Metrics settings (see metrics.py)
+METRICS_LISTEN = getattr(config, 'METRICS_LISTEN', '127.0.0.1')  # Address of the /metrics endpoint
+METRICS_PORT = getattr(config, 'METRICS_PORT', 0)  # Port of the /metrics endpoint; 0 = off
+PROFILER_INTERVAL = getattr(config, 'PROFILER_INTERVAL', 0.01)  # Seconds between profiler samples
+PROFILER_MAX_SECONDS = getattr(config, 'PROFILER_MAX_SECONDS', 300)  # A forgotten profiler stops after this
+
+# Statistics settings (see stats.py)
+STATS_EVENT_DAYS = getattr(config, 'STATS_EVENT_DAYS', 365)  # Days of daily counts kept for /stats days
+
+# Spam tracker settings
+SPAM_SAVE_INTERVAL = getattr(config, 'SPAM_SAVE_INTERVAL', 30)  # Seconds between spam state snapshots
+
+# Multi-tenant settings (see tenants.py)
+TENANT_ALLOWED_USERS = getattr(config, 'TENANT_ALLOWED_USERS', [ADMIN_ID])  # Users allowed to connect the bot; None = anyone
+TENANT_DEFAULTS = {'alert_chat_id': None,  # None = the account owner
+                   'alerts': ['deleted', 'edited', 'spam'],
+                   'retention_days': None,  # None = CLEANUP_DAYS
+                   **getattr(config, 'TENANT_DEFAULTS', {})}
+TENANT_SETTINGS = getattr(config, 'TENANT_SETTINGS', {})  # Per business connection overrides of TENANT_DEFAULTS
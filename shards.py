@@ -0,0 +1,105 @@
+# Sharded media layout
+# Media files live in MEDIA_DIR/XX/NAME, where XX is the first byte of the MD5
+# of the file name, so 256 directories share the archive instead of one flat
+# directory holding every file. The shard only depends on the name, which
+# keeps content-addressed files (see media.py) at a single path.
+#
+# Archives from before the sharded layout are moved in the background at
+# startup, or by hand:
+#     python3 shards.py migrate [BATCH_SIZE]
+# Files are moved first and their references rewritten one batch per
+# transaction; resolve() finds a file under either layout, so media stays
+# readable while a migration runs or after one was interrupted.
+
+import os
+import sys
+import time
+import hashlib
+import threading
+from settings import *
+import storage
+
+BATCH_SIZE = 500  # Files moved per transaction
+_BATCH_PAUSE = 0.05  # Seconds between batches, so message writes get in between
+_LAYOUT_KEY = 'media_layout'
+
+_migrate_lock = threading.Lock()
+
+# Shard directory name for a file name
+def shard(name):
+    return hashlib.md5(name.encode()).hexdigest()[:2]
+
+# Path a media file with this name is stored at
+def media_path(name):
+    return f"{MEDIA_DIR}/{shard(name)}/{name}"
+
+def is_flat(path):
+    return os.path.dirname(path) == MEDIA_DIR
+
+# Where the file for a stored media path is: the path itself, or the same file
+# under the other layout while references are being migrated
+def resolve(path):
+    if os.path.exists(path):
+        return path
+    name = os.path.basename(path)
+    if is_flat(path):
+        other = media_path(name)
+    elif path == media_path(name):
+        other = f"{MEDIA_DIR}/{name}"
+    else:
+        return path  # Not a media path (warm files, packs)
+    return other if os.path.exists(other) else path
+
+# Move one batch of flat files to their shards. Returns the number of moves.
+def _migrate_batch(paths):
+    moves = []
+    for old in paths:
+        new = media_path(os.path.basename(old))
+        if os.path.exists(old):
+            os.makedirs(os.path.dirname(new), exist_ok=True)
+            os.replace(old, new)
+        moves.append((old, new))  # References move even if the file is in warm/cold storage
+    storage.move_media(moves)
+    return len(moves)
+
+# Move every flat media file into the sharded layout (resumable: already moved
+# files are skipped)
+def migrate(batch_size=BATCH_SIZE):
+    if not _migrate_lock.acquire(blocking=False):
+        return 0  # Already running
+    try:
+        started = time.time()
+        moved = 0
+        after = ''
+        while True:
+            paths = storage.media_paths_after(after, batch_size)
+            if not paths:
+                break
+            after = paths[-1]
+            flat = [path for path in paths if is_flat(path)]
+            if flat:
+                moved += _migrate_batch(flat)
+                time.sleep(_BATCH_PAUSE)
+        storage.set_meta(_LAYOUT_KEY, 'sharded')
+        if moved:
+            print(f"Moved {moved} media files to the sharded layout in {time.time() - started:.1f} s")
+        return moved
+    finally:
+        _migrate_lock.release()
+
+# Migrate in a background thread unless the archive is already sharded
+def migrate_in_background():
+    if storage.get_meta(_LAYOUT_KEY) == 'sharded':
+        return
+    threading.Thread(target=migrate, name='media-migrate', daemon=True).start()
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3) or sys.argv[1] != 'migrate' or len(sys.argv) == 3 and not sys.argv[2].isdigit():
+        print("Usage: python3 shards.py migrate [BATCH_SIZE]")
+        sys.exit(1)
+    storage.init_db()
+    try:
+        moved = migrate(int(sys.argv[2]) if len(sys.argv) == 3 else BATCH_SIZE)
+        print(f"Done, {moved} files moved.")
+    finally:
+        storage.close()
@@ -0,0 +1,117 @@
+# Spam tracking
+# Each sender (per business connection) keeps a fixed-size ring buffer of their last photo timestamps:
+# more than SPAM_THRESHOLD photos inside SPAM_WINDOW means the buffer is full
+# and its oldest entry is still inside the window. State lives in memory and
+# is written to the spam_state table every SPAM_SAVE_INTERVAL seconds (only
+# users that changed). Idle users are dropped once their window and block
+# have passed, so memory and save cost stay bounded.
+
+import os
+import json
+import time
+import threading
+from collections import deque, namedtuple
+from settings import *
+import storage
+
+_MEDIA_TYPES = ('photo', 'video', 'document', 'voice', 'audio')
+_LEGACY_FILE = 'spam_tracker.json'
+
+# skip: drop the media; already_blocked: user was blocked before this message;
+# notify: block just started and the admin has not been alerted yet
+SpamVerdict = namedtuple('SpamVerdict', 'skip already_blocked photo_count notify')
+_ALLOW = SpamVerdict(False, False, 0, False)
+
+class UserState:
+    __slots__ = ('photos', 'block_until', 'notified')
+
+    def __init__(self, photos=(), block_until=0.0, notified=False):
+        self.photos = deque(photos, maxlen=SPAM_THRESHOLD + 1)
+        self.block_until = block_until
+        self.notified = notified
+
+    # Nothing left to remember: no block and no photo inside the window
+    def idle(self, now):
+        return now >= self.block_until and (not self.photos or now - self.photos[-1] >= SPAM_WINDOW)
+
+_users = {}  # (business_id, user_id) -> UserState
+_dirty = set()
+_lock = threading.Lock()
+
+# Record a message from user_id in a business connection and decide whether its media is skipped
+def check(business_id, user_id, media_type, now=None):
+    now = now or time.time()
+    key = (business_id, user_id)
+    with _lock:
+        state = _users.get(key)
+
+        if state is not None and now < state.block_until:
+            if media_type in _MEDIA_TYPES:
+                return SpamVerdict(True, True, 0, False)
+            return _ALLOW
+
+        # Only photos count towards spam detection
+        if media_type != 'photo':
+            return _ALLOW
+
+        if state is None:
+            state = _users[key] = UserState()
+        state.photos.append(now)
+        _dirty.add(key)
+
+        full = len(state.photos) == state.photos.maxlen
+        if not (full and now - state.photos[0] < SPAM_WINDOW):
+            return _ALLOW
+
+        state.block_until = now + SPAM_BLOCK_DURATION
+        photo_count = sum(1 for t in state.photos if now - t < SPAM_WINDOW)
+        notify = not state.notified
+        state.notified = True
+        return SpamVerdict(True, False, photo_count, notify)
+
+# Load saved state. owns(user_id) limits the state to the users a worker
+# process tracks.
+def load(owns=None):
+    rows = storage.load_spam_state()
+    with _lock:
+        _users.clear()
+        for row in rows:
+            if owns is None or owns(row['user_id']):
+                _users[(row['business_id'], row['user_id'])] = UserState(
+                    json.loads(row['photos']), row['block_until'], bool(row['notified']))
+
+# Import a spam_tracker.json from older versions once, attributed to the
+# connection in config.py. Called at startup before load(), and before the
+# worker processes start in processes mode.
+def import_legacy_file():
+    if not os.path.exists(_LEGACY_FILE):
+        return
+    try:
+        with open(_LEGACY_FILE, 'r') as f:
+            legacy = json.load(f)
+        rows = [(ALLOWED_BUSINESS_ID, int(user_id),
+                 json.dumps(sorted(t for t, _ in entry.get('photos', []))[-(SPAM_THRESHOLD + 1):]),
+                 entry.get('block_until', 0), int(bool(entry.get('notified', False))))
+                for user_id, entry in legacy.items()]
+        storage.save_spam_state(rows, [])
+        os.replace(_LEGACY_FILE, f"{_LEGACY_FILE}.imported")
+        print(f"Imported {len(legacy)} users from {_LEGACY_FILE}")
+    except Exception as e:
+        print(f"Error importing {_LEGACY_FILE}: {e}")
+
+# Write changed users, drop idle ones (scheduled every SPAM_SAVE_INTERVAL seconds)
+def save():
+    now = time.time()
+    with _lock:
+        idle = [key for key, state in _users.items() if state.idle(now)]
+        for key in idle:
+            del _users[key]
+        changed = [(*key, json.dumps(list(state.photos)), state.block_until, int(state.notified))
+                   for key, state in _users.items() if key in _dirty]
+        _dirty.clear()
+    try:
+        storage.save_spam_state(changed, idle)
+    except Exception as e:
+        print(f"Error saving spam state: {e}")
+        with _lock:
+            _dirty.update((business_id, user_id) for business_id, user_id, *_ in changed)  # Retry on the next save
@@ -0,0 +1,78 @@
+# /stats command
+# Every report is read from the counters that triggers keep up to date (see
+# stats_totals / stats_events in storage.py), so it costs the same on an
+# archive of any size.
+#
+# /stats               totals
+# /stats days [N]      new, edited and deleted messages per day (default 7 days)
+# /stats chats|users|types [deleted|edited|media]
+#                      top chats, users or media types by that count
+
+from datetime import date, timedelta
+from settings import *
+import storage
+
+TOP_SIZE = 10
+MAX_DAYS = 90
+
+_SCOPES = {'chats': 'chat', 'users': 'user', 'types': 'media_type'}
+_USAGE = ("Usage: /stats | /stats days [N] | /stats chats|users|types [deleted|edited|media]")
+
+def _percent(part, total):
+    return f"{part * 100 / total:.1f}%" if total else "0%"
+
+def _totals(business_ids):
+    total, deleted, edited, media = storage.message_stats(business_ids)
+    return (f"📊 Statistics:\n"
+            f"Total messages: {total}\n"
+            f"Deleted: {deleted} ({_percent(deleted, total)})\n"
+            f"Edited: {edited} ({_percent(edited, total)})\n"
+            f"With media: {media}")
+
+def _days(args, business_ids):
+    days = int(args[0]) if args and args[0].isdigit() else 7
+    days = min(max(days, 1), MAX_DAYS)
+    since = date.today() - timedelta(days=days - 1)
+    counts = {}
+    for row in storage.stats_events(since.isoformat(), business_ids):
+        counts.setdefault(row['day'], {})[row['kind']] = row['count']
+    lines = [f"📅 Last {days} days (new / edited / deleted):"]
+    for i in range(days):
+        day = (since + timedelta(days=i)).isoformat()
+        c = counts.get(day, {})
+        lines.append(f"{day}: {c.get('messages', 0)} / {c.get('edited', 0)} / {c.get('deleted', 0)}")
+    return '\n'.join(lines)
+
+def _label(scope, row):
+    if scope == 'user':
+        return f"@{row['label']}" if row['label'] else f"user {row['key']}"
+    if scope == 'chat':
+        return f"chat {row['key']}"
+    return row['key']
+
+def _top(scope_name, args, business_ids):
+    scope = _SCOPES[scope_name]
+    order_by = args[0].lower() if args and args[0].lower() in ('deleted', 'edited', 'media') else 'messages'
+    rows = storage.stats_totals(scope, business_ids, order_by=order_by, limit=TOP_SIZE)
+    rows = [row for row in rows if row[order_by] > 0]
+    if not rows:
+        return "No data yet."
+    lines = [f"🏆 Top {scope_name} by {order_by}:"]
+    for row in rows:
+        lines.append(f"{_label(scope, row)}: {row['messages']} messages, "
+                     f"{row['deleted']} deleted ({_percent(row['deleted'], row['messages'])}), "
+                     f"{row['edited']} edited ({_percent(row['edited'], row['messages'])})")
+    return '\n'.join(lines)
+
+# Run /stats and return the reply (plain text). business_ids limits the report
+# to those connections (None = all).
+def report(args, business_ids=None):
+    parts = args.split()
+    if not parts:
+        return _totals(business_ids)
+    name, rest = parts[0].lower(), parts[1:]
+    if name == 'days':
+        return _days(rest, business_ids)
+    if name in _SCOPES:
+        return _top(name, rest, business_ids)
+    return _USAGE
@@ -0,0 +1,1248 @@
+# SQLite storage layer
+# Owns one long-lived connection to messages.db (WAL mode, tuned pragmas) that
+# every handler shares. SQL lives in module-level constants so the sqlite3
+# statement cache reuses the prepared statements across calls.
+
+import sqlite3
+import threading
+import functools
+import time
+from itertools import groupby
+from contextlib import contextmanager
+from settings import *
+import metrics
+import message_cache
+
+_conn = None
+_lock = threading.RLock()
+
+# Write-behind queue: (sql, params) pairs committed together by flush()
+_pending = []
+_pending_since = 0.0
+
+# In a worker process (see process_runtime.py) the database belongs to the
+# writer process: writes and transactions are sent to it over this pipe and
+# the local connection is read-only
+_writer = None
+_writer_lock = threading.Lock()
+_WRITER_CALLS = {}  # Functions a worker runs in the writer process, by name
+
+_CREATE_MESSAGES = '''CREATE TABLE IF NOT EXISTS messages
+                      (id INTEGER PRIMARY KEY,
+                       message_id INT,
+                       chat_id INT,
+                       user_id INT,
+                       username TEXT,
+                       text TEXT,
+                       original_text TEXT,
+                       date INT,
+                       business_id TEXT,
+                       media_type TEXT,
+                       media_path TEXT,
+                       original_media_type TEXT,
+                       original_media_path TEXT,
+                       is_deleted BOOLEAN DEFAULT 0,
+                       is_edited BOOLEAN DEFAULT 0,
+                       forward_from TEXT,
+                       forward_from_chat INT,
+                       forward_from_message_id INT)'''
+
+# Recount media references from scratch (into an empty media_blobs table)
+REBUILD_MESSAGE_MEDIA_REFS = '''INSERT INTO media_blobs (path, refs)
+                                SELECT path, COUNT(*) FROM
+                                    (SELECT media_path AS path FROM messages WHERE media_path IS NOT NULL
+                                     UNION ALL
+                                     SELECT original_media_path FROM messages WHERE original_media_path IS NOT NULL)
+                                GROUP BY path'''
+
+# The same including edit history (schema version 14 and later)
+REBUILD_MEDIA_REFS = '''INSERT INTO media_blobs (path, refs)
+                        SELECT path, COUNT(*) FROM
+                            (SELECT media_path AS path FROM messages WHERE media_path IS NOT NULL
+                             UNION ALL
+                             SELECT original_media_path FROM messages WHERE original_media_path IS NOT NULL
+                             UNION ALL
+                             SELECT media_path FROM message_versions WHERE media_path IS NOT NULL)
+                        GROUP BY path'''
+
+# Statistics scopes: (scope, key, label, condition), written for the NEW or OLD row.
+# stats_totals keeps one row of counts per business connection, scope and key.
+_STATS_SCOPES = [
+    ('all', "''", 'NULL', '1'),
+    ('day', "date({r}.date, 'unixepoch', 'localtime')", 'NULL', '1'),
+    ('chat', 'CAST({r}.chat_id AS TEXT)', 'NULL', '1'),
+    ('user', 'CAST({r}.user_id AS TEXT)', '{r}.username', '1'),
+    ('media_type', '{r}.media_type', 'NULL', '{r}.media_type IS NOT NULL'),
+]
+
+# Trigger statements adding the counts of row r ('NEW' or 'OLD') to every scope
+def _stats_add(r):
+    return ''.join(f"""
+                 INSERT INTO stats_totals (business_id, scope, key, label, messages, deleted, edited, media)
+                     SELECT COALESCE({r}.business_id, ''), '{scope}', {key.format(r=r)}, {label.format(r=r)},
+                            1, {r}.is_deleted, {r}.is_edited, {r}.media_type IS NOT NULL
+                     WHERE {condition.format(r=r)}
+                     ON CONFLICT (business_id, scope, key) DO UPDATE
+                     SET messages = messages + 1, deleted = deleted + excluded.deleted,
+                         edited = edited + excluded.edited, media = media + excluded.media,
+                         label = COALESCE(excluded.label, label);"""
+                   for scope, key, label, condition in _STATS_SCOPES)
+
+# Trigger statements taking the counts of row r out of every scope
+def _stats_remove(r):
+    return ''.join(f"""
+                 UPDATE stats_totals
+                     SET messages = messages - 1, deleted = deleted - {r}.is_deleted,
+                         edited = edited - {r}.is_edited, media = media - ({r}.media_type IS NOT NULL)
+                     WHERE business_id = COALESCE({r}.business_id, '') AND scope = '{scope}'
+                           AND key = {key.format(r=r)} AND {condition.format(r=r)};"""
+                   for scope, key, label, condition in _STATS_SCOPES)
+
+def _stats_event(business_id, day, kind):
+    return f"""
+                 INSERT INTO stats_events (business_id, day, kind, count)
+                     VALUES (COALESCE({business_id}, ''), {day}, '{kind}', 1)
+                     ON CONFLICT (business_id, day, kind) DO UPDATE SET count = count + 1;"""
+
+# Fill the statistics tables from scratch (after creating them, or after a restore)
+REBUILD_STATS = [f"""INSERT INTO stats_totals (business_id, scope, key, label, messages, deleted, edited, media)
+                     SELECT COALESCE(business_id, ''), '{scope}', {key.format(r='messages')},
+                            MAX({label.format(r='messages')}), COUNT(*), SUM(is_deleted), SUM(is_edited),
+                            SUM(media_type IS NOT NULL)
+                     FROM messages
+                     WHERE {condition.format(r='messages')}
+                     GROUP BY 1, 3""" for scope, key, label, condition in _STATS_SCOPES] + [
+    """INSERT INTO stats_events (business_id, day, kind, count)
+       SELECT COALESCE(business_id, ''), date(date, 'unixepoch', 'localtime'), 'messages', COUNT(*)
+       FROM messages GROUP BY 1, 2""",
+    # Deletion times are only known for rows flagged after updated_at was added
+    """INSERT INTO stats_events (business_id, day, kind, count)
+       SELECT COALESCE(business_id, ''), date(updated_at, 'unixepoch', 'localtime'), 'deleted', COUNT(*)
+       FROM messages WHERE is_deleted = 1 AND updated_at IS NOT NULL GROUP BY 1, 2""",
+    """INSERT INTO stats_events (business_id, day, kind, count)
+       SELECT COALESCE(m.business_id, ''), date(v.edited_at, 'unixepoch', 'localtime'), 'edited', COUNT(*)
+       FROM message_versions v JOIN messages m ON m.id = v.message_ref GROUP BY 1, 2""",
+]
+
+# Schema migrations, tracked in PRAGMA user_version. Each step runs in its own
+# short transaction, so upgrading a large messages.db never holds the write
+# lock for the whole upgrade, and an interrupted upgrade resumes where it stopped.
+MIGRATIONS = [
+    (1, [_CREATE_MESSAGES]),
+    # Edit/delete lookups
+    (2, ['''CREATE INDEX IF NOT EXISTS idx_messages_lookup
+            ON messages (business_id, chat_id, message_id)''']),
+    # Retention cleanup
+    (3, ['''CREATE INDEX IF NOT EXISTS idx_messages_date ON messages (date)''']),
+    # Deleted/edited reports only touch the flagged rows
+    (4, ['''CREATE INDEX IF NOT EXISTS idx_messages_deleted
+            ON messages (business_id, date) WHERE is_deleted = 1''']),
+    (5, ['''CREATE INDEX IF NOT EXISTS idx_messages_edited
+            ON messages (business_id, date) WHERE is_edited = 1''']),
+    # Background media downloads: rows start as 'pending' and keep the file_id for resuming
+    (6, ['''ALTER TABLE messages ADD COLUMN media_status TEXT''',
+         '''ALTER TABLE messages ADD COLUMN media_file_id TEXT''',
+         '''CREATE INDEX IF NOT EXISTS idx_messages_media_path
+            ON messages (media_path) WHERE media_path IS NOT NULL''',
+         """CREATE INDEX IF NOT EXISTS idx_messages_media_pending
+            ON messages (id) WHERE media_status = 'pending'"""]),
+    # Content-addressed media: one file per blob, shared by every row that references
+    # it. Triggers keep refs equal to the number of media_path/original_media_path
+    # references, so cleanup only removes files nobody points at any more.
+    (7, ["""CREATE TABLE IF NOT EXISTS media_blobs
+            (path TEXT PRIMARY KEY,
+             refs INT NOT NULL DEFAULT 0) WITHOUT ROWID""",
+         REBUILD_MESSAGE_MEDIA_REFS,
+         """CREATE INDEX IF NOT EXISTS idx_media_blobs_orphans ON media_blobs (path) WHERE refs <= 0""",
+         """CREATE INDEX IF NOT EXISTS idx_messages_original_media_path
+            ON messages (original_media_path) WHERE original_media_path IS NOT NULL""",
+         """CREATE TRIGGER IF NOT EXISTS media_refs_insert AFTER INSERT ON messages
+            BEGIN
+                INSERT INTO media_blobs (path, refs) SELECT NEW.media_path, 1
+                    WHERE NEW.media_path IS NOT NULL
+                    ON CONFLICT (path) DO UPDATE SET refs = refs + 1;
+                INSERT INTO media_blobs (path, refs) SELECT NEW.original_media_path, 1
+                    WHERE NEW.original_media_path IS NOT NULL
+                    ON CONFLICT (path) DO UPDATE SET refs = refs + 1;
+            END""",
+         """CREATE TRIGGER IF NOT EXISTS media_refs_update
+            AFTER UPDATE OF media_path, original_media_path ON messages
+            BEGIN
+                UPDATE media_blobs SET refs = refs - 1 WHERE path = OLD.media_path;
+                UPDATE media_blobs SET refs = refs - 1 WHERE path = OLD.original_media_path;
+                INSERT INTO media_blobs (path, refs) SELECT NEW.media_path, 1
+                    WHERE NEW.media_path IS NOT NULL
+                    ON CONFLICT (path) DO UPDATE SET refs = refs + 1;
+                INSERT INTO media_blobs (path, refs) SELECT NEW.original_media_path, 1
+                    WHERE NEW.original_media_path IS NOT NULL
+                    ON CONFLICT (path) DO UPDATE SET refs = refs + 1;
+            END""",
+         """CREATE TRIGGER IF NOT EXISTS media_refs_delete AFTER DELETE ON messages
+            BEGIN
+                UPDATE media_blobs SET refs = refs - 1 WHERE path = OLD.media_path;
+                UPDATE media_blobs SET refs = refs - 1 WHERE path = OLD.original_media_path;
+            END"""]),
+    # Incremental backups: updated_at marks rows changed after insertion, meta keeps
+    # small key/value state such as the last backup position
+    (8, ["""ALTER TABLE messages ADD COLUMN updated_at INT""",
+         """CREATE INDEX IF NOT EXISTS idx_messages_updated_at
+            ON messages (updated_at) WHERE updated_at IS NOT NULL""",
+         """CREATE TABLE IF NOT EXISTS meta
+            (key TEXT PRIMARY KEY,
+             value TEXT) WITHOUT ROWID"""]),
+    # Disk usage ledger: media_blobs records each stored file's size and the type and
+    # chat it was first stored for; triggers keep per-scope totals in usage_totals
+    (9, ["""ALTER TABLE media_blobs ADD COLUMN size INT""",
+         """ALTER TABLE media_blobs ADD COLUMN media_type TEXT""",
+         """ALTER TABLE media_blobs ADD COLUMN chat_id INT""",
+         """CREATE TABLE IF NOT EXISTS usage_totals
+            (scope TEXT NOT NULL,
+             key TEXT NOT NULL,
+             bytes INT NOT NULL DEFAULT 0,
+             files INT NOT NULL DEFAULT 0,
+             PRIMARY KEY (scope, key)) WITHOUT ROWID""",
+         """CREATE TRIGGER IF NOT EXISTS media_usage_update AFTER UPDATE OF size ON media_blobs
+            BEGIN
+                INSERT INTO usage_totals (scope, key, bytes, files)
+                    VALUES ('all', '', COALESCE(NEW.size, 0) - COALESCE(OLD.size, 0),
+                            (NEW.size IS NOT NULL) - (OLD.size IS NOT NULL))
+                    ON CONFLICT (scope, key) DO UPDATE
+                    SET bytes = bytes + excluded.bytes, files = files + excluded.files;
+                INSERT INTO usage_totals (scope, key, bytes, files)
+                    VALUES ('media_type', COALESCE(NEW.media_type, 'unknown'),
+                            COALESCE(NEW.size, 0) - COALESCE(OLD.size, 0),
+                            (NEW.size IS NOT NULL) - (OLD.size IS NOT NULL))
+                    ON CONFLICT (scope, key) DO UPDATE
+                    SET bytes = bytes + excluded.bytes, files = files + excluded.files;
+                INSERT INTO usage_totals (scope, key, bytes, files)
+                    VALUES ('chat', COALESCE(CAST(NEW.chat_id AS TEXT), 'unknown'),
+                            COALESCE(NEW.size, 0) - COALESCE(OLD.size, 0),
+                            (NEW.size IS NOT NULL) - (OLD.size IS NOT NULL))
+                    ON CONFLICT (scope, key) DO UPDATE
+                    SET bytes = bytes + excluded.bytes, files = files + excluded.files;
+            END""",
+         """CREATE TRIGGER IF NOT EXISTS media_usage_delete AFTER DELETE ON media_blobs
+            WHEN OLD.size IS NOT NULL
+            BEGIN
+                UPDATE usage_totals SET bytes = bytes - OLD.size, files = files - 1
+                    WHERE scope = 'all' AND key = '';
+                UPDATE usage_totals SET bytes = bytes - OLD.size, files = files - 1
+                    WHERE scope = 'media_type' AND key = COALESCE(OLD.media_type, 'unknown');
+                UPDATE usage_totals SET bytes = bytes - OLD.size, files = files - 1
+                    WHERE scope = 'chat' AND key = COALESCE(CAST(OLD.chat_id AS TEXT), 'unknown');
+            END"""]),
+    # Spam tracker snapshots (replaces spam_tracker.json)
+    (10, ["""CREATE TABLE IF NOT EXISTS spam_state
+             (user_id INTEGER PRIMARY KEY,
+              photos TEXT NOT NULL,
+              block_until REAL NOT NULL DEFAULT 0,
+              notified INT NOT NULL DEFAULT 0)"""]),
+    # Multi-tenant support: one row per business connection. Spam state is kept per
+    # connection (the short-lived blocks of the single-account table are dropped),
+    # and per-connection /stats only reads that connection's index ranges.
+    (11, ["""CREATE TABLE IF NOT EXISTS tenants
+             (business_id TEXT PRIMARY KEY,
+              user_id INT NOT NULL,
+              username TEXT,
+              is_enabled INT NOT NULL DEFAULT 1,
+              connected_at INT,
+              updated_at INT) WITHOUT ROWID""",
+          """DROP TABLE IF EXISTS spam_state""",
+          """CREATE TABLE spam_state
+             (business_id TEXT NOT NULL,
+              user_id INT NOT NULL,
+              photos TEXT NOT NULL,
+              block_until REAL NOT NULL DEFAULT 0,
+              notified INT NOT NULL DEFAULT 0,
+              PRIMARY KEY (business_id, user_id)) WITHOUT ROWID""",
+          """CREATE INDEX IF NOT EXISTS idx_messages_media
+             ON messages (business_id) WHERE media_type IS NOT NULL"""]),
+    # Outbound alerts waiting to be sent (see alerts.py)
+    (12, ["""CREATE TABLE IF NOT EXISTS alert_queue
+             (id INTEGER PRIMARY KEY,
+              chat_id INT NOT NULL,
+              kind TEXT NOT NULL,
+              payload TEXT NOT NULL,
+              created_at INT NOT NULL,
+              attempts INT NOT NULL DEFAULT 0,
+              next_attempt_at REAL NOT NULL DEFAULT 0)"""]),
+    # Full-text search over text and original_text. The index is external-content
+    # (it stores no copy of the text) and triggers keep it in sync with messages.
+    # The initial build indexes every existing row once.
+    (13, ["""CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+             USING fts5(text, original_text, content='messages', content_rowid='id',
+                        tokenize='unicode61 remove_diacritics 2')""",
+          """INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')""",
+          """CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+             BEGIN
+                 INSERT INTO messages_fts (rowid, text, original_text)
+                     VALUES (NEW.id, NEW.text, NEW.original_text);
+             END""",
+          """CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+             BEGIN
+                 INSERT INTO messages_fts (messages_fts, rowid, text, original_text)
+                     VALUES ('delete', OLD.id, OLD.text, OLD.original_text);
+             END""",
+          """CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF text, original_text ON messages
+             WHEN OLD.text IS NOT NEW.text OR OLD.original_text IS NOT NEW.original_text
+             BEGIN
+                 INSERT INTO messages_fts (messages_fts, rowid, text, original_text)
+                     VALUES ('delete', OLD.id, OLD.text, OLD.original_text);
+                 INSERT INTO messages_fts (rowid, text, original_text)
+                     VALUES (NEW.id, NEW.text, NEW.original_text);
+             END"""]),
+    # Edit history: one insert-only row per edit (see history.py). Version media
+    # counts towards media_blobs.refs, and a message's versions go with it.
+    (14, ["""CREATE TABLE IF NOT EXISTS message_versions
+             (id INTEGER PRIMARY KEY,
+              message_ref INT NOT NULL,
+              version INT NOT NULL,
+              edited_at INT NOT NULL,
+              text_format TEXT NOT NULL DEFAULT 'full',
+              text TEXT,
+              media_type TEXT,
+              media_path TEXT,
+              UNIQUE (message_ref, version))""",
+          """CREATE INDEX IF NOT EXISTS idx_versions_media_path
+             ON message_versions (media_path) WHERE media_path IS NOT NULL""",
+          """CREATE TRIGGER IF NOT EXISTS versions_media_insert AFTER INSERT ON message_versions
+             WHEN NEW.media_path IS NOT NULL
+             BEGIN
+                 INSERT INTO media_blobs (path, refs) VALUES (NEW.media_path, 1)
+                     ON CONFLICT (path) DO UPDATE SET refs = refs + 1;
+             END""",
+          """CREATE TRIGGER IF NOT EXISTS versions_media_update AFTER UPDATE OF media_path ON message_versions
+             BEGIN
+                 UPDATE media_blobs SET refs = refs - 1 WHERE path = OLD.media_path;
+                 INSERT INTO media_blobs (path, refs) SELECT NEW.media_path, 1
+                     WHERE NEW.media_path IS NOT NULL
+                     ON CONFLICT (path) DO UPDATE SET refs = refs + 1;
+             END""",
+          """CREATE TRIGGER IF NOT EXISTS versions_media_delete AFTER DELETE ON message_versions
+             BEGIN
+                 UPDATE media_blobs SET refs = refs - 1 WHERE path = OLD.media_path;
+             END""",
+          """CREATE TRIGGER IF NOT EXISTS messages_versions_delete AFTER DELETE ON messages
+             BEGIN
+                 DELETE FROM message_versions WHERE message_ref = OLD.id;
+             END"""]),
+    # Statistics kept up to date by triggers, so /stats never counts the messages
+    # table: stats_totals holds the current archive per scope (see _STATS_SCOPES),
+    # stats_events what happened per day (messages, edits, deletions)
+    (15, ["""CREATE TABLE IF NOT EXISTS stats_totals
+             (business_id TEXT NOT NULL,
+              scope TEXT NOT NULL,
+              key TEXT NOT NULL,
+              label TEXT,
+              messages INT NOT NULL DEFAULT 0,
+              deleted INT NOT NULL DEFAULT 0,
+              edited INT NOT NULL DEFAULT 0,
+              media INT NOT NULL DEFAULT 0,
+              PRIMARY KEY (business_id, scope, key)) WITHOUT ROWID""",
+          """CREATE TABLE IF NOT EXISTS stats_events
+             (business_id TEXT NOT NULL,
+              day TEXT NOT NULL,
+              kind TEXT NOT NULL,
+              count INT NOT NULL DEFAULT 0,
+              PRIMARY KEY (business_id, day, kind)) WITHOUT ROWID""",
+          *REBUILD_STATS,
+          f"""CREATE TRIGGER IF NOT EXISTS stats_insert AFTER INSERT ON messages
+              BEGIN{_stats_add('NEW')}{_stats_event('NEW.business_id', "date(NEW.date, 'unixepoch', 'localtime')", 'messages')}
+              END""",
+          f"""CREATE TRIGGER IF NOT EXISTS stats_update AFTER UPDATE OF is_deleted, is_edited, media_type ON messages
+              WHEN OLD.is_deleted IS NOT NEW.is_deleted OR OLD.is_edited IS NOT NEW.is_edited
+                   OR OLD.media_type IS NOT NEW.media_type
+              BEGIN{_stats_remove('OLD')}{_stats_add('NEW')}
+              END""",
+          f"""CREATE TRIGGER IF NOT EXISTS stats_deleted AFTER UPDATE OF is_deleted ON messages
+              WHEN NEW.is_deleted = 1 AND OLD.is_deleted = 0
+              BEGIN{_stats_event('NEW.business_id', "date('now', 'localtime')", 'deleted')}
+              END""",
+          f"""CREATE TRIGGER IF NOT EXISTS stats_delete AFTER DELETE ON messages
+              BEGIN{_stats_remove('OLD')}
+              END""",
+          f"""CREATE TRIGGER IF NOT EXISTS stats_edited AFTER INSERT ON message_versions
+              BEGIN{_stats_event('(SELECT business_id FROM messages WHERE id = NEW.message_ref)', "date(NEW.edited_at, 'unixepoch', 'localtime')", 'edited')}
+              END"""]),
+    # One row per Telegram message: updates fetched again after a crash used to
+    # be stored twice. The first copy is kept (edits and deletions updated every
+    # copy), and versions recorded on a later copy move to it when their number
+    # is free. Deleting the copies runs the media, search and statistics triggers.
+    (16, ["""UPDATE OR IGNORE message_versions
+             SET message_ref = (SELECT MIN(k.id) FROM messages d JOIN messages k
+                                ON k.business_id IS d.business_id AND k.chat_id = d.chat_id
+                                   AND k.message_id = d.message_id
+                                WHERE d.id = message_versions.message_ref)
+             WHERE message_ref IN (SELECT d.id FROM messages d
+                                   WHERE EXISTS (SELECT 1 FROM messages k
+                                                 WHERE k.business_id IS d.business_id AND k.chat_id = d.chat_id
+                                                       AND k.message_id = d.message_id AND k.id < d.id))""",
+          """DELETE FROM messages
+             WHERE EXISTS (SELECT 1 FROM messages k
+                           WHERE k.business_id IS messages.business_id AND k.chat_id = messages.chat_id
+                                 AND k.message_id = messages.message_id AND k.id < messages.id)""",
+          """DROP INDEX IF EXISTS idx_messages_lookup""",
+          """CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_key
+             ON messages (business_id, chat_id, message_id)"""]),
+    # Tiered media (see tiers.py): where media moved out of its original path is
+    # stored. Hot media has no row. location is the warm file or the pack
+    # holding the bytes (offset/length within it), codec how they are encoded.
+    (17, ["""CREATE TABLE IF NOT EXISTS media_store
+             (path TEXT PRIMARY KEY,
+              tier TEXT NOT NULL,
+              codec TEXT NOT NULL,
+              location TEXT NOT NULL,
+              offset INT NOT NULL DEFAULT 0,
+              length INT NOT NULL,
+              original_size INT NOT NULL,
+              stored_at INT NOT NULL) WITHOUT ROWID""",
+          """CREATE INDEX IF NOT EXISTS idx_media_store_tier ON media_store (tier, stored_at)""",
+          """CREATE INDEX IF NOT EXISTS idx_media_store_location ON media_store (location)"""]),
+    # Earlier alerts of a chat, for keeping deferred alerts ahead of later ones
+    (18, ["""CREATE INDEX IF NOT EXISTS idx_alert_queue_chat ON alert_queue (chat_id, id)"""]),
+    # Media types with a shorter retention (see retention.py). Expired media
+    # leaves these indexes, so they only hold files that may still expire.
+    (19, ["""CREATE INDEX IF NOT EXISTS idx_messages_media_type
+             ON messages (media_type, date) WHERE media_path IS NOT NULL""",
+          """CREATE INDEX IF NOT EXISTS idx_messages_original_media_type
+             ON messages (original_media_type, date) WHERE original_media_path IS NOT NULL"""]),
+    # Paths queued or downloading in any process, so the alert dispatcher waits
+    # for them (also original and lazy media, which has no 'pending' row)
+    (20, ["""CREATE TABLE IF NOT EXISTS media_downloads
+             (path TEXT PRIMARY KEY,
+              queued_at INT NOT NULL) WITHOUT ROWID"""]),
+]
+
+_INSERT_MESSAGE = '''INSERT INTO messages
+                     (message_id, chat_id, user_id, username, text, original_text, date, business_id,
+                      media_type, media_path, original_media_type, original_media_path,
+                      forward_from, forward_from_chat, forward_from_message_id,
+                      media_status, media_file_id)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                     ON CONFLICT (business_id, chat_id, message_id) DO NOTHING'''
+
+# The same record is kept in message_cache for recent messages
+_SELECT_MESSAGES = '''SELECT business_id, chat_id, message_id, text, original_text, username,
+                             media_type, media_path, original_media_type, original_media_path,
+                             date, is_deleted, media_status, media_file_id,
+                             (SELECT COUNT(*) FROM message_versions WHERE message_ref = messages.id) AS versions,
+                             (SELECT MAX(edited_at) FROM message_versions
+                              WHERE message_ref = messages.id) AS last_edited_at
+                      FROM messages
+                      WHERE chat_id = ? AND business_id = ? AND message_id IN (%s)'''
+
+# Appended for each edit; the version number comes from get_message(). The
+# message is looked up by its Telegram key, so a version can be queued in the
+# same write batch as the message itself.
+_INSERT_VERSION = '''INSERT INTO message_versions
+                     (message_ref, version, edited_at, text_format, text, media_type, media_path)
+                     SELECT id, ?, ?, ?, ?, ?, ? FROM messages
+                     WHERE message_id = ? AND chat_id = ? AND business_id = ?'''
+
+_SELECT_VERSIONS = '''SELECT version, edited_at, text_format, text, media_type, media_path
+                      FROM message_versions
+                      WHERE message_ref = ?
+                      ORDER BY version'''
+
+# Look a message up without knowing its business connection; the IN list keeps
+# the lookup on the (business_id, chat_id, message_id) index
+_FIND_MESSAGE = '''SELECT id, username, date, text, original_text, original_media_type,
+                         original_media_path, is_deleted
+                  FROM messages
+                  WHERE chat_id = ? AND message_id = ? AND business_id IN (%s)
+                  ORDER BY id DESC
+                  LIMIT 1'''
+
+# Every UPDATE of a message row sets updated_at so incremental backups pick it up
+_NOW = "CAST(strftime('%s', 'now') AS INTEGER)"
+
+# The right-hand side of SET sees the row as it was before the update, so the
+# original_* columns keep the first version without a separate SELECT.
+_MARK_EDITED = '''UPDATE messages
+                  SET is_edited = 1,
+                      text = ?,
+                      original_text = COALESCE(original_text, text),
+                      media_type = ?,
+                      media_path = ?,
+                      media_status = ?,
+                      media_file_id = ?,
+                      original_media_type = COALESCE(original_media_type, media_type),
+                      original_media_path = COALESCE(original_media_path, media_path),
+                      updated_at = ''' + _NOW + '''
+                  WHERE message_id = ? AND chat_id = ? AND business_id = ?'''
+
+_MARK_DELETED = '''UPDATE messages
+                   SET is_deleted = 1, updated_at = ''' + _NOW + '''
+                   WHERE message_id = ? AND chat_id = ? AND business_id = ?'''
+
+_SET_MEDIA_STATUS = '''UPDATE messages SET media_status = ?, updated_at = ''' + _NOW + '''
+                       WHERE media_path = ?'''
+
+_SELECT_PENDING_MEDIA = '''SELECT media_file_id, media_path, media_type FROM messages
+                           WHERE media_status = 'pending' AND media_file_id IS NOT NULL'''
+
+# Point rows at the content-addressed path once a hashed download is complete
+_RENAME_MEDIA = '''UPDATE messages
+                   SET media_path = CASE WHEN media_path = :old THEN :new ELSE media_path END,
+                       original_media_path = CASE WHEN original_media_path = :old
+                                                  THEN :new ELSE original_media_path END,
+                       updated_at = ''' + _NOW + '''
+                   WHERE media_path = :old OR original_media_path = :old'''
+
+_RENAME_VERSION_MEDIA = '''UPDATE message_versions SET media_path = :new WHERE media_path = :old'''
+
+# Referenced media after a path, in path order (layout migration). Sizes are
+# not required: an upgraded archive has none until usage.reconcile() ran.
+_SELECT_MEDIA_AFTER = '''SELECT path FROM media_blobs
+                         WHERE path > ? AND refs > 0
+                         ORDER BY path LIMIT ?'''
+
+_SELECT_BLOB = '''SELECT size, media_type, chat_id FROM media_blobs WHERE path = ?'''
+
+# Carry a moved file's ledger entry over to its new path
+_MOVE_BLOB_USAGE = '''UPDATE media_blobs SET size = :size, media_type = :media_type, chat_id = :chat_id
+                      WHERE path = :path AND size IS NULL'''
+
+_MOVE_STORED_MEDIA = '''UPDATE media_store
+                        SET path = :new, location = CASE WHEN location = :old THEN :new ELSE location END
+                        WHERE path = :old'''
+
+# Paths in queued alert payloads are JSON strings
+_MOVE_ALERT_MEDIA = '''UPDATE alert_queue SET payload = REPLACE(payload, :old_json, :new_json)
+                       WHERE instr(payload, :old_json) > 0'''
+
+_SELECT_ORPHANED_MEDIA = '''SELECT path FROM media_blobs WHERE refs <= 0'''
+
+_DELETE_ORPHANED_BLOB = '''DELETE FROM media_blobs WHERE path = ? AND refs <= 0'''
+
+# Record a stored file's size, attributed to the first message that references it
+_SET_MEDIA_SIZE = '''UPDATE media_blobs
+                     SET size = :size,
+                         media_type = COALESCE(media_type,
+                             (SELECT media_type FROM messages WHERE media_path = :path LIMIT 1),
+                             (SELECT original_media_type FROM messages WHERE original_media_path = :path LIMIT 1)),
+                         chat_id = COALESCE(chat_id,
+                             (SELECT chat_id FROM messages WHERE media_path = :path LIMIT 1),
+                             (SELECT chat_id FROM messages WHERE original_media_path = :path LIMIT 1))
+                     WHERE path = :path AND size IS NOT :size'''
+
+_SELECT_MEDIA_SIZES = '''SELECT path, size FROM media_blobs'''
+
+# Downloaded, referenced media still at its original path
+_SELECT_HOT_MEDIA = '''SELECT b.path, b.media_type, b.size FROM media_blobs b
+                       WHERE b.refs > 0 AND b.size IS NOT NULL
+                             AND NOT EXISTS (SELECT 1 FROM media_store s WHERE s.path = b.path)'''
+
+_SELECT_STORED_MEDIA = '''SELECT path, tier, codec, location, offset, length, original_size, stored_at
+                          FROM media_store WHERE path = ?'''
+
+_SELECT_WARM_MEDIA = '''SELECT path, tier, codec, location, offset, length, original_size, stored_at
+                        FROM media_store
+                        WHERE tier = 'warm' AND stored_at < ?
+                        ORDER BY stored_at
+                        LIMIT ?'''
+
+_SAVE_STORED_MEDIA = '''INSERT INTO media_store
+                        (path, tier, codec, location, offset, length, original_size, stored_at)
+                        VALUES (:path, :tier, :codec, :location, :offset, :length, :original_size, :stored_at)
+                        ON CONFLICT (path) DO UPDATE
+                        SET tier = excluded.tier, codec = excluded.codec, location = excluded.location,
+                            offset = excluded.offset, length = excluded.length'''
+
+_DELETE_STORED_MEDIA = '''DELETE FROM media_store WHERE path = ?'''
+
+_COUNT_LOCATION_ENTRIES = '''SELECT COUNT(*) FROM media_store WHERE location = ?'''
+
+_SELECT_STORED_SIZES = '''SELECT path, tier, location, length FROM media_store'''
+
+_SELECT_USAGE = '''SELECT scope, key, bytes, files FROM usage_totals
+                   WHERE files > 0 OR bytes != 0
+                   ORDER BY scope, bytes DESC'''
+
+_SELECT_SPAM_STATE = '''SELECT business_id, user_id, photos, block_until, notified FROM spam_state'''
+
+_SAVE_SPAM_STATE = '''INSERT INTO spam_state (business_id, user_id, photos, block_until, notified)
+                      VALUES (?, ?, ?, ?, ?)
+                      ON CONFLICT (business_id, user_id) DO UPDATE
+                      SET photos = excluded.photos, block_until = excluded.block_until,
+                          notified = excluded.notified'''
+
+_DELETE_SPAM_STATE = '''DELETE FROM spam_state WHERE business_id = ? AND user_id = ?'''
+
+_SELECT_TENANTS = '''SELECT business_id, user_id, username, is_enabled FROM tenants'''
+
+# Connections from business_connection updates replace what was stored before
+_SAVE_TENANT = '''INSERT INTO tenants (business_id, user_id, username, is_enabled, connected_at, updated_at)
+                 VALUES (:business_id, :user_id, :username, :is_enabled, :connected_at, ''' + _NOW + ''')
+                 ON CONFLICT (business_id) DO UPDATE
+                 SET user_id = excluded.user_id, username = excluded.username,
+                     is_enabled = excluded.is_enabled,
+                     connected_at = COALESCE(excluded.connected_at, connected_at),
+                     updated_at = excluded.updated_at'''
+
+# The connection configured in config.py is only added if it is not known yet
+_SEED_TENANT = '''INSERT INTO tenants (business_id, user_id, username, is_enabled, updated_at)
+                 VALUES (?, ?, ?, 1, ''' + _NOW + ''')
+                 ON CONFLICT (business_id) DO NOTHING'''
+
+_INSERT_ALERT = '''INSERT INTO alert_queue (chat_id, kind, payload, created_at)
+                  VALUES (?, ?, ?, ''' + _NOW + ''')'''
+
+# An alert is not due while an earlier alert of its chat is deferred
+_SELECT_DUE_ALERTS = '''SELECT id, chat_id, kind, payload, created_at, attempts FROM alert_queue a
+                       WHERE next_attempt_at <= :now
+                             AND NOT EXISTS (SELECT 1 FROM alert_queue b
+                                             WHERE b.chat_id = a.chat_id AND b.id < a.id
+                                                   AND b.next_attempt_at > :now)
+                       ORDER BY id
+                       LIMIT :limit'''
+
+_DELETE_ALERT = '''DELETE FROM alert_queue WHERE id = ?'''
+
+_DEFER_ALERT = '''UPDATE alert_queue SET attempts = ?, next_attempt_at = ? WHERE id = ?'''
+
+_COUNT_ALERTS = '''SELECT COUNT(*) FROM alert_queue'''
+
+_SELECT_MEDIA_PENDING = """SELECT 1 FROM media_downloads WHERE path = :path
+                          UNION ALL
+                          SELECT 1 FROM messages WHERE media_path = :path AND media_status = 'pending'
+                          LIMIT 1"""
+
+_INSERT_MEDIA_DOWNLOAD = '''INSERT OR IGNORE INTO media_downloads (path, queued_at) VALUES (?, ?)'''
+
+_DELETE_MEDIA_DOWNLOAD = '''DELETE FROM media_downloads WHERE path = ?'''
+
+_CLEAR_MEDIA_DOWNLOADS = '''DELETE FROM media_downloads'''
+
+# Full-text search, newest first. FTS5 walks its index in rowid order, so with
+# LIMIT it stops after the first page instead of sorting every match. Filters
+# are appended by search_messages(); the snippet marks hits with \x02/\x03.
+_SEARCH_MESSAGES = '''SELECT m.id, m.business_id, m.chat_id, m.message_id, m.username, m.date,
+                             m.is_deleted, m.is_edited, m.media_type,
+                             snippet(messages_fts, -1, char(2), char(3), '...', 16) AS snippet
+                      FROM messages_fts
+                      JOIN messages m ON m.id = messages_fts.rowid
+                      WHERE messages_fts MATCH :query'''
+
+_SEARCH_FILTERS = {
+    'chat_id': ''' AND m.chat_id = :chat_id''',
+    'user_id': ''' AND m.user_id = :user_id''',
+    'username': ''' AND m.username = :username COLLATE NOCASE''',
+    'since': ''' AND m.date >= :since''',
+    'until': ''' AND m.date < :until''',
+    'deleted': ''' AND m.is_deleted = 1''',
+    'edited': ''' AND m.is_edited = 1''',
+}
+
+_SEARCH_ORDER = ''' ORDER BY messages_fts.rowid DESC LIMIT :limit OFFSET :offset'''
+
+_SELECT_META = '''SELECT value FROM meta WHERE key = ?'''
+
+_DELETE_META = '''DELETE FROM meta WHERE key = ?'''
+
+_SET_META = '''INSERT INTO meta (key, value) VALUES (?, ?)
+               ON CONFLICT (key) DO UPDATE SET value = excluded.value'''
+
+_OFFSET_MAX_AGE = 6 * 86400  # Seconds
+
+# Retention scan: keyset pagination over the date index
+_SELECT_EXPIRY_CANDIDATES = '''SELECT id, business_id, chat_id, date, media_type, media_path,
+                                      original_media_type, original_media_path
+                               FROM messages
+                               WHERE date < ? AND (date, id) > (?, ?)
+                               ORDER BY date, id
+                               LIMIT ?'''
+
+# Rows whose current or original media of a type is older than a cutoff
+_SELECT_EXPIRED_MEDIA = '''SELECT id FROM messages
+                           WHERE media_type = ? AND date < ? AND media_path IS NOT NULL
+                           LIMIT ?'''
+
+_SELECT_EXPIRED_ORIGINAL_MEDIA = '''SELECT id FROM messages
+                                    WHERE original_media_type = ? AND date < ?
+                                          AND original_media_path IS NOT NULL
+                                    LIMIT ?'''
+
+_DELETE_MESSAGE_BY_ID = '''DELETE FROM messages WHERE id = ?'''
+
+_EXPIRE_MEDIA = '''UPDATE messages
+                   SET media_path = NULL, media_status = 'expired', updated_at = ''' + _NOW + '''
+                   WHERE id = ?'''
+
+_EXPIRE_VERSION_MEDIA = '''UPDATE message_versions SET media_path = NULL
+                           WHERE message_ref = ? AND media_path IS NOT NULL'''
+
+_EXPIRE_ORIGINAL_MEDIA = '''UPDATE messages
+                            SET original_media_path = NULL, updated_at = ''' + _NOW + '''
+                            WHERE id = ?'''
+
+# Statistics reads; %s is replaced by a business_id filter (or nothing)
+_SELECT_STATS_TOTALS = '''SELECT key, MAX(label) AS label, SUM(messages) AS messages,
+                                 SUM(deleted) AS deleted, SUM(edited) AS edited, SUM(media) AS media
+                          FROM stats_totals
+                          WHERE scope = ? %s
+                          GROUP BY key
+                          ORDER BY %s DESC
+                          LIMIT ?'''
+
+_SELECT_STATS_EVENTS = '''SELECT day, kind, SUM(count) AS count
+                          FROM stats_events
+                          WHERE day >= ? %s
+                          GROUP BY day, kind
+                          ORDER BY day'''
+
+_PRUNE_STATS_EVENTS = '''DELETE FROM stats_events WHERE day < ?'''
+
+_PRUNE_STATS_TOTALS = '''DELETE FROM stats_totals WHERE messages <= 0'''
+
+# Open the shared connection and apply performance pragmas
+def _connect(path):
+    # isolation_level=None: statements autocommit unless wrapped in transaction()
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None,
+                           cached_statements=256)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')  # WAL stays durable across app crashes
+    conn.execute(f'PRAGMA cache_size=-{int(DB_CACHE_SIZE_KB)}')
+    conn.execute(f'PRAGMA mmap_size={int(DB_MMAP_SIZE)}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA busy_timeout=5000')
+    return conn
+
+# Return the shared connection, opening it on first use
+def get_connection():
+    global _conn
+    with _lock:
+        if _conn is None:
+            _conn = _connect(DB_PATH)
+            if _writer is not None:
+                _conn.execute('PRAGMA query_only = ON')
+        return _conn
+
+@contextmanager
+def _transaction():
+    conn = get_connection()
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+# Run a block of statements in one write transaction (nested calls join the outer one).
+# Queued writes are flushed first so the block sees them.
+@contextmanager
+def transaction():
+    with _lock:
+        flush()
+        with metrics.timer('bot_db_seconds', op='transaction'), _transaction() as conn:
+            yield conn
+
+# Queue a write; it is committed with the rest of the batch by flush()
+def queue_write(sql, params):
+    global _pending_since
+    with _lock:
+        if not _pending:
+            _pending_since = time.monotonic()
+        _pending.append((sql, params))
+        if (len(_pending) >= WRITE_BATCH_SIZE
+                or time.monotonic() - _pending_since >= WRITE_FLUSH_INTERVAL):
+            flush()
+
+# Commit all queued writes in one transaction, grouping runs of the same
+# statement into executemany(). Returns the number of writes committed.
+def flush():
+    with _lock:
+        if not _pending:
+            return 0
+        ops = _pending[:]
+        del _pending[:]
+        if _writer is not None:
+            return _request('flush', ops)
+        try:
+            with metrics.timer('bot_db_seconds', op='flush'), _transaction() as conn:
+                for sql, group in groupby(ops, key=lambda op: op[0]):
+                    conn.executemany(sql, [params for _, params in group])
+            metrics.inc('bot_db_writes_total', len(ops))
+        except sqlite3.Error as e:
+            # Replay one by one so a single bad write does not drop the whole batch
+            print(f"Batch write failed ({e}), retrying {len(ops)} writes individually")
+            conn = get_connection()
+            for sql, params in ops:
+                try:
+                    conn.execute(sql, params)
+                except sqlite3.Error as e:
+                    print(f"Dropped write {sql.split()[0]} {params}: {e}")
+        return len(ops)
+
+# Run one write statement now. In a worker process the writer commits it and
+# nothing is returned.
+def execute(sql, params=()):
+    with _lock:
+        if _writer is not None:
+            _pending.append((sql, params))
+            flush()
+            return None
+        flush()
+        with metrics.timer('bot_db_seconds', op='execute'):
+            return get_connection().execute(sql, params)
+
+def query_one(sql, params=()):
+    with _lock:
+        flush()
+        with metrics.timer('bot_db_seconds', op='query'):
+            return get_connection().execute(sql, params).fetchone()
+
+def query_all(sql, params=()):
+    with _lock:
+        flush()
+        with metrics.timer('bot_db_seconds', op='query'):
+            return get_connection().execute(sql, params).fetchall()
+
+# Send a request to the writer process and wait for its answer
+def _request(*request):
+    with _writer_lock:
+        _writer.send(request)
+        ok, result = _writer.recv()
+    if not ok:
+        raise result
+    return result
+
+# Functions that write in their own transaction run in the writer process
+# when called from a worker
+def _in_writer(fn):
+    _WRITER_CALLS[fn.__name__] = fn
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if _writer is None:
+            return fn(*args, **kwargs)
+        flush()  # Keep the worker's queued writes ahead of the call
+        return _request('call', fn.__name__, args, kwargs)
+    return wrapper
+
+# Use the writer process at the end of conn (a multiprocessing pipe) for every
+# write; called once at the start of a worker process
+def connect_writer(conn):
+    global _writer
+    _writer = conn
+
+# Serve one worker's requests until it disconnects (runs in the writer process).
+# on_flush is called after each batch of the worker's writes is committed.
+def serve_writer(conn, on_flush=None):
+    while True:
+        try:
+            kind, *args = conn.recv()
+        except (EOFError, OSError):
+            return
+        try:
+            if kind == 'flush':
+                with _lock:
+                    _pending.extend(args[0])
+                    result = flush()
+                if on_flush is not None:
+                    on_flush()
+            else:
+                name, call_args, call_kwargs = args
+                result = _WRITER_CALLS[name](*call_args, **call_kwargs)
+            reply = (True, result)
+        except Exception as e:
+            reply = (False, e)
+        try:
+            conn.send(reply)
+        except (BrokenPipeError, OSError):
+            return
+
+# Current schema version of the open database
+def schema_version():
+    return query_one('PRAGMA user_version')[0]
+
+# Create tables and bring an existing database up to the latest schema
+def init_db():
+    current = schema_version()
+    for version, statements in MIGRATIONS:
+        if version <= current:
+            continue
+        print(f"Applying database migration {version}...")
+        with transaction() as conn:
+            for sql in statements:
+                conn.execute(sql)
+            conn.execute(f'PRAGMA user_version = {int(version)}')
+        current = version
+
+# Flush the WAL into the main file and close the connection
+def close():
+    global _conn
+    with _lock:
+        if _conn is None:
+            return
+        flush()
+        if _writer is None:
+            try:
+                _conn.execute('PRAGMA optimize')
+                _conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            except sqlite3.Error as e:
+                print(f"Error checkpointing database: {e}")
+        _conn.close()
+        _conn = None
+
+# Insert a new archived message (ignored if the message is already stored)
+def insert_message(message_id, chat_id, user_id, username, text, date, business_id,
+                   media_type, media_path, forward_from, forward_from_chat, forward_from_message_id,
+                   media_file_id=None, media_status='pending'):
+    media_status = media_status if media_path else None
+    queue_write(_INSERT_MESSAGE,
+                (message_id, chat_id, user_id, username, text, text, date, business_id,
+                 media_type, media_path, media_type, media_path,
+                 forward_from, forward_from_chat, forward_from_message_id,
+                 media_status, media_file_id))
+    message_cache.add((business_id, chat_id, message_id), {
+        'business_id': business_id, 'chat_id': chat_id, 'message_id': message_id,
+        'text': text, 'original_text': text, 'username': username,
+        'media_type': media_type, 'media_path': media_path,
+        'original_media_type': media_type, 'original_media_path': media_path,
+        'date': date, 'is_deleted': 0, 'media_status': media_status, 'media_file_id': media_file_id,
+        'versions': 0, 'last_edited_at': None})
+
+# Fetch one archived message as a dict, or None
+def get_message(business_id, chat_id, message_id):
+    return get_messages(business_id, chat_id, [message_id]).get(message_id)
+
+# Fetch messages of one chat as {message_id: dict}; recent ones come from the
+# cache, the others from one query
+def get_messages(business_id, chat_id, message_ids):
+    found = {}
+    missing = []
+    for message_id in message_ids:
+        record = message_cache.get((business_id, chat_id, message_id))
+        if record is None:
+            missing.append(message_id)
+        else:
+            found[message_id] = record
+    if missing:
+        sql = _SELECT_MESSAGES % ', '.join('?' for _ in missing)
+        for row in query_all(sql, (chat_id, business_id, *missing)):
+            found[row['message_id']] = dict(row)
+    return found
+
+# Store the new text/media of an edited message, keeping the first version
+def mark_edited(business_id, chat_id, message_id, new_text, new_media_type, new_media_path,
+                new_media_file_id=None, media_status='pending'):
+    media_status = media_status if new_media_path else None
+    queue_write(_MARK_EDITED,
+                (new_text, new_media_type, new_media_path, media_status, new_media_file_id,
+                 message_id, chat_id, business_id))
+    message_cache.edited((business_id, chat_id, message_id), new_text, new_media_type, new_media_path,
+                         media_status, new_media_file_id)
+
+# Append one version to a message's edit history
+def add_version(business_id, chat_id, message_id, version, edited_at, text_format, text, media_type, media_path):
+    queue_write(_INSERT_VERSION, (version, edited_at, text_format, text, media_type, media_path,
+                                  message_id, chat_id, business_id))
+    message_cache.versioned((business_id, chat_id, message_id), version, edited_at)
+
+# Stored versions of a message (messages.id), oldest first
+def message_versions(message_ref):
+    return query_all(_SELECT_VERSIONS, (message_ref,))
+
+# Newest message with this chat and message id in one of the business connections
+def find_message(chat_id, message_id, business_ids):
+    if not business_ids:
+        return None
+    sql = _FIND_MESSAGE % ', '.join('?' for _ in business_ids)
+    row = query_one(sql, (chat_id, message_id, *business_ids))
+    return dict(row) if row else None
+
+# Flag messages as deleted
+def mark_deleted(business_id, chat_id, message_ids):
+    for msg_id in message_ids:
+        queue_write(_MARK_DELETED, (msg_id, chat_id, business_id))
+        message_cache.deleted((business_id, chat_id, msg_id))
+
+# Record the outcome of a background download ('done', 'failed', 'too_large')
+def set_media_status(media_path, status):
+    execute(_SET_MEDIA_STATUS, (status, media_path))
+    message_cache.media_status(media_path, status)
+
+# Downloads that were still pending when the bot stopped
+def pending_media():
+    return query_all(_SELECT_PENDING_MEDIA)
+
+# A download of path was queued; stored with the write batch of its message
+def media_download_started(path):
+    queue_write(_INSERT_MEDIA_DOWNLOAD, (path, int(time.time())))
+
+def media_download_finished(path):
+    execute(_DELETE_MEDIA_DOWNLOAD, (path,))
+
+# Forget downloads queued by a previous run (pending ones are queued again)
+def clear_media_downloads():
+    execute(_CLEAR_MEDIA_DOWNLOADS)
+
+# Move every reference from a temporary media path to its final path
+def rename_media(old_path, new_path):
+    _rename_media(old_path, new_path)
+    message_cache.media_moved(old_path, new_path)
+
+@_in_writer
+def _rename_media(old_path, new_path):
+    with transaction() as conn:
+        conn.execute(_RENAME_MEDIA, {'old': old_path, 'new': new_path})
+        conn.execute(_RENAME_VERSION_MEDIA, {'old': old_path, 'new': new_path})
+        conn.execute(_DELETE_ORPHANED_BLOB, (old_path,))
+
+# Referenced media paths after a path, in path order
+def media_paths_after(after, limit):
+    return [row['path'] for row in query_all(_SELECT_MEDIA_AFTER, (after, limit))]
+
+# Repoint every reference to moved files in one transaction; moves is a list
+# of (old path, new path). The usage ledger keeps each file's size.
+def move_media(moves):
+    _move_media(moves)
+    for old, new in moves:
+        message_cache.media_moved(old, new)
+
+@_in_writer
+def _move_media(moves):
+    with transaction() as conn:
+        for old, new in moves:
+            blob = conn.execute(_SELECT_BLOB, (old,)).fetchone()
+            params = {'old': old, 'new': new}
+            conn.execute(_RENAME_MEDIA, params)
+            conn.execute(_RENAME_VERSION_MEDIA, params)
+            conn.execute(_MOVE_STORED_MEDIA, params)
+            conn.execute(_MOVE_ALERT_MEDIA, {'old_json': f'"{old}"', 'new_json': f'"{new}"'})
+            conn.execute(_DELETE_ORPHANED_BLOB, (old,))
+            if blob is not None:
+                conn.execute(_MOVE_BLOB_USAGE, {'path': new, 'size': blob['size'],
+                                                'media_type': blob['media_type'], 'chat_id': blob['chat_id']})
+
+# Media files no longer referenced by any message
+def orphaned_media():
+    return [row['path'] for row in query_all(_SELECT_ORPHANED_MEDIA)]
+
+# Drop the records of unreferenced media files. Returns the paths that can be
+# removed from disk (files that gained a new reference meanwhile are kept).
+@_in_writer
+def forget_media(paths):
+    forgotten = []
+    with transaction() as conn:
+        for path in paths:
+            if conn.execute(_DELETE_ORPHANED_BLOB, (path,)).rowcount == 1:
+                forgotten.append(path)
+    return forgotten
+
+# Media at its original path, as (path, media_type, size) rows
+def hot_media():
+    return query_all(_SELECT_HOT_MEDIA)
+
+# Where a tiered media file is stored, or None for media at its original path
+def stored_media(path):
+    row = query_one(_SELECT_STORED_MEDIA, (path,))
+    return dict(row) if row else None
+
+# Warm media stored before a time, oldest first
+def warm_media(before, limit):
+    return [dict(row) for row in query_all(_SELECT_WARM_MEDIA, (before, limit))]
+
+# Record a media file's new location; the usage ledger counts the stored size.
+# Returns False when the media was forgotten meanwhile (nothing is recorded).
+@_in_writer
+def save_stored_media(entry):
+    with transaction() as conn:
+        if conn.execute('SELECT 1 FROM media_blobs WHERE path = ? AND refs > 0', (entry['path'],)).fetchone() is None:
+            return False
+        conn.execute(_SAVE_STORED_MEDIA, entry)
+        conn.execute(_SET_MEDIA_SIZE, {'path': entry['path'], 'size': entry['length']})
+    return True
+
+def forget_stored_media(path):
+    execute(_DELETE_STORED_MEDIA, (path,))
+
+# Media entries still stored in a warm file or pack
+def location_entries(location):
+    return query_one(_COUNT_LOCATION_ENTRIES, (location,))[0]
+
+def stored_media_sizes():
+    return query_all(_SELECT_STORED_SIZES)
+
+# Next batch of messages older than max_cutoff, after the (date, id) position
+def expiry_candidates(max_cutoff, after_date, after_id, limit):
+    return query_all(_SELECT_EXPIRY_CANDIDATES, (max_cutoff, after_date, after_id, limit))
+
+# IDs of up to limit rows with media (original media if original is set) of
+# media_type sent before cutoff
+def expired_media(media_type, cutoff, original, limit):
+    sql = _SELECT_EXPIRED_ORIGINAL_MEDIA if original else _SELECT_EXPIRED_MEDIA
+    return [row['id'] for row in query_all(sql, (media_type, cutoff, limit))]
+
+# Apply one retention batch in a single short transaction
+@_in_writer
+def apply_expiry(delete_ids, expire_media_ids, expire_original_ids):
+    with transaction() as conn:
+        conn.executemany(_DELETE_MESSAGE_BY_ID, [(i,) for i in delete_ids])
+        conn.executemany(_EXPIRE_MEDIA, [(i,) for i in expire_media_ids])
+        conn.executemany(_EXPIRE_VERSION_MEDIA, [(i,) for i in expire_media_ids])
+        conn.executemany(_EXPIRE_ORIGINAL_MEDIA, [(i,) for i in expire_original_ids])
+
+def _business_filter(business_ids):
+    if business_ids is None:
+        return '', ()
+    return f"AND business_id IN ({', '.join('?' for _ in business_ids)})", tuple(business_ids)
+
+# Totals for /stats: (total, deleted, edited, with media), for all messages
+# or only those of the given business connections
+def message_stats(business_ids=None):
+    rows = stats_totals('all', business_ids)
+    if not rows:
+        return (0, 0, 0, 0)
+    row = rows[0]
+    return (row['messages'], row['deleted'], row['edited'], row['media'])
+
+# Counter rows of one scope ('all', 'day', 'chat', 'user', 'media_type'),
+# summed over the business connections, largest order_by first
+def stats_totals(scope, business_ids=None, order_by='messages', limit=1):
+    if order_by not in ('messages', 'deleted', 'edited', 'media', 'key'):
+        raise ValueError(f"Cannot order statistics by {order_by}")
+    where, params = _business_filter(business_ids)
+    return query_all(_SELECT_STATS_TOTALS % (where, order_by), (scope, *params, limit))
+
+# Daily event counts since day ('YYYY-MM-DD') as (day, kind, count) rows
+def stats_events(since_day, business_ids=None):
+    where, params = _business_filter(business_ids)
+    return query_all(_SELECT_STATS_EVENTS % where, (since_day, *params))
+
+# Drop daily events before day and counter rows of messages that are all gone
+@_in_writer
+def prune_stats(before_day):
+    with transaction() as conn:
+        conn.execute(_PRUNE_STATS_EVENTS, (before_day,))
+        conn.execute(_PRUNE_STATS_TOTALS)
+
+# Record the size of a stored media file (None if the file is missing)
+def set_media_size(path, size):
+    execute(_SET_MEDIA_SIZE, {'path': path, 'size': size})
+
+# Apply many (path, size) corrections in one transaction
+@_in_writer
+def set_media_sizes(sizes):
+    with transaction() as conn:
+        conn.executemany(_SET_MEDIA_SIZE, [{'path': path, 'size': size} for path, size in sizes])
+
+# {path: recorded size} for every media file the database knows about
+def media_sizes():
+    return {row['path']: row['size'] for row in query_all(_SELECT_MEDIA_SIZES)}
+
+# Ledger totals as (scope, key, bytes, files) rows
+def usage_totals():
+    return [tuple(row) for row in query_all(_SELECT_USAGE)]
+
+# Saved spam tracker state
+def load_spam_state():
+    return query_all(_SELECT_SPAM_STATE)
+
+# Upsert changed spam tracker users and drop removed (business_id, user_id) keys
+# in one transaction
+@_in_writer
+def save_spam_state(changed, removed_keys):
+    if not changed and not removed_keys:
+        return
+    with transaction() as conn:
+        conn.executemany(_SAVE_SPAM_STATE, changed)
+        conn.executemany(_DELETE_SPAM_STATE, removed_keys)
+
+# Known business connections
+def load_tenants():
+    return query_all(_SELECT_TENANTS)
+
+# Store a business connection (new, changed or disabled)
+def save_tenant(business_id, user_id, username, is_enabled, connected_at=None):
+    execute(_SAVE_TENANT, {'business_id': business_id, 'user_id': user_id, 'username': username,
+                           'is_enabled': int(is_enabled), 'connected_at': connected_at})
+
+# Register the connection from config.py unless it is already known
+def seed_tenant(business_id, user_id, username):
+    execute(_SEED_TENANT, (business_id, user_id, username))
+
+# Queue an alert; it is stored with the rest of the write batch
+def queue_alert(chat_id, kind, payload):
+    queue_write(_INSERT_ALERT, (chat_id, kind, payload))
+
+# Queued alerts that may be sent now, oldest first
+def due_alerts(now, limit):
+    return query_all(_SELECT_DUE_ALERTS, {'now': now, 'limit': limit})
+
+def delete_alert(alert_id):
+    execute(_DELETE_ALERT, (alert_id,))
+
+# Try an alert again at next_attempt_at
+def defer_alert(alert_id, attempts, next_attempt_at):
+    execute(_DEFER_ALERT, (attempts, next_attempt_at, alert_id))
+
+# Alerts waiting to be sent (read without flushing, for metrics)
+def alert_queue_size():
+    with _lock:
+        return get_connection().execute(_COUNT_ALERTS).fetchone()[0]
+
+# Writes waiting for the next flush
+def pending_writes():
+    return len(_pending)
+
+# Whether a media file is still being downloaded
+def media_pending(path):
+    return query_one(_SELECT_MEDIA_PENDING, {'path': path}) is not None
+
+# Search archived text. filters may hold chat_id, user_id, username, since,
+# until, deleted and edited; business_ids limits the search to those connections.
+def search_messages(query, filters, business_ids=None, limit=10, offset=0):
+    sql = _SEARCH_MESSAGES
+    params = {'query': query, 'limit': limit, 'offset': offset}
+    for name, value in filters.items():
+        if value is not None and value is not False:
+            sql += _SEARCH_FILTERS[name]
+            params[name] = value
+    if business_ids is not None:
+        names = [f'business_id_{i}' for i in range(len(business_ids))]
+        sql += f" AND m.business_id IN ({', '.join(':' + n for n in names)})"
+        params.update(zip(names, business_ids))
+    return query_all(sql + _SEARCH_ORDER, params)
+
+# Commit the queued writes together with the getUpdates offset that follows
+# them, so a restart resumes after the last committed update
+def commit_offset(offset):
+    queue_write(_SET_META, ('update_offset', f"{offset}:{int(time.time())}"))
+    return flush()
+
+# Offset saved by commit_offset(), or None. Telegram restarts update ids at
+# random after a week without updates, so an older offset is not used.
+def load_offset():
+    value = get_meta('update_offset')
+    if value is None:
+        return None
+    offset, saved_at = (int(v) for v in value.split(':'))
+    return offset if time.time() - saved_at < _OFFSET_MAX_AGE else None
+
+# Read a value from the meta table
+def get_meta(key, default=None):
+    row = query_one(_SELECT_META, (key,))
+    return row['value'] if row else default
+
+# Store a value in the meta table
+def set_meta(key, value):
+    execute(_SET_META, (key, str(value)))
+
+# Remove a value from the meta table
+def delete_meta(key):
+    execute(_DELETE_META, (key,))
+
+# Open an extra connection for long reads (backups, exports). In WAL mode it
+# reads a consistent snapshot without blocking the shared connection's writers.
+def open_reader():
+    flush()
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA query_only = ON')
+    return conn
@@ -0,0 +1,94 @@
+# Shared Bot API client
+# Every Bot API call and file download goes through one pooled requests
+# session (keep-alive, bounded connection pool), with timeouts on every call.
+# 5xx responses are retried with backoff for every method. Sends are retried
+# too: Telegram's 5xx answers nearly always mean the request was not handled,
+# and a rare duplicate alert is better than a lost one. 429 responses wait for
+# Telegram's retry_after, unless the caller reschedules the call itself (the
+# alert dispatcher does, so one rate-limited chat does not hold up the rest).
+
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from settings import *
+import metrics
+
+_session = None
+_session_lock = threading.Lock()
+
+# Create a session with connection pooling and retry logic
+def create_session():
+    session = requests.Session()
+    # 429 is handled in call() so the wait follows Telegram's retry_after
+    retries = Retry(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504],
+                    allowed_methods=None)  # Also POST: every Bot API method here is sent as POST
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=HTTP_POOL_SIZE, max_retries=retries)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+# Return the shared session, creating it on first use
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = create_session()
+        return _session
+
+# Rewind uploaded files so a retried request sends them again from the start
+def _rewind(files):
+    for value in (files or {}).values():
+        f = value[1] if isinstance(value, tuple) else value
+        if hasattr(f, 'seek'):
+            f.seek(0)
+
+# Seconds to wait before retrying a 429 response
+def _retry_after(response):
+    try:
+        return int(response.json().get('parameters', {}).get('retry_after', 1))
+    except ValueError:
+        return int(response.headers.get('Retry-After', 1))
+
+# Call a Bot API method and return the decoded JSON response.
+# Requests with only params are sent as GET, everything else as POST.
+# With wait_on_429=False a 429 response is returned at once.
+def call(method, params=None, data=None, json=None, files=None, timeout=None, wait_on_429=True):
+    session = get_session()
+    url = f'{BASE_URL}/{method}'
+    timeout = timeout or (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        _rewind(files)
+        with metrics.timer('bot_telegram_request_seconds', method=method):
+            if data is None and json is None and files is None:
+                response = session.get(url, params=params, timeout=timeout)
+            else:
+                response = session.post(url, params=params, data=data, json=json, files=files,
+                                        timeout=timeout)
+
+        if response.status_code != 429 or not wait_on_429 or attempt == HTTP_MAX_RETRIES:
+            break
+        metrics.inc('bot_telegram_errors_total', method=method, code=429)
+        wait = _retry_after(response)
+        print(f"Telegram rate limit on {method}, retrying in {wait} s")
+        time.sleep(wait)
+
+    result = response.json()
+    if not result.get('ok', False):
+        metrics.inc('bot_telegram_errors_total', method=method, code=result.get('error_code', response.status_code))
+        print(f"Telegram API error on {method}: {result.get('description')}")
+    return result
+
+# URL of a file returned by getFile
+def file_url(file_path):
+    return f'{FILE_BASE_URL}/{file_path}'
+
+# Open a streaming download of a file returned by getFile (use as a context manager).
+# headers may hold a Range to continue a partial download.
+def open_file(file_path, timeout=None, headers=None):
+    response = get_session().get(file_url(file_path), stream=True, headers=headers,
+                                 timeout=timeout or (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    response.raise_for_status()
+    return response
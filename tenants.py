@@ -0,0 +1,94 @@
+# Business connection registry
+# One bot process serves every business account connected to it. Connections
+# arrive as business_connection updates and are kept in the tenants table and
+# in memory, so routing an update is a dict lookup. The connection written to
+# config.py by init_bot.py (ALLOWED_BUSINESS_ID / ADMIN_ID) is registered on
+# first start, so single-account setups keep working unchanged.
+#
+# TENANT_ALLOWED_USERS limits which Telegram users may connect the bot (None
+# accepts anyone). TENANT_SETTINGS overrides TENANT_DEFAULTS per connection:
+#     {BUSINESS_CONNECTION_ID: {'alert_chat_id': CHAT_ID,       # alerts go here
+#                               'alerts': ['deleted', 'edited'], # alert types sent
+#                               'retention_days': DAYS}}         # overrides CLEANUP_DAYS
+
+import threading
+from settings import *
+import storage
+
+class Tenant:
+    __slots__ = ('business_id', 'user_id', 'username', 'enabled', 'settings')
+
+    def __init__(self, business_id, user_id, username, enabled=True):
+        self.business_id = business_id
+        self.user_id = user_id
+        self.username = (username or '').lstrip('@').lower()
+        self.enabled = enabled
+        self.settings = {**TENANT_DEFAULTS, **TENANT_SETTINGS.get(business_id, {})}
+
+    # Chat that receives this connection's alerts (the account owner by default)
+    def alert_chat_id(self):
+        return self.settings.get('alert_chat_id') or self.user_id
+
+    def alerts_enabled(self, event_type):
+        return event_type in self.settings.get('alerts', ())
+
+    # Messages written by the account owner are not archived
+    def is_owner(self, user):
+        if user.get('id') == self.user_id:
+            return True
+        username = (user.get('username') or '').lower()
+        return bool(username) and username == self.username
+
+_tenants = {}
+_lock = threading.Lock()
+
+# Load known connections (and the one from config.py)
+def load():
+    if ALLOWED_BUSINESS_ID:
+        storage.seed_tenant(ALLOWED_BUSINESS_ID, ADMIN_ID, SENDER_USERNAME)
+    rows = storage.load_tenants()
+    with _lock:
+        _tenants.clear()
+        for row in rows:
+            _tenants[row['business_id']] = Tenant(row['business_id'], row['user_id'], row['username'],
+                                                  bool(row['is_enabled']))
+    print(f"Serving {sum(t.enabled for t in _tenants.values())} business connections")
+
+# Enabled connection for an update, or None if the bot does not serve it
+def get(business_id):
+    tenant = _tenants.get(business_id)
+    return tenant if tenant is not None and tenant.enabled else None
+
+# Connections owned by a Telegram user (used to scope admin commands)
+def owned_by(user_id):
+    return [t for t in _tenants.values() if t.user_id == user_id and t.enabled]
+
+# Every known connection, enabled or not
+def all_ids():
+    return list(_tenants)
+
+def retention_days():
+    return {t.business_id: t.settings['retention_days'] for t in _tenants.values()
+            if t.settings.get('retention_days')}
+
+# Handle a business_connection update: a new, changed or disabled connection.
+# Returns the stored Tenant, or None if the user may not connect the bot.
+# save=False only updates this process (another one stores the connection).
+def register(connection, save=True):
+    user = connection['user']
+    if TENANT_ALLOWED_USERS is not None and user['id'] not in TENANT_ALLOWED_USERS:
+        if save:
+            print(f"🚫 Ignored business connection from user {user['id']} (not in TENANT_ALLOWED_USERS)")
+        return None
+    # Older Bot API versions sent 'disabled' instead of 'is_enabled'
+    enabled = connection.get('is_enabled', not connection.get('disabled', False))
+    tenant = Tenant(connection['id'], user['id'], user.get('username'), enabled)
+    with _lock:
+        _tenants[tenant.business_id] = tenant
+    if not save:
+        return tenant
+    storage.save_tenant(tenant.business_id, tenant.user_id, tenant.username, enabled,
+                        connection.get('date'))
+    state = "enabled" if enabled else "disabled"
+    print(f"🔗 Business connection {tenant.business_id} of @{tenant.username} {state}")
+    return tenant
@@ -0,0 +1,92 @@
+# Test setup: settings.py imports config.py (written by install.sh), so a
+# minimal one is generated before any bot module is imported. Every test that
+# uses the db fixture gets an empty, migrated database in its own directory
+# (the working directory, so DB_PATH and MEDIA_DIR point into it).
+
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+import pytest
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_CONFIG_DIR = tempfile.mkdtemp(prefix='archive-bot-tests-')
+
+with open(os.path.join(_CONFIG_DIR, 'config.py'), 'w') as f:
+    f.write("""TOKEN = 'test'
+ADMIN_ID = 1
+ALLOWED_BUSINESS_ID = 'biz'
+SENDER_USERNAME = 'owner'
+BASE_URL = 'http://127.0.0.1:9/bottest'
+MEDIA_DIR = 'media_archive'
+MAX_FILE_SIZE = 50 * 1024 * 1024
+CLEANUP_DAYS = 5
+SPAM_THRESHOLD = 10
+SPAM_WINDOW = 60
+SPAM_BLOCK_DURATION = 3600
+MESSAGE_CACHE_SIZE = 0
+""")
+
+sys.path[:0] = [_CONFIG_DIR, _ROOT]
+
+import storage
+import shards
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    storage.close()
+    monkeypatch.chdir(tmp_path)
+    storage.init_db()
+    yield storage
+    storage.close()
+
+# messages table created by the first release, before storage.py existed
+_LEGACY_SCHEMA = '''CREATE TABLE messages
+                    (id INTEGER PRIMARY KEY, message_id INT, chat_id INT, user_id INT, username TEXT,
+                     text TEXT, original_text TEXT, date INT, business_id TEXT, media_type TEXT,
+                     media_path TEXT, original_media_type TEXT, original_media_path TEXT,
+                     is_deleted BOOLEAN DEFAULT 0, is_edited BOOLEAN DEFAULT 0, forward_from TEXT,
+                     forward_from_chat INT, forward_from_message_id INT)'''
+
+# legacy_db(rows) writes a first-release database with rows of (message_id,
+# text, original_text, media_type, media_path, original_media_type,
+# original_media_path, is_deleted, is_edited), then upgrades it
+@pytest.fixture
+def legacy_db(tmp_path, monkeypatch):
+    storage.close()
+    monkeypatch.chdir(tmp_path)
+    def create(rows):
+        conn = sqlite3.connect('messages.db')
+        conn.execute(_LEGACY_SCHEMA)
+        conn.executemany('''INSERT INTO messages (message_id, chat_id, user_id, username, text, original_text,
+                                                  date, business_id, media_type, media_path,
+                                                  original_media_type, original_media_path, is_deleted, is_edited)
+                            VALUES (?, 5, 5, 'u', ?, ?, 1700000000, 'biz', ?, ?, ?, ?, ?, ?)''', rows)
+        conn.commit()
+        conn.close()
+        storage.init_db()
+        return storage
+    yield create
+    storage.close()
+
+# add_message(message_id, ...) archives a message; with media_type, its media
+# file is written (content, or size random bytes) and recorded as downloaded.
+# Returns the media path.
+@pytest.fixture
+def add_message(db):
+    def add(message_id, chat_id=100, text='hello', date=None, media_type=None, size=None,
+            content=None, extension='.bin', business_id='biz'):
+        path = None
+        if media_type:
+            content = os.urandom(size or 1) if content is None else content
+            path = shards.media_path(f'{chat_id}_{message_id}{extension}')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(content)
+        db.insert_message(message_id, chat_id, chat_id, f'user{chat_id}', text, int(date or time.time()),
+                          business_id, media_type, path, None, None, None, media_status='done')
+        if path:
+            db.set_media_size(path, len(content))
+        return path
+    return add
@@ -0,0 +1,63 @@
+import json
+import time
+import alerts
+
+def _dispatcher(monkeypatch, replies):
+    sent = []
+    def send(row):
+        text = json.loads(row['payload'])['text']
+        reply = replies.pop(text, ({'ok': True}, 1))
+        if reply is not None and reply[0].get('ok'):
+            sent.append(text)
+        return reply
+    monkeypatch.setattr(alerts, '_send', send)
+    monkeypatch.setattr(alerts, '_chat_bucket', lambda chat_id: alerts.TokenBucket(1000, 1000))
+    return sent
+
+def _queue(*alerts_by_chat):
+    for chat_id, text in alerts_by_chat:
+        alerts.enqueue(chat_id, 'message', {'text': text})
+
+def _make_due(db):
+    db.execute('UPDATE alert_queue SET next_attempt_at = 0')
+
+def test_alert_waiting_for_media_keeps_its_place(db, monkeypatch):
+    sent = _dispatcher(monkeypatch, {'a1': None})
+    _queue((1, 'a1'), (1, 'a2'), (2, 'b1'))
+    alerts._dispatch_due()
+    alerts._dispatch_due()
+    assert sent == ['b1']
+    _make_due(db)
+    alerts._dispatch_due()
+    assert sent == ['b1', 'a1', 'a2']
+    assert db.alert_queue_size() == 0
+
+def test_retried_alert_keeps_its_place(db, monkeypatch):
+    sent = _dispatcher(monkeypatch, {'a1': ({'ok': False, 'error_code': 502}, 1)})
+    _queue((1, 'a1'), (1, 'a2'), (2, 'b1'))
+    alerts._dispatch_due()
+    alerts._dispatch_due()
+    assert sent == ['b1']
+    _make_due(db)
+    alerts._dispatch_due()
+    assert sent == ['b1', 'a1', 'a2']
+
+def test_refused_alert_is_dropped(db, monkeypatch):
+    sent = _dispatcher(monkeypatch, {'a1': ({'ok': False, 'error_code': 403}, 1)})
+    _queue((1, 'a1'), (1, 'a2'))
+    alerts._dispatch_due()
+    assert sent == ['a2']
+    assert db.alert_queue_size() == 0
+
+def test_document_waits_for_a_download_in_any_process(db, monkeypatch):
+    path = 'media_archive/ab/original.bin'
+    db.media_download_started(path)  # Queued by an update worker
+    row = {'id': 1, 'chat_id': 1, 'kind': 'document', 'created_at': time.time(), 'attempts': 0,
+           'payload': json.dumps({'path': path, 'caption': 'deleted photo'})}
+    assert alerts._send(row) is None
+
+    calls = []
+    monkeypatch.setattr(alerts.telegram_api, 'call', lambda method, **kwargs: calls.append(method) or {'ok': True})
+    db.media_download_finished(path)  # Failed: the caption goes out alone
+    assert alerts._send(row) == ({'ok': True}, 1)
+    assert calls == ['sendMessage']
@@ -0,0 +1,90 @@
+import os
+import time
+import sqlite3
+import backup
+import retention
+import search
+import usage
+
+_MESSAGES = '''SELECT message_id, chat_id, text, original_text, media_path, original_media_path,
+                      is_deleted, is_edited FROM messages ORDER BY message_id'''
+_VERSIONS = 'SELECT message_ref, version, text, media_path FROM message_versions ORDER BY message_ref, version'
+_REFS = 'SELECT path, refs FROM media_blobs WHERE refs > 0 ORDER BY path'
+_STATS = '''SELECT business_id, scope, key, messages, deleted, edited, media FROM stats_totals
+            WHERE messages > 0 ORDER BY business_id, scope, key'''
+
+def _rows(path, sql):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute(sql).fetchall()
+    finally:
+        conn.close()
+
+def _search(path, words):
+    conn = sqlite3.connect(path)
+    try:
+        query, _, _ = search.parse(words)
+        return [row[0] for row in conn.execute('''SELECT m.message_id FROM messages_fts
+                                                  JOIN messages m ON m.id = messages_fts.rowid
+                                                  WHERE messages_fts MATCH ?''', (query,))]
+    finally:
+        conn.close()
+
+def _usage(db):
+    return sorted(row for row in db.usage_totals() if row[3] > 0)
+
+def test_restore_full_and_delta(db, add_message):
+    add_message(1, media_type='photo', size=100)
+    add_message(2, text='first')
+    add_message(4, text='apple banana')
+    db.mark_edited('biz', 100, 4, 'cherry', None, None)
+    usage.reconcile()
+    since = int(time.time())
+    full, max_id, max_version_id = backup.create_full_backup('full')
+
+    add_message(3, media_type='video', size=300)
+    db.mark_edited('biz', 100, 2, 'second', None, None)
+    db.add_version('biz', 100, 2, 1, since, 'text', 'second', None, None)
+    db.mark_deleted('biz', 100, [1])
+    db.mark_edited('biz', 100, 4, 'damson', None, None)
+    delta, *_ = backup.create_delta_backup('delta', max_id, since, max_version_id)
+    usage.reconcile()
+    expected_usage = _usage(db)
+    db.close()
+
+    backup.restore('restored.db', full, [delta])
+    for sql in (_MESSAGES, _VERSIONS, _REFS, _STATS):
+        assert _rows('restored.db', sql) == _rows('messages.db', sql)
+    _rows('restored.db', "INSERT INTO messages_fts (messages_fts, rank) VALUES ('integrity-check', 1)")
+    assert _search('restored.db', 'cherry') == []
+    assert _search('restored.db', 'damson') == [4]
+    assert _search('restored.db', 'apple') == [4]  # The original text
+
+    # The ledger of the restored database is reconciled again on the next start
+    for name in os.listdir('.'):
+        if name.startswith('messages.db'):
+            os.remove(name)
+    os.rename('restored.db', 'messages.db')
+    db.init_db()
+    assert db.get_meta('usage_reconciled_at') is None
+    usage.reconcile()
+    assert _usage(db) == expected_usage
+
+def test_restore_applies_retention_policies(db, add_message, monkeypatch):
+    monkeypatch.setattr(retention, 'RETENTION_POLICIES', {'chats': {200: 30}})
+    monkeypatch.setattr(retention.tenants, 'retention_days', lambda: {'biz2': 2})
+    monkeypatch.setattr(retention, 'RETENTION_BATCH_PAUSE', 0)
+    now = time.time()
+    add_message(1, chat_id=100, date=now - 10 * 86400)  # CLEANUP_DAYS = 5
+    add_message(2, chat_id=200, date=now - 10 * 86400)  # Kept by its chat policy
+    add_message(3, chat_id=300, date=now - 3 * 86400, business_id='biz2')  # Connection keeps 2 days
+    add_message(4, chat_id=300, date=now - 3 * 86400)
+    since = int(time.time())
+    full, max_id, max_version_id = backup.create_full_backup('full')
+    retention.run()
+    delta, *_ = backup.create_delta_backup('delta', max_id, since, max_version_id)
+    db.close()
+
+    backup.restore('restored.db', full, [delta])
+    assert _rows('restored.db', 'SELECT message_id FROM messages ORDER BY message_id') == [(2,), (4,)]
+    assert _rows('restored.db', _MESSAGES) == _rows('messages.db', _MESSAGES)
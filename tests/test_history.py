@@ -0,0 +1,26 @@
+import pytest
+import history
+
+@pytest.mark.parametrize('old, new', [
+    ('', 'new text'),
+    ('the parcel arrives on monday', 'the parcel arrives on tuesday morning'),
+    ('дом и сад', 'дом, сад и огород'),
+    ('drop everything', ''),
+])
+def test_diff_round_trip(old, new):
+    assert history.apply_diff(old, history.encode_diff(old, new)) == new
+
+def test_versions_rebuild_every_edit(db, add_message, monkeypatch):
+    monkeypatch.setattr(history, 'HISTORY_DIFF_MIN_LENGTH', 1)
+    base = 'order 1234: two boxes, delivery to the main office before noon. '
+    texts = [base * 3, base * 3 + 'Call first.', base * 2 + 'Call first.', 'cancelled']
+    add_message(1, text=texts[0])
+    for i, text in enumerate(texts[1:], 1):
+        previous = db.get_message('biz', 100, 1)
+        history.record_edit(previous, text, None, None, edited_at=1700000000 + i)
+        db.mark_edited('biz', 100, 1, text, None, None)
+    formats = [row['text_format'] for row in db.message_versions(db.find_message(100, 1, ['biz'])['id'])]
+    assert 'diff' in formats
+    versions = history.load_versions(db.find_message(100, 1, ['biz']))
+    assert [version['text'] for version in versions] == texts
+    assert [version['version'] for version in versions] == [0, 1, 2, 3]
@@ -0,0 +1,49 @@
+import sqlite3
+import threading
+import multiprocessing
+import pytest
+import storage
+import process_runtime
+
+# Worker side: every write goes through the pipe (runs in a spawned process)
+def _client(conn):
+    storage.connect_writer(conn)
+    storage.insert_message(1, 5, 5, 'u', 'first', 1700000000, 'biz', 'photo', 'media_archive/p',
+                           None, None, None, media_status='done')
+    storage.insert_message(2, 5, 5, 'u', 'second', 1700000000, 'biz', None, None, None, None, None)
+    storage.flush()
+    assert storage.get_message('biz', 5, 1)['text'] == 'first'  # Committed before flush() returns
+    storage.mark_deleted('biz', 5, [2])
+    storage.set_media_sizes([('media_archive/p', 10)])  # Runs in the writer, after the queued writes
+    try:
+        storage.forget_media(None)
+    except TypeError:
+        pass  # Raised in the writer, re-raised here
+    else:
+        raise AssertionError("writer error was not raised in the worker")
+    try:
+        storage.execute('INSERT INTO meta (key, value) VALUES (?, ?)', ('worker', 'done'))
+    except sqlite3.OperationalError:
+        raise AssertionError("the read-only connection was used for a write")
+    storage.close()
+
+def test_worker_writes_through_the_writer(db):
+    writer_end, worker_end = multiprocessing.Pipe()
+    flushes = []
+    writer = threading.Thread(target=storage.serve_writer, args=(writer_end, lambda: flushes.append(1)))
+    writer.start()
+    process = multiprocessing.get_context('spawn').Process(target=_client, args=(worker_end,))
+    process.start()
+    worker_end.close()
+    process.join(60)
+    writer.join(10)
+    assert process.exitcode == 0 and not writer.is_alive()
+    assert flushes
+    rows = db.query_all('SELECT message_id, is_deleted FROM messages ORDER BY message_id')
+    assert [tuple(row) for row in rows] == [(1, 0), (2, 1)]
+    assert db.media_sizes() == {'media_archive/p': 10}
+    assert db.get_meta('worker') == 'done'
+
+@pytest.mark.parametrize('chat_id, count, worker', [(10, 3, 1), (-100123, 4, 1), (None, 4, 0), (7, 1, 0)])
+def test_chats_stay_on_one_worker(chat_id, count, worker):
+    assert process_runtime._shard(chat_id, count) == worker
@@ -0,0 +1,82 @@
+import os
+import time
+from datetime import datetime
+import pytest
+import retention
+
+_DAY = 86400
+
+@pytest.fixture(autouse=True)
+def small_batches(monkeypatch):
+    monkeypatch.setattr(retention, 'RETENTION_BATCH_SIZE', 2)
+    monkeypatch.setattr(retention, 'RETENTION_BATCH_PAUSE', 0)
+
+def _policy(media_types=None, chats=None, days=5):
+    return retention.RetentionPolicy({'media_types': media_types or {}, 'chats': chats or {}},
+                                     default_days=days, now=datetime.now(), tenant_days={})
+
+def _message_ids(db):
+    return [row[0] for row in db.query_all('SELECT message_id FROM messages ORDER BY message_id')]
+
+def test_interrupted_run_resumes(db, add_message, monkeypatch):
+    now = time.time()
+    old_paths = [add_message(i, date=now - (20 - i) * _DAY, media_type='photo', size=10) for i in range(1, 8)]
+    add_message(10, date=now)
+    applied = []
+    apply_expiry = db.apply_expiry
+    def crash_on_third_batch(*args):
+        if len(applied) == 2:
+            raise RuntimeError('interrupted')
+        applied.append(args)
+        apply_expiry(*args)
+    monkeypatch.setattr(db, 'apply_expiry', crash_on_third_batch)
+    with pytest.raises(RuntimeError):
+        retention.run(_policy())
+    assert _message_ids(db) == [5, 6, 7, 10]
+    assert db.get_meta('retention_cursor') is not None
+
+    monkeypatch.setattr(db, 'apply_expiry', apply_expiry)
+    candidates = []
+    expiry_candidates = db.expiry_candidates
+    def record(*args):
+        rows = expiry_candidates(*args)
+        candidates.extend(row['id'] for row in rows)
+        return rows
+    monkeypatch.setattr(db, 'expiry_candidates', record)
+    assert retention.run(_policy()) == (3, 0, 3)
+    assert len(candidates) == 3  # Only the rows after the saved position
+    assert _message_ids(db) == [10]
+    assert db.get_meta('retention_cursor') is None
+    assert not any(os.path.exists(path) for path in old_paths)
+    assert db.query_all('SELECT path FROM media_blobs') == []
+
+def test_chat_policy_overrides_default(db, add_message):
+    now = time.time()
+    add_message(1, chat_id=1, date=now - 10 * _DAY)
+    add_message(2, chat_id=2, date=now - 10 * _DAY)
+    add_message(3, chat_id=2, date=now - 40 * _DAY)
+    retention.run(_policy(chats={2: 30}))
+    assert _message_ids(db) == [2]
+
+def test_media_type_policy_does_not_widen_the_scan(db, add_message, monkeypatch):
+    now = time.time()
+    old_video = add_message(1, date=now - 3 * _DAY, media_type='video', size=10)
+    old_photo = add_message(2, date=now - 3 * _DAY, media_type='photo', size=10)
+    new_video = add_message(3, date=now, media_type='video', size=10)
+    for i in range(4, 10):
+        add_message(i, date=now - 3 * _DAY, media_type='video', size=10)
+    cutoffs = []
+    monkeypatch.setattr(db, 'expiry_candidates', lambda cutoff, *args: cutoffs.append(cutoff) or [])
+    policy = _policy(media_types={'video': 1})
+    assert retention.run(policy) == (0, 14, 7)  # Current and original media
+    assert cutoffs == [policy.message_cutoff()]
+    assert _message_ids(db) == list(range(1, 10))
+    rows = db.query_all('SELECT media_path, original_media_path, media_status FROM messages WHERE message_id = 1')
+    assert tuple(rows[0]) == (None, None, 'expired')
+    assert not os.path.exists(old_video)
+    assert os.path.exists(old_photo) and os.path.exists(new_video)
+
+def test_media_type_expiry_uses_its_index(db):
+    for sql in (db._SELECT_EXPIRED_MEDIA, db._SELECT_EXPIRED_ORIGINAL_MEDIA):
+        plan = ' '.join(row[3] for row in db.query_all('EXPLAIN QUERY PLAN ' + sql, ('video', 0, 10)))
+        assert 'USING INDEX idx_messages_' in plan and 'media_type' in plan
@@ -0,0 +1,32 @@
+import search
+
+def _found(db, args):
+    query, filters, _ = search.parse(args)
+    return sorted(row['message_id'] for row in db.search_messages(query, filters))
+
+def _check_index(db):
+    db.execute("INSERT INTO messages_fts (messages_fts, rank) VALUES ('integrity-check', 1)")
+
+def test_index_follows_inserts_edits_and_deletes(db, add_message):
+    add_message(1, text='parcel arrives tomorrow')
+    add_message(2, text='invoice attached')
+    add_message(3, chat_id=7, text='parcel is late')
+    assert _found(db, 'parcel') == [1, 3]
+    assert _found(db, 'parcel chat:7') == [3]
+
+    db.mark_edited('biz', 100, 2, 'corrected receipt', None, None)
+    assert _found(db, 'receipt') == [2]
+    assert _found(db, 'invoice') == [2]  # The original text stays searchable
+    assert _found(db, 'invoice edited') == [2]
+
+    db.mark_deleted('biz', 100, [1])
+    assert _found(db, 'parcel deleted') == [1]
+    row_id = db.query_one('SELECT id FROM messages WHERE message_id = 3')['id']
+    db.apply_expiry([row_id], [], [])
+    assert _found(db, 'parcel') == [1]
+    _check_index(db)
+
+def test_user_input_is_not_fts_syntax(db, add_message):
+    add_message(1, text='price: NEAR "quoted" OR')
+    assert _found(db, 'NEAR OR') == [1]
+    assert _found(db, 'pri*') == [1]
@@ -0,0 +1,29 @@
+import os
+import shards
+
+def test_legacy_flat_archive_is_sharded(legacy_db):
+    os.makedirs('media_archive')
+    with open('media_archive/photo_1.jpg', 'wb') as f:
+        f.write(b'jpeg')
+    db = legacy_db([(1, 'hi', 'hi', 'photo', 'media_archive/photo_1.jpg', 'photo', 'media_archive/photo_1.jpg', 0, 0)])
+    assert db.media_sizes() == {'media_archive/photo_1.jpg': None}  # Not reconciled yet
+
+    assert shards.migrate() == 1
+    new = shards.media_path('photo_1.jpg')
+    assert not os.path.exists('media_archive/photo_1.jpg')
+    with open(new, 'rb') as f:
+        assert f.read() == b'jpeg'
+    row = db.query_one('SELECT media_path, original_media_path FROM messages')
+    assert tuple(row) == (new, new)
+    assert db.media_sizes() == {new: None}
+    assert db.get_meta('media_layout') == 'sharded'
+    assert shards.migrate() == 0  # Nothing left to move
+
+def test_resolve_finds_either_layout(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    sharded = shards.media_path('a.jpg')
+    os.makedirs('media_archive')
+    open('media_archive/a.jpg', 'wb').close()
+    assert shards.resolve(sharded) == 'media_archive/a.jpg'
+    assert shards.resolve('media_archive/a.jpg') == 'media_archive/a.jpg'
+    assert shards.resolve('media_archive/warm/x.webp') == 'media_archive/warm/x.webp'
@@ -0,0 +1,21 @@
+import json
+import os
+import time
+import spam
+
+def test_legacy_tracker_is_imported_for_worker_processes(db):
+    now = time.time()
+    with open('spam_tracker.json', 'w') as f:
+        json.dump({'7': {'photos': [[now - 5, 1], [now - 1, 2]], 'block_until': now + 60, 'notified': True},
+                   '8': {'photos': [[now - 2, 3]]}}, f)
+    spam.import_legacy_file()
+    assert not os.path.exists('spam_tracker.json') and os.path.exists('spam_tracker.json.imported')
+
+    spam.load(lambda user_id: user_id % 2 == 1)  # The worker of odd user IDs
+    try:
+        assert set(spam._users) == {('biz', 7)}
+        state = spam._users[('biz', 7)]
+        assert list(state.photos) == [now - 5, now - 1] and state.notified
+        assert spam.check('biz', 7, 'photo', now).already_blocked
+    finally:
+        spam.load(lambda user_id: False)
@@ -0,0 +1,64 @@
+import storage
+
+def _refs(db):
+    return {row['path']: row['refs'] for row in db.query_all('SELECT path, refs FROM media_blobs')}
+
+def test_new_database_is_at_latest_version(db):
+    assert db.schema_version() == storage.MIGRATIONS[-1][0]
+    tables = {row[0] for row in db.query_all("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    db.init_db()  # Nothing left to apply
+    assert {row[0] for row in db.query_all("SELECT name FROM sqlite_master WHERE type = 'table'")} == tables
+
+def test_legacy_database_is_upgraded(legacy_db):
+    db = legacy_db([
+        (1, 'first', 'first', 'photo', 'media_archive/a.jpg', 'photo', 'media_archive/a.jpg', 0, 0),
+        (2, 'edited', 'orig', 'photo', 'media_archive/b.jpg', 'photo', 'media_archive/a.jpg', 0, 1),
+        (3, 'gone', 'gone', None, None, None, None, 1, 0),
+        (3, 'gone', 'gone', None, None, None, None, 1, 0),  # Stored twice by an old restart
+    ])
+    assert db.schema_version() == storage.MIGRATIONS[-1][0]
+    rows = db.query_all('SELECT message_id, text, original_text FROM messages ORDER BY message_id')
+    assert [tuple(row) for row in rows] == [(1, 'first', 'first'), (2, 'edited', 'orig'), (3, 'gone', 'gone')]
+    assert _refs(db) == {'media_archive/a.jpg': 3, 'media_archive/b.jpg': 1}
+    assert db.message_stats() == (3, 1, 1, 2)
+
+def _insert(db, message_id, path, chat_id=5):
+    db.insert_message(message_id, chat_id, chat_id, 'u', 'text', 1700000000, 'biz', 'photo', path,
+                      None, None, None, media_status='done')
+
+def _delete_rows(db, *message_ids):
+    ids = [row['id'] for row in db.query_all(
+        f"SELECT id FROM messages WHERE message_id IN ({', '.join('?' for _ in message_ids)})", message_ids)]
+    db.apply_expiry(ids, [], [])
+
+def test_media_refs_follow_every_reference(db):
+    _insert(db, 1, 'media_archive/p')
+    _insert(db, 2, 'media_archive/p')  # Same content, same file
+    assert _refs(db) == {'media_archive/p': 4}  # media_path and original_media_path of both
+
+    db.mark_edited('biz', 5, 1, 'text', 'photo', 'media_archive/q')
+    db.add_version('biz', 5, 1, 1, 1700000001, 'text', 'text', 'photo', 'media_archive/q')
+    assert _refs(db) == {'media_archive/p': 3, 'media_archive/q': 2}
+
+    _delete_rows(db, 2)
+    assert _refs(db) == {'media_archive/p': 1, 'media_archive/q': 2}
+    assert db.orphaned_media() == []
+
+    _delete_rows(db, 1)  # Its versions go with it
+    assert _refs(db) == {'media_archive/p': 0, 'media_archive/q': 0}
+    assert sorted(db.forget_media(db.orphaned_media())) == ['media_archive/p', 'media_archive/q']
+    assert _refs(db) == {}
+
+def test_renamed_media_merges_into_existing_file(db):
+    _insert(db, 1, 'media_archive/tmp1')
+    _insert(db, 2, 'media_archive/final')
+    db.rename_media('media_archive/tmp1', 'media_archive/final')
+    assert _refs(db) == {'media_archive/final': 4}
+
+def test_expired_media_drops_its_references(db):
+    _insert(db, 1, 'media_archive/p')
+    row_id = db.query_one('SELECT id FROM messages')['id']
+    db.apply_expiry([], [row_id], [])
+    assert _refs(db) == {'media_archive/p': 1}  # original_media_path is kept
+    db.apply_expiry([], [], [row_id])
+    assert db.orphaned_media() == ['media_archive/p']
@@ -0,0 +1,79 @@
+import io
+import os
+import time
+import pytest
+import tiers
+
+@pytest.fixture(autouse=True)
+def tiering(monkeypatch):
+    monkeypatch.setattr(tiers, 'MEDIA_WARM_DAYS', 0)
+    monkeypatch.setattr(tiers, 'MEDIA_COLD_DAYS', 1)
+
+def _age(*paths):
+    old = time.time() - 3600
+    for path in paths:
+        os.utime(path, (old, old))
+
+def _read(path):
+    name, f = tiers.open_original(path)
+    with f:
+        return name, f.read()
+
+def _pack_now(monkeypatch):
+    monkeypatch.setattr(tiers, 'MEDIA_COLD_DAYS', -1)
+    tiers.run()
+
+def test_packed_media_round_trip(db, add_message, monkeypatch):
+    monkeypatch.setattr(tiers, 'Image', None)
+    monkeypatch.setattr(tiers, 'zstandard', None)
+    contents = {add_message(i, media_type='document', size=1000 * i): None for i in range(1, 4)}
+    for path in contents:
+        with open(path, 'rb') as f:
+            contents[path] = f.read()
+    _age(*contents)
+    _pack_now(monkeypatch)
+
+    entries = [db.stored_media(path) for path in contents]
+    assert {entry['tier'] for entry in entries} == {'cold'}
+    pack = entries[0]['location']
+    assert {entry['location'] for entry in entries} == {pack}
+    for path, content in contents.items():
+        assert not os.path.exists(path)
+        assert tiers.exists(path)
+        assert _read(path) == (os.path.basename(path), content)
+
+    first, second, third = contents
+    tiers.remove(first)
+    tiers.remove(second)
+    assert os.path.exists(pack) and _read(third)[1] == contents[third]
+    tiers.remove(third)
+    assert not os.path.exists(pack) and not tiers.exists(third)
+
+def test_compressed_media_round_trip(db, add_message, monkeypatch):
+    pytest.importorskip('zstandard')
+    content = b'order 1234, delivery tomorrow\n' * 2000
+    path = add_message(1, media_type='document', content=content, extension='.txt')
+    _age(path)
+    tiers.run()
+    entry = db.stored_media(path)
+    assert (entry['tier'], entry['codec']) == ('warm', 'zstd')
+    assert entry['length'] < len(content) and not os.path.exists(path)
+    assert _read(path) == (os.path.basename(path), content)
+
+    _pack_now(monkeypatch)
+    assert db.stored_media(path)['tier'] == 'cold'
+    assert _read(path) == (os.path.basename(path), content)
+
+def test_photo_is_sent_as_webp(db, add_message):
+    Image = pytest.importorskip('PIL.Image')
+    image = Image.radial_gradient('L').convert('RGB')
+    jpeg = io.BytesIO()
+    image.save(jpeg, 'JPEG', quality=95)
+    path = add_message(1, media_type='photo', content=jpeg.getvalue(), extension='.jpg')
+    _age(path)
+    tiers.run()
+    assert db.stored_media(path)['codec'] == 'webp'
+    name, data = _read(path)
+    assert name == os.path.splitext(os.path.basename(path))[0] + '.webp'
+    with Image.open(io.BytesIO(data)) as decoded:
+        assert decoded.format == 'WEBP' and decoded.size == image.size
@@ -0,0 +1,318 @@
+# Tiered media storage
+# Fresh downloads stay in MEDIA_DIR as they arrived (hot). After MEDIA_WARM_DAYS
+# a background process pool re-encodes them into MEDIA_DIR/warm: photos to WebP,
+# compressible documents to zstd. Media that would not shrink (video, voice,
+# already compressed files) is left where it is. After MEDIA_COLD_DAYS warm
+# media is appended to large append-only packs in MEDIA_DIR/packs, so an old
+# archive is a handful of big files instead of one inode per photo.
+#
+# Messages keep their original media path. media_store maps it to the warm file
+# or the pack slice holding the bytes, and open_original() reads them back for
+# alerts. Packs are filled in date order and expire together with their media;
+# a pack is deleted once no entry in it is referenced any more.
+#
+# Small JPEG thumbnails (MEDIA_DIR/thumbs) are made when a photo is downloaded
+# and shown as the preview of document alerts.
+#
+# Pillow (WebP, thumbnails) and zstandard are optional: without them media is
+# only packed.
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from settings import *
+import storage
+import shards
+import metrics
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+WARM_DIR = f"{MEDIA_DIR}/warm"
+PACK_DIR = f"{MEDIA_DIR}/packs"
+THUMB_DIR = f"{MEDIA_DIR}/thumbs"
+
+_THUMBNAIL_SIZE = 320  # Bot API limit for document thumbnails
+_PACK_BATCH = 100  # Files appended to a pack per fsync
+_WEBP_MIN_SAVING = 0.25  # Keep the original unless WebP is this much smaller
+_ZSTD_MIN_SAVING = 0.10
+
+_IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff'}
+# Formats that zstd cannot shrink noticeably
+_COMPRESSED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.mp4', '.mov', '.mkv', '.webm',
+                          '.mp3', '.m4a', '.ogg', '.oga', '.opus', '.flac', '.zip', '.gz', '.tgz', '.bz2',
+                          '.xz', '.zst', '.7z', '.rar', '.apk', '.docx', '.xlsx', '.pptx', '.epub'}
+
+_run_lock = threading.Lock()
+_move_lock = threading.Lock()  # Between moving a file to another tier and removing it
+_open_pack = None  # Pack being appended to, kept even while none of its entries are saved yet
+
+def thumb_path(path):
+    return f"{THUMB_DIR}/{os.path.splitext(os.path.basename(path))[0]}.jpg"
+
+# Whether the media at a logical path is stored in any tier
+def exists(path):
+    return os.path.exists(shards.resolve(path)) or storage.stored_media(path) is not None
+
+# File name to send the media under (WebP keeps the original name's stem)
+def _display_name(path, entry):
+    name = os.path.basename(path)
+    if entry and entry['codec'] == 'webp':
+        return f"{os.path.splitext(name)[0]}.webp"
+    return name
+
+def _read_entry(entry):
+    if entry['tier'] == 'cold':
+        spooled = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+        with open(entry['location'], 'rb') as f:
+            f.seek(entry['offset'])
+            remaining = entry['length']
+            while remaining:
+                chunk = f.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    raise OSError(f"pack {entry['location']} is truncated")
+                spooled.write(chunk)
+                remaining -= len(chunk)
+        spooled.seek(0)
+        source = spooled
+    else:
+        source = open(shards.resolve(entry['location']), 'rb')
+    if entry['codec'] != 'zstd':
+        return source
+    with source:
+        output = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+        zstandard.ZstdDecompressor().copy_stream(source, output)
+        output.seek(0)
+        return output
+
+# Open the media stored at a logical path, wherever it lives.
+# Returns (file name, binary file object); the caller closes the file.
+def open_original(path):
+    for attempt in range(2):
+        entry = storage.stored_media(path)
+        try:
+            if entry is None:
+                return _display_name(path, None), open(shards.resolve(path), 'rb')
+            return _display_name(path, entry), _read_entry(entry)
+        except FileNotFoundError:
+            if attempt:
+                raise  # Moved to the next tier while opening: look it up once more
+
+# Thumbnail of an image, if one was made
+def thumbnail(path):
+    thumb = thumb_path(path)
+    return thumb if os.path.exists(thumb) else None
+
+# Make the alert preview of a downloaded image (called by the download workers)
+def make_thumbnail(path):
+    if not MEDIA_THUMBNAILS or Image is None or os.path.splitext(path)[1].lower() not in _IMAGE_EXTENSIONS:
+        return
+    try:
+        os.makedirs(THUMB_DIR, exist_ok=True)
+        with Image.open(path) as image:
+            image.draft('RGB', (_THUMBNAIL_SIZE, _THUMBNAIL_SIZE))  # Decode JPEGs at a reduced scale
+            image = image.convert('RGB')
+            image.thumbnail((_THUMBNAIL_SIZE, _THUMBNAIL_SIZE))
+            image.save(thumb_path(path), 'JPEG', quality=80)
+    except Exception as e:
+        print(f"Error making thumbnail of {path}: {e}")
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+# Remove media from every tier (after its last reference is gone).
+# Returns True if anything was deleted.
+def remove(path):
+    with _move_lock:
+        removed = False
+        entry = storage.stored_media(path)
+        hot = shards.resolve(path)
+        if os.path.exists(hot):
+            os.remove(hot)
+            removed = True
+        if entry is not None:
+            storage.forget_stored_media(path)
+            removed = True
+            location = entry['location']
+            if location not in (path, hot, _open_pack) and storage.location_entries(location) == 0:
+                _remove_quietly(location)  # Warm file, or a pack with no live entries left
+        if os.path.exists(thumb_path(path)):
+            os.remove(thumb_path(path))
+    return removed
+
+# Which encoding to try for a hot file
+def _codec(row):
+    extension = os.path.splitext(row['path'])[1].lower()
+    if Image is not None and (row['media_type'] == 'photo' or extension in _IMAGE_EXTENSIONS):
+        return 'webp'
+    if zstandard is not None and row['media_type'] == 'document' and extension not in _COMPRESSED_EXTENSIONS:
+        return 'zstd'
+    return 'raw'
+
+# Re-encode one file (runs in a worker process). Returns the encoded size, or
+# None when it does not save enough to be worth keeping.
+def _encode(path, target, codec, level):
+    original_size = os.path.getsize(path)
+    try:
+        if codec == 'webp':
+            with Image.open(path) as image:
+                image.save(target, 'WEBP', quality=level)
+            min_saving = _WEBP_MIN_SAVING
+        else:
+            with open(path, 'rb') as source, open(target, 'wb') as output:
+                zstandard.ZstdCompressor(level=level).copy_stream(source, output)
+            min_saving = _ZSTD_MIN_SAVING
+        size = os.path.getsize(target)
+    except Exception:
+        _remove_quietly(target)
+        raise
+    if size > original_size * (1 - min_saving):
+        _remove_quietly(target)
+        return None
+    return size
+
+# Record a new location and delete the file it replaces. A file whose media was
+# forgotten meanwhile is dropped instead.
+def _commit_move(entry, old_location):
+    with _move_lock:
+        if not storage.save_stored_media(entry):
+            if entry['location'] != old_location and entry['tier'] == 'warm':
+                _remove_quietly(entry['location'])
+            return False
+        if old_location != entry['location']:
+            _remove_quietly(old_location)
+    metrics.inc('bot_media_tiered_total', tier=entry['tier'], codec=entry['codec'])
+    return True
+
+# Move hot media older than MEDIA_WARM_DAYS to the warm tier
+def _warm(pool):
+    cutoff = time.time() - MEDIA_WARM_DAYS * 86400
+    moved = saved = 0
+    futures = {}
+    for row in storage.hot_media():
+        path = row['path']
+        source = shards.resolve(path)
+        try:
+            stat = os.stat(source)
+        except FileNotFoundError:
+            continue
+        if stat.st_mtime >= cutoff:
+            continue
+        entry = {'path': path, 'tier': 'warm', 'codec': 'raw', 'location': source, 'offset': 0,
+                 'length': stat.st_size, 'original_size': stat.st_size, 'stored_at': int(time.time())}
+        codec = _codec(row)
+        if codec == 'raw' or pool is None:
+            moved += _commit_move(entry, source)
+            continue
+        name = os.path.basename(path)
+        target = f"{WARM_DIR}/{shards.shard(name)}/{name}.{'webp' if codec == 'webp' else 'zst'}"
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        level = MEDIA_WEBP_QUALITY if codec == 'webp' else MEDIA_ZSTD_LEVEL
+        futures[pool.submit(_encode, source, target, codec, level)] = (entry, codec, source, target)
+
+    for future in as_completed(futures):
+        entry, codec, source, target = futures[future]
+        try:
+            size = future.result()
+        except FileNotFoundError:
+            continue  # Removed by cleanup meanwhile
+        except Exception as e:
+            print(f"Error recompressing {entry['path']}: {e}")
+            size = None
+        if size is not None:
+            saved += entry['original_size'] - size
+            entry.update(codec=codec, location=target, length=size)
+        moved += _commit_move(entry, source)
+    metrics.inc('bot_media_tiering_saved_bytes_total', saved)
+    return moved, saved
+
+# Pack to append to: the newest one until it reaches MEDIA_PACK_SIZE
+def _current_pack():
+    packs = sorted(name for name in os.listdir(PACK_DIR) if name.endswith('.pack'))
+    if packs:
+        path = f"{PACK_DIR}/{packs[-1]}"
+        if os.path.getsize(path) < MEDIA_PACK_SIZE:
+            return path
+        number = int(packs[-1][5:-5]) + 1
+    else:
+        number = 1
+    return f"{PACK_DIR}/pack_{number:06d}.pack"
+
+# Append warm media older than MEDIA_COLD_DAYS to packs
+def _pack():
+    global _open_pack
+    cutoff = int(time.time() - MEDIA_COLD_DAYS * 86400)
+    packed = 0
+    while True:
+        entries = storage.warm_media(cutoff, _PACK_BATCH)
+        if not entries:
+            break
+        with _move_lock:
+            pack = _open_pack = _current_pack()
+        appended = []
+        with open(pack, 'ab') as f:
+            for entry in entries:
+                try:
+                    location = shards.resolve(entry['location'])
+                    with open(location, 'rb') as source:
+                        offset = f.tell()
+                        shutil.copyfileobj(source, f, 1024 * 1024)
+                except FileNotFoundError:
+                    continue  # Removed by cleanup meanwhile
+                appended.append((entry, location, offset))
+                if f.tell() >= MEDIA_PACK_SIZE:
+                    break
+            f.flush()
+            os.fsync(f.fileno())  # Pack data is durable before any row points at it
+        for entry, old_location, offset in appended:
+            entry.update(tier='cold', location=pack, offset=offset)
+            packed += _commit_move(entry, old_location)
+        with _move_lock:
+            _open_pack = None
+        if not appended:
+            break  # Every candidate vanished; the next run sees the cleaned-up rows
+    return packed
+
+# Move media between tiers (scheduled hourly when MEDIA_TIERING is on)
+def run():
+    if not _run_lock.acquire(blocking=False):
+        return  # Already running
+    try:
+        started = time.time()
+        os.makedirs(WARM_DIR, exist_ok=True)
+        os.makedirs(PACK_DIR, exist_ok=True)
+        pool = None
+        if Image is not None or zstandard is not None:
+            pool = ProcessPoolExecutor(max_workers=MEDIA_TIERING_WORKERS,
+                                       mp_context=multiprocessing.get_context('spawn'))
+        try:
+            warmed, saved = _warm(pool)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        packed = _pack()
+        if warmed or packed:
+            print(f"Media tiering: {warmed} files to warm storage ({saved / 1048576:.1f} MB saved), "
+                  f"{packed} to packs in {time.time() - started:.1f} s")
+    except Exception as e:
+        metrics.inc('bot_failures_total', where='tiering')
+        print(f"Media tiering error: {e}")
+    finally:
+        _run_lock.release()
+
+def run_in_background():
+    threading.Thread(target=run, name='media-tiering', daemon=True).start()
@@ -0,0 +1,151 @@
+# Disk usage accounting
+# Media sizes are recorded in the database when a download finishes and
+# dropped when cleanup removes a file, so /size and backup captions read a few
+# ledger rows instead of walking the media archive. reconcile() periodically
+# re-scans the disk with os.scandir to correct drift (files removed by hand,
+# archives from before the ledger existed) and measures everything outside
+# the media directory. Media moved to warm or cold storage (see tiers.py) is
+# counted at its stored size.
+
+import os
+import time
+import threading
+from settings import *
+import storage
+import shards
+
+_reconcile_lock = threading.Lock()
+
+# Convert size to human-readable format
+def sizeof_fmt(num, suffix='B'):
+    for unit in ['', 'K', 'M', 'G', 'T', 'P', 'E', 'Z']:
+        if abs(num) < 1024.0:
+            return f"{num:.1f}{unit}{suffix}"
+        num /= 1024.0
+    return f"{num:.1f}Y{suffix}"
+
+# Yield (path, size) for every regular file below path
+def _scan(path):
+    try:
+        entries = list(os.scandir(path))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if entry.is_symlink():
+            continue
+        if entry.is_dir():
+            yield from _scan(entry.path)
+        elif entry.is_file():
+            yield entry.path, entry.stat().st_size
+
+# Database files change size constantly, so they are measured live
+def _database_bytes():
+    total = 0
+    for path in (DB_PATH, f"{DB_PATH}-wal", f"{DB_PATH}-shm"):
+        try:
+            total += os.path.getsize(path)
+        except OSError:
+            pass
+    return total
+
+def _is_database_file(path):
+    return os.path.normpath(path) in {os.path.normpath(p) for p in
+                                      (DB_PATH, f"{DB_PATH}-wal", f"{DB_PATH}-shm")}
+
+# Record the size of a finished download
+def record_file(path):
+    try:
+        storage.set_media_size(path, os.path.getsize(shards.resolve(path)))
+    except OSError as e:
+        print(f"Error recording size of {path}: {e}")
+
+# Re-scan the project directory and correct the ledger
+def reconcile():
+    if not _reconcile_lock.acquire(blocking=False):
+        return  # Already running
+    try:
+        started = time.time()
+        media_dir = os.path.normpath(MEDIA_DIR)
+        recorded = storage.media_sizes()
+        stored = {}  # Logical path -> (location, size), for media moved out of its original path
+        live_bytes = {}  # Warm file or pack -> bytes of it still referenced
+        for path, tier, location, length in storage.stored_media_sizes():
+            if location != path:
+                stored[path] = (location, length)
+                live_bytes[location] = live_bytes.get(location, 0) + length
+        corrections = []
+        seen = set()
+        untracked_bytes = 0
+
+        for path, size in _scan(MEDIA_DIR):
+            key = path.replace(os.sep, '/')
+            if key in recorded:
+                seen.add(key)
+                if recorded[key] != size:
+                    corrections.append((key, size))
+            elif key in live_bytes:
+                seen.add(key)
+                untracked_bytes += max(size - live_bytes[key], 0)  # Dead space left in a pack
+            else:
+                untracked_bytes += size  # Partial downloads, thumbnails, files not referenced by the DB
+        for key, size in recorded.items():
+            if key in seen:
+                continue
+            location, length = stored.get(key, (None, None))
+            if location in seen:
+                if size != length:
+                    corrections.append((key, length))
+            elif size is not None:
+                corrections.append((key, None))  # File is gone
+
+        for i in range(0, len(corrections), 500):
+            storage.set_media_sizes(corrections[i:i + 500])
+
+        other_bytes = 0
+        for entry in os.scandir('.'):
+            if os.path.normpath(entry.path) == media_dir or entry.is_symlink():
+                continue
+            if entry.is_dir():
+                other_bytes += sum(size for _, size in _scan(entry.path))
+            elif entry.is_file() and not _is_database_file(entry.path):
+                other_bytes += entry.stat().st_size
+
+        storage.set_meta('usage_untracked_bytes', untracked_bytes)
+        storage.set_meta('usage_other_bytes', other_bytes)
+        storage.set_meta('usage_reconciled_at', int(time.time()))
+        print(f"Disk usage reconciled in {time.time() - started:.1f} s "
+              f"({len(corrections)} corrections)")
+    finally:
+        _reconcile_lock.release()
+
+# Reconcile in a background thread (startup of a database without a ledger yet)
+def reconcile_in_background():
+    threading.Thread(target=reconcile, name='usage-reconcile', daemon=True).start()
+
+# Total project size in bytes
+def project_size_bytes():
+    media_bytes = 0
+    for scope, key, size, files in storage.usage_totals():
+        if scope == 'all':
+            media_bytes = size
+    return (media_bytes + _database_bytes()
+            + int(storage.get_meta('usage_untracked_bytes', 0))
+            + int(storage.get_meta('usage_other_bytes', 0)))
+
+# Human-readable usage report for /size
+def usage_report(top_chats=5):
+    totals = storage.usage_totals()
+    lines = [f"📁 Project directory size: {sizeof_fmt(project_size_bytes())}",
+             f"Database: {sizeof_fmt(_database_bytes())}"]
+    by_type = [(key, size, files) for scope, key, size, files in totals if scope == 'media_type']
+    if by_type:
+        lines.append("\nMedia by type:")
+        lines += [f"{key}: {sizeof_fmt(size)} ({files} files)" for key, size, files in by_type]
+    by_chat = [(key, size, files) for scope, key, size, files in totals if scope == 'chat']
+    if by_chat:
+        lines.append(f"\nTop chats by media:")
+        lines += [f"{key}: {sizeof_fmt(size)} ({files} files)" for key, size, files in by_chat[:top_chats]]
+    reconciled_at = storage.get_meta('usage_reconciled_at')
+    if reconciled_at:
+        lines.append(f"\nLast disk scan: {time.strftime('%Y-%m-%d %H:%M', time.localtime(int(reconciled_at)))}")
+    return '\n'.join(lines)
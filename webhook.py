@@ -0,0 +1,116 @@
+# Webhook runtime
+# Telegram POSTs updates to an embedded aiohttp server instead of the bot
+# polling for them. Each request is checked against the secret token,
+# answered right away and queued; a consumer feeds the queue to the same
+# per-chat ChatDispatcher as async mode. When the queue is full the server
+# answers 503 and Telegram redelivers the update later.
+#
+# Telegram only delivers to HTTPS on ports 443, 80, 88 or 8443: run a reverse
+# proxy (nginx, Caddy) that terminates TLS for WEBHOOK_URL and forwards to
+# WEBHOOK_LISTEN:WEBHOOK_PORT. With WEBHOOK_URL unset the server only listens
+# locally, so recorded updates can be replayed with curl:
+#     curl -H 'X-Telegram-Bot-Api-Secret-Token: SECRET' -H 'Content-Type: application/json' \
+#          -d @update.json http://127.0.0.1:8443/telegram-webhook
+
+import hmac
+import json
+import asyncio
+import secrets
+from settings import *
+import telegram_api
+import async_runtime
+import metrics
+
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+_SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+# Receives updates over HTTP and hands them to a ChatDispatcher
+class WebhookServer:
+    def __init__(self, dispatcher, secret, queue_size=WEBHOOK_QUEUE_SIZE):
+        self.dispatcher = dispatcher
+        self.secret = secret
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.received = 0
+        self.rejected = 0
+
+    async def handle(self, request):
+        token = request.headers.get(_SECRET_HEADER, '')
+        if not hmac.compare_digest(token.encode(), self.secret.encode()):
+            return web.Response(status=401)
+        try:
+            update = json.loads(await request.read())
+        except ValueError:
+            return web.Response(status=400)
+        if not isinstance(update, dict) or 'update_id' not in update:
+            return web.Response(status=400)
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            metrics.inc('bot_webhook_rejected_total')
+            return web.Response(status=503, headers={'Retry-After': '1'})
+        self.received += 1
+        return web.Response()
+
+    # Move queued updates to the dispatcher (waits while it is at ASYNC_MAX_PENDING)
+    async def consume(self):
+        while True:
+            update = await self.queue.get()
+            await self.dispatcher.submit(update)
+
+    # Submit whatever was acknowledged but not dispatched yet
+    async def drain(self):
+        while not self.queue.empty():
+            await self.dispatcher.submit(self.queue.get_nowait())
+        await self.dispatcher.drain()
+
+# Point Telegram at WEBHOOK_URL (nothing to do when testing locally)
+def register_webhook(secret):
+    if not WEBHOOK_URL:
+        print("WEBHOOK_URL is not set, not registering the webhook with Telegram")
+        return
+    telegram_api.call('setWebhook', json={
+        'url': WEBHOOK_URL,
+        'secret_token': secret,
+        'max_connections': WEBHOOK_MAX_CONNECTIONS
+    })
+    print(f"Webhook registered at {WEBHOOK_URL}")
+
+async def _main(handler):
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    if not WEBHOOK_SECRET and not WEBHOOK_URL:
+        print(f"Webhook secret for this run: {secret}")
+    dispatcher = async_runtime.ChatDispatcher(handler)
+    server = WebhookServer(dispatcher, secret)
+
+    app = web.Application(client_max_size=WEBHOOK_MAX_BODY)
+    app.router.add_post(WEBHOOK_PATH, server.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+    print(f"Listening for updates on http://{WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, register_webhook, secret)
+
+    tasks = [asyncio.ensure_future(coro) for coro in [server.consume(), *async_runtime.background_jobs()]]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        await runner.cleanup()  # Stop accepting updates first
+        for task in tasks:
+            task.cancel()
+        await server.drain()
+        dispatcher.shutdown()
+        print(f"Webhook stopped: {server.received} updates received, {server.rejected} rejected as busy")
+
+# Run the bot as a webhook server until interrupted
+def run(handler):
+    if web is None:
+        raise SystemExit("Webhook mode needs aiohttp: pip3 install aiohttp")
+    print("🌐 Running in webhook mode")
+    asyncio.run(_main(handler))